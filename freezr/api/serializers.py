@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 from rest_framework import serializers
+from django.db import connection
 from freezr.core.models import Account, LogEntry, Domain, Project, Instance
 from freezr.common.util import separator_split
 import freezr.common.util as util
@@ -10,6 +11,11 @@ from collections import Counter
 
 log = logging.getLogger('freezr.serializers')
 
+# Number of most recent log entries embedded in domains, accounts and
+# projects, unless overridden with the `log_entries` query parameter.
+# The full log is available from the log entry endpoint.
+LOG_ENTRIES_DEFAULT = 10
+
 
 class ImmutableMixin(object):
     def restore_object(self, attrs, instance=None):
@@ -25,6 +31,46 @@ class ImmutableMixin(object):
                                                           instance=instance)
 
 
+class SparseFieldsMixin(object):
+    """Limits the serialized fields to those listed in the `fields`
+    query parameter (comma-separated), if given. The `id` field is
+    always included."""
+
+    def __init__(self, *args, **kwargs):
+        super(SparseFieldsMixin, self).__init__(*args, **kwargs)
+
+        fields = wanted_fields(self.context.get('request'))
+
+        if fields is not None:
+            for name in list(self.fields):
+                if name not in fields:
+                    del self.fields[name]
+
+
+def wanted_fields(request):
+    """Set of fields asked for with the `fields` query parameter, or
+    None if all fields are wanted."""
+    try:
+        fields = request.QUERY_PARAMS['fields']
+    except (AttributeError, KeyError):
+        return None
+
+    return set(separator_split(fields, ",")) | set(['id'])
+
+
+# Project fields computed from the instance categories, see
+# freezr.core.models.prefetch_categories.
+CATEGORY_FIELDS = set(['picked_instances', 'saved_instances',
+                       'terminated_instances', 'skipped_instances'])
+
+
+def categories_wanted(request):
+    """Whether any of the CATEGORY_FIELDS are wanted, see
+    `wanted_fields`."""
+    fields = wanted_fields(request)
+    return fields is None or bool(fields & CATEGORY_FIELDS)
+
+
 class CommaStringListField(util.Logger, serializers.WritableField):
     def to_native(self, obj):
         return list(set(separator_split(obj, ",")))
@@ -36,19 +82,93 @@ class CommaStringListField(util.Logger, serializers.WritableField):
 class LogEntrySerializer(serializers.ModelSerializer):
     user_id = serializers.Field(source='user.id')
     user = serializers.Field(source='user.username')
+    details = serializers.Field(source='get_details')
 
     class Meta:
         model = LogEntry
         fields = ('type', 'time', 'message', 'details', 'user_id', 'user')
 
 
+def log_entry_count(request):
+    """Number of log entries to embed for `request`."""
+    try:
+        return max(0, int(request.QUERY_PARAMS['log_entries']))
+    except (AttributeError, KeyError, ValueError):
+        return LOG_ENTRIES_DEFAULT
+
+
+def prefetch_recent_log_entries(objs, count):
+    """Load the `count` most recent log entries of all `objs` (which
+    must be of the same model) with a single query, and store them for
+    `RecentLogEntriesField`."""
+    if not objs or not count:
+        return
+
+    owner = objs[0]._meta.model_name
+    attname = LogEntry._meta.get_field(owner).attname
+    table = connection.ops.quote_name(LogEntry._meta.db_table)
+    column = connection.ops.quote_name(attname)
+
+    # Correlated subquery picking the latest entries of each object
+    entries = (LogEntry.objects
+               .filter(**{owner + '__in': objs})
+               .select_related('user', 'stored_details')
+               .extra(where=['{0}.id IN (SELECT l.id FROM {0} l '
+                             'WHERE l.{1} = {0}.{1} '
+                             'ORDER BY l.time DESC, l.id DESC '
+                             'LIMIT %s)'.format(table, column)],
+                      params=[count])
+               .order_by('time', 'id'))
+
+    by_owner = {obj.pk: [] for obj in objs}
+
+    for entry in entries:
+        by_owner[getattr(entry, attname)].append(entry)
+
+    for obj in objs:
+        obj._recent_log_entries = by_owner[obj.pk]
+
+
+class RecentLogEntriesField(serializers.Field):
+    """Read-only field embedding the most recent log entries of the
+    object (in chronological order). The number of entries is given by
+    the `log_entries` query parameter, defaulting to
+    `LOG_ENTRIES_DEFAULT`. See also `prefetch_recent_log_entries`."""
+
+    def field_to_native(self, obj, field_name):
+        count = log_entry_count(self.context.get('request'))
+
+        if not count:
+            return []
+
+        entries = getattr(obj, '_recent_log_entries', None)
+
+        if entries is None:
+            entries = list(obj.log_entries
+                           .select_related('user', 'stored_details')
+                           .order_by('-time', '-id')[:count])
+            entries.reverse()
+
+        return LogEntrySerializer(entries, many=True,
+                                  context=self.context).data
+
+
+class StandaloneLogEntrySerializer(LogEntrySerializer):
+    """Log entry serializer for log entries outside of their owning
+    object, e.g. including the id and the owning object references."""
+
+    class Meta(LogEntrySerializer.Meta):
+        fields = (('id', 'domain', 'account', 'project') +
+                  LogEntrySerializer.Meta.fields)
+
+
 class DomainSerializer(serializers.ModelSerializer):
-    log_entries = LogEntrySerializer(many=True, read_only=True)
+    log_entries = RecentLogEntriesField()
 
     class Meta:
         model = Domain
         fields = ('id', 'name', 'description', 'active', 'accounts',
-                  'log_entries', 'domain',
+                  'log_entries', 'domain', 'sequence',
                   #'url',
                   )
 
@@ -58,7 +178,7 @@ class AccountSerializer(util.Logger, ImmutableMixin,
 #                        serializers.HyperlinkedModelSerializer):
     regions = serializers.Field()
     updated = serializers.Field()  # no user-initiated updates on this field
-    log_entries = LogEntrySerializer(many=True, read_only=True)
+    log_entries = RecentLogEntriesField()
     secret_key = serializers.WritableField(required=False)
 
     # def restore_fields(self, data, files):
@@ -112,13 +232,13 @@ class AccountSerializer(util.Logger, ImmutableMixin,
         model = Account
         fields = ('id', 'domain', 'name', 'access_key', 'secret_key',
                   'active', 'projects', 'regions',
-                  'instances', 'updated', 'log_entries',
+                  'instances', 'updated', 'log_entries', 'sequence',
                   #'url',
                   )
         immutable_fields = ('domain',)
 
 
-class ProjectSerializer(util.Logger, ImmutableMixin,
+class ProjectSerializer(util.Logger, ImmutableMixin, SparseFieldsMixin,
                         serializers.ModelSerializer):
     picked_instances = serializers.PrimaryKeyRelatedField(
         many=True, read_only=True)
@@ -134,7 +254,7 @@ class ProjectSerializer(util.Logger, ImmutableMixin,
 
     regions = CommaStringListField(source='regions_actual')
 
-    log_entries = LogEntrySerializer(many=True, read_only=True)
+    log_entries = RecentLogEntriesField()
 
     state_updated = serializers.Field()
 
@@ -236,21 +356,21 @@ class ProjectSerializer(util.Logger, ImmutableMixin,
                   'pick_filter', 'save_filter', 'terminate_filter',
                   'picked_instances', 'saved_instances',
                   'skipped_instances', 'terminated_instances',
-                  'log_entries', 'state_updated',
+                  'log_entries', 'state_updated', 'sequence',
                   #, 'url')
                   )
         immutable_fields = ('account',)
 
 
-class InstanceSerializer(serializers.ModelSerializer):
+class InstanceSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     tags = serializers.Field()
 
     class Meta:
         model = Instance
         fields = ('id', 'account', 'instance_id', 'region', 'vpc_id',
-                  'store', 'state', 'tags',
+                  'store', 'state', 'tags', 'sequence',
                   #'url',
                   )
 
     def transform_tags(self, obj, value):
-        return {tag.key: tag.value for tag in obj.tags.all()}
+        return obj.tag_data
@@ -1,7 +1,8 @@
 from __future__ import absolute_import
 import django.conf.urls as urls
 from .views import (DomainViewSet, AccountViewSet,
-                    ProjectViewSet, InstanceViewSet)
+                    ProjectViewSet, InstanceViewSet, LogEntryViewSet,
+                    BulkOperationView, ChangesView)
 from rest_framework import routers
 import logging
 
@@ -12,8 +13,13 @@ router.register(r'domain', DomainViewSet)
 router.register(r'account', AccountViewSet)
 router.register(r'project', ProjectViewSet)
 router.register(r'instance', InstanceViewSet)
+router.register(r'log', LogEntryViewSet, base_name='log')
 
 urlpatterns = urls.patterns(
     '',
+    urls.url(r'^api/changes/$', ChangesView.as_view(), name='changes'),
+    # Before the router, which would take these for project ids
+    urls.url(r'^api/project/(?P<operation>freeze|thaw)/$',
+             BulkOperationView.as_view(), name='project-bulk'),
     urls.url(r'^api/', urls.include(router.urls))
     )
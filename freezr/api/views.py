@@ -1,19 +1,141 @@
 from __future__ import absolute_import
-from freezr.core.models import Account, Domain, Project, Instance
+from freezr.core.models import (Account, Domain, Project, Instance,
+                                LogEntry, Tombstone, safe_sequence,
+                                narrow_instances, prefetch_categories)
 from .serializers import (AccountSerializer, DomainSerializer,
-                          InstanceSerializer, ProjectSerializer)
+                          InstanceSerializer, ProjectSerializer,
+                          StandaloneLogEntrySerializer, categories_wanted,
+                          log_entry_count, prefetch_recent_log_entries)
+from freezr.core.filter import Filter, ParseException
+from freezr.core.inventory import Inventory
 from freezr.backend.tasks import (dispatch, refresh_account,
-                                  freeze_project, thaw_project)
+                                  refresh_project_states,
+                                  freeze_project, thaw_project,
+                                  freeze_projects, thaw_projects)
 from django.http import Http404
+from django.utils.dateparse import parse_datetime
+from django.utils import timezone
 from rest_framework.response import Response
-from rest_framework.decorators import action
-from rest_framework.exceptions import MethodNotAllowed
+from rest_framework.decorators import action, link
+from rest_framework.exceptions import MethodNotAllowed, ParseError
 from rest_framework import status
 from rest_framework import viewsets
+from rest_framework.views import APIView
+from rest_framework.templatetags.rest_framework import replace_query_param
 import freezr.common.util as util
-
-
-class BaseViewSet(util.Logger, viewsets.ModelViewSet):
+import time
+
+# Default and maximum time (in seconds) a change feed request waits
+# for changes, and how often the database is checked while waiting.
+CHANGES_TIMEOUT = 25
+CHANGES_TIMEOUT_MAX = 60
+CHANGES_POLL_INTERVAL = 1
+
+# Maximum number of objects (and of deletions) returned at a time by
+# a `since` listing of a viewset without `max_paginate_by`.
+SINCE_BATCH_SIZE = 1000
+
+
+def start_operation(project, state):
+    """Move `project` to `state` ("freezing" or "thawing") and return
+    the id of the operation to run for it."""
+    # Plan which instances to change, a re-freeze (or re-thaw)
+    # continues with the plan made earlier.
+    if project.state != state:
+        project.make_plan(state)
+
+    # Update project state.
+    project.state = state
+    project.save()
+
+    # Take over the operation from any earlier one (see Project.
+    # acquire_operation), which then stops at its next renewal.
+    return project.acquire_operation(force=True)
+
+
+def batch_end(queryset, limit):
+    """Return the sequence up to which the objects in `queryset` make
+    a batch of at most `limit` objects, or None if all of them fit.
+    Objects with the same sequence are never split between batches,
+    so a batch is larger if more than `limit` objects share the
+    sequence."""
+    sequences = queryset.order_by('sequence').values_list('sequence',
+                                                          flat=True)
+    excluded = list(sequences[limit:limit + 1])
+
+    if not excluded:
+        return None
+
+    last = list(sequences.filter(sequence__lt=excluded[0])
+                .order_by('-sequence')[:1])
+    return last[0] if last else excluded[0]
+
+
+class SinceMixin(object):
+    """Adds incremental listing to a viewset: when the `since`
+    query parameter is given, the list contains only objects modified
+    after that sequence, ids of objects deleted after it, and the
+    cursor to use as `since` in the next request. Use `since=-1` to
+    get everything along with the initial cursor. The cursor has the
+    same guarantee as in ChangesView.
+
+    The changes are returned in batches of at most `max_paginate_by`
+    (or SINCE_BATCH_SIZE) objects and deletions, oldest first. When
+    there are more, `more` is true in the response and the cursor is
+    the last sequence in the batch.
+
+    If `since` is older than the tombstone horizon (see Tombstone),
+    deletions after it are no longer known. Then everything is listed
+    as with `since=-1`, and `resync` is true in the response: the
+    client should drop the objects it has that are not listed."""
+
+    def list(self, request, *args, **kwargs):
+        since = request.QUERY_PARAMS.get('since')
+
+        if since is None:
+            return super(SinceMixin, self).list(request, *args, **kwargs)
+
+        try:
+            since = int(since)
+        except ValueError:
+            return Response({'error': 'Invalid since value'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        resync = since < Tombstone.horizon()
+
+        if resync:
+            since = -1
+
+        # See ChangesView.changes.
+        cursor = safe_sequence()
+        window = {'sequence__gt': since, 'sequence__lte': cursor}
+        objects = self.filter_queryset(self.get_queryset().filter(**window))
+        deleted = Tombstone.objects.filter(kind=self.model._meta.model_name,
+                                           **window)
+
+        limit = self.max_paginate_by or SINCE_BATCH_SIZE
+        ends = [end for end in (batch_end(objects, limit),
+                                batch_end(deleted, limit))
+                if end is not None and end < cursor]
+        more = bool(ends)
+
+        if more:
+            cursor = min(ends)
+
+        objects = objects.filter(sequence__lte=cursor).order_by('sequence',
+                                                                'id')
+        deleted = (deleted.filter(sequence__lte=cursor)
+                   .order_by('sequence').values_list('object_id', flat=True))
+
+        return Response({'cursor': cursor,
+                         'more': more,
+                         'resync': resync,
+                         'results': self.get_serializer(objects,
+                                                        many=True).data,
+                         'deleted': list(deleted)})
+
+
+class BaseViewSet(util.Logger, SinceMixin, viewsets.ModelViewSet):
     def handle_exception(self, exc):
         # Just ignore some exceptions which are communicating normal
         # cases up the chain.
@@ -24,14 +146,26 @@ class BaseViewSet(util.Logger, viewsets.ModelViewSet):
 
         return super(BaseViewSet, self).handle_exception(exc)
 
+    def get_serializer(self, instance=None, *args, **kwargs):
+        # Load embedded log entries for all listed objects at once.
+        if kwargs.get('many') and instance is not None:
+            instance = list(instance)
+            prefetch_recent_log_entries(instance,
+                                        log_entry_count(self.request))
+
+        return super(BaseViewSet, self).get_serializer(instance,
+                                                       *args, **kwargs)
+
 
 class DomainViewSet(BaseViewSet):
     model = Domain
+    queryset = Domain.objects.prefetch_related('accounts')
     serializer_class = DomainSerializer
 
 
 class AccountViewSet(BaseViewSet):
     model = Account
+    queryset = Account.objects.prefetch_related('projects', 'instances')
     serializer_class = AccountSerializer
 
     @action()
@@ -65,14 +199,47 @@ class AccountViewSet(BaseViewSet):
 
 class ProjectViewSet(BaseViewSet):
     model = Project
+    queryset = Project.objects.prefetch_related('elastic_ips')
     serializer_class = ProjectSerializer
 
+    def get_queryset(self):
+        queryset = super(ProjectViewSet, self).get_queryset()
+
+        # Instance categories of listed projects are computed from
+        # their accounts' instances, see Account.categorize. Single
+        # projects load only the instances in their regions.
+        if self.action == 'list' and categories_wanted(self.request):
+            queryset = queryset.prefetch_related('account__instances')
+
+        return queryset
+
+    def get_serializer(self, instance=None, *args, **kwargs):
+        # Categorize instances of all projects under an account at
+        # once. Not done when updating, as the filters may change, or
+        # when the categories are not wanted.
+        if (instance is not None and kwargs.get('data') is None and
+                categories_wanted(self.request)):
+            if kwargs.get('many'):
+                instance = list(instance)
+                prefetch_categories(instance)
+            else:
+                prefetch_categories([instance])
+
+        return super(ProjectViewSet, self).get_serializer(instance,
+                                                          *args, **kwargs)
+
     # TODO: extend @log_error mechanism either to
     # create/retrieve/update/partial_update/destroy/list methods, or
     # move the whole error logging out of here to somewhere
     # sensible. (OTOH, if we want to have errors linked to the correct
     # object, we need that information somwhere close by...)
 
+    @link()
+    def explain(self, request, pk):
+        """Profile of the project's filters against its current
+        instances, see Project.explain."""
+        return Response(self.get_object().explain())
+
     @action()
     @util.log_error(Project)
     def freeze(self, request, pk):
@@ -97,17 +264,16 @@ class ProjectViewSet(BaseViewSet):
                              'Project state is not valid for freezing'},
                             status=status.HTTP_409_CONFLICT)
 
-        # Update project state.
-        project.state = 'freezing'
-        project.save()
+        operation = start_operation(project, 'freezing')
 
-        # Do a forced refresh on the account just before freeze so we
-        # have as up-to-date information as possible. (Freeze operates
-        # based on our knowledge of the account.)
+        # Refresh states of the project's instances just before
+        # freeze so we have as up-to-date information as possible.
+        # (Freeze operates based on our knowledge of the account.) The
+        # full refresh is left to the regular schedule.
         dispatch(
-            (refresh_account.si(project.account.id, forced=True) |
-             freeze_project.si(project.id) |
-             refresh_account.si(project.account.id, forced=True)))
+            (refresh_project_states.si(project.id) |
+             freeze_project.si(project.id, operation=operation) |
+             refresh_project_states.si(project.id)))
 
         serializer = self.get_serializer(project)
         return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
@@ -128,20 +294,357 @@ class ProjectViewSet(BaseViewSet):
                              'Project state is not valid for thawing'},
                             status=status.HTTP_409_CONFLICT)
 
-        project.state = 'thawing'
-        project.save()
+        operation = start_operation(project, 'thawing')
 
-        # Again, do a forced refresh before starting the thaw
-        # operation.
+        # Again, refresh states before starting the thaw operation.
         dispatch(
-            (refresh_account.si(project.account.id, forced=True) |
-             thaw_project.si(project.id) |
-             refresh_account.si(project.account.id, forced=True)))
+            (refresh_project_states.si(project.id) |
+             thaw_project.si(project.id, operation=operation) |
+             refresh_project_states.si(project.id)))
 
         serializer = self.get_serializer(project)
         return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
 
 
-class InstanceViewSet(viewsets.ReadOnlyModelViewSet):
+class InstanceViewSet(SinceMixin, viewsets.ReadOnlyModelViewSet):
+    """Instances, optionally filtered by `account`, `region` and
+    `state` (comma-separated lists), by the instances picked by
+    `project`, and by a freezr filter expression in `filter`.
+
+    Giving `limit` or `cursor` switches to cursor-based pagination,
+    where the response contains `results` and `next`, the URL of the
+    next page (or null)."""
+
     model = Instance
+    queryset = Instance.objects.all()
     serializer_class = InstanceSerializer
+
+    # Default and maximum page size, and how many instances are
+    # evaluated at a time when looking for a page of instances
+    # matching `filter`.
+    page_size = 100
+    max_page_size = 1000
+    chunk_size = 500
+
+    def get_queryset(self):
+        params = self.request.QUERY_PARAMS
+        queryset = super(InstanceViewSet, self).get_queryset()
+
+        if 'account' in params:
+            try:
+                accounts = [int(account) for account in
+                            util.separator_split(params['account'], ",")]
+            except ValueError:
+                raise ParseError('Invalid account')
+
+            queryset = queryset.filter(account__in=accounts)
+
+        for param, lookup in (('region', 'region__in'),
+                              ('state', 'state__in')):
+            if param in params:
+                queryset = queryset.filter(
+                    **{lookup: util.separator_split(params[param], ",")})
+
+        project = self.get_project()
+
+        if project is not None:
+            # The pick filter itself is evaluated with `filter`, see
+            # get_filter.
+            queryset = queryset.filter(account=project.account_id,
+                                       region__in=project.regions)
+
+            if not project.pick_filter:
+                return queryset.none()
+
+        f = self.get_filter()
+
+        if f is not None:
+            queryset = narrow_instances(queryset, f)
+
+        return queryset
+
+    def get_project(self):
+        """Return the project given by `project`, or None."""
+        if 'project' not in self.request.QUERY_PARAMS:
+            return None
+
+        if not hasattr(self, '_project'):
+            try:
+                self._project = Project.objects.get(
+                    pk=int(self.request.QUERY_PARAMS['project']))
+            except (ValueError, Project.DoesNotExist):
+                raise ParseError('Invalid project')
+
+        return self._project
+
+    def get_filter(self):
+        """Return the filter given by `filter`, combined with the pick
+        filter of `project` if given, or None."""
+        text = self.request.QUERY_PARAMS.get('filter')
+        project = self.get_project()
+        f = None
+
+        if text:
+            try:
+                f = Filter.parse(text)
+            except ParseException as ex:
+                raise ParseError('Invalid filter: %s' % (ex,))
+
+        if project is not None and project.pick_filter:
+            picked = project.instance_filter(project.pick_filter)
+            f = picked if f is None else picked.AND(f)
+
+        return f.optimize() if f is not None else None
+
+    def filter_queryset(self, queryset):
+        f = self.get_filter()
+
+        if f is None:
+            return queryset
+
+        return Inventory.for_instances(queryset).filter(f)
+
+    def list(self, request, *args, **kwargs):
+        params = request.QUERY_PARAMS
+
+        if 'since' in params or not ('limit' in params or
+                                     'cursor' in params):
+            return super(InstanceViewSet, self).list(request,
+                                                     *args, **kwargs)
+
+        try:
+            limit = min(int(params.get('limit', self.page_size)),
+                        self.max_page_size)
+            last = int(params.get('cursor', 0))
+        except ValueError:
+            raise ParseError('Invalid limit or cursor')
+
+        queryset = self.get_queryset().order_by('id')
+        results = []
+
+        # Look for one more than the limit to know whether there is
+        # a next page at all.
+        while len(results) <= limit:
+            chunk = list(queryset.filter(id__gt=last)[:self.chunk_size])
+
+            if not chunk:
+                break
+
+            results.extend(self.filter_queryset(chunk))
+            last = chunk[-1].id
+
+        next = None
+
+        if len(results) > limit:
+            results = results[:limit]
+            next = replace_query_param(request.build_absolute_uri(),
+                                       'cursor', results[-1].id)
+
+        return Response({'next': next,
+                         'results': self.get_serializer(results,
+                                                        many=True).data})
+
+
+class LogEntryViewSet(SinceMixin, viewsets.ReadOnlyModelViewSet):
+    """Paginated log entries, newest first. Can be filtered by the
+    owning object (`domain`, `account` or `project` id), by `type`
+    (comma-separated list) and by time (`after` and `before`, ISO 8601
+    timestamps)."""
+
+    model = LogEntry
+    serializer_class = StandaloneLogEntrySerializer
+    paginate_by = 50
+    paginate_by_param = 'page_size'
+    max_paginate_by = 1000
+
+    def get_queryset(self):
+        params = self.request.QUERY_PARAMS
+        queryset = (LogEntry.objects
+                    .select_related('user', 'stored_details')
+                    .order_by('-time', '-id'))
+
+        try:
+            for field in ('domain', 'account', 'project'):
+                if field in params:
+                    queryset = queryset.filter(
+                        **{field: int(params[field])})
+        except ValueError:
+            raise ParseError('Invalid object id')
+
+        if 'type' in params:
+            queryset = queryset.filter(
+                type__in=util.separator_split(params['type'], ","))
+
+        for param, lookup in (('after', 'time__gte'),
+                              ('before', 'time__lt')):
+            if param in params:
+                value = parse_datetime(params[param])
+
+                if value is None:
+                    raise ParseError('Invalid %s timestamp' % (param,))
+
+                if timezone.is_naive(value):
+                    value = timezone.make_aware(value, timezone.utc)
+
+                queryset = queryset.filter(**{lookup: value})
+
+        return queryset
+
+
+class BulkOperationView(util.Logger, APIView):
+    """Freeze or thaw many projects at once. The projects are given
+    either as a list of ids in `projects`, or as all the projects of
+    an `account` or a `domain`.
+
+    The projects of each account are frozen or thawed together by one
+    task, which refreshes the account only once and changes the
+    instances of all the projects with as few EC2 calls as possible.
+    The response lists the ids of the projects in `projects`, and
+    those that could not be frozen or thawed in `skipped` along with
+    the reason."""
+
+    operations = {
+        'freeze': ('freezing', ('running', 'freezing'), freeze_projects),
+        'thaw': ('thawing', ('frozen', 'thawing'), thaw_projects),
+        }
+
+    def post(self, request, operation):
+        state, valid_states, task = self.operations[operation]
+        projects = Project.objects.select_related('account')
+
+        try:
+            if 'projects' in request.DATA:
+                projects = projects.filter(
+                    id__in=[int(id) for id in request.DATA['projects']])
+            elif 'account' in request.DATA:
+                projects = projects.filter(
+                    account=int(request.DATA['account']))
+            elif 'domain' in request.DATA:
+                projects = projects.filter(
+                    account__domain=int(request.DATA['domain']))
+            else:
+                return Response({'error': 'No projects given'},
+                                status=status.HTTP_400_BAD_REQUEST)
+        except (TypeError, ValueError):
+            return Response({'error': 'Invalid project selection'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        started = []
+        skipped = {}
+
+        for project in projects.order_by('id'):
+            if not project.account.active:
+                skipped[project.id] = 'Account is inactive'
+            elif project.state not in valid_states:
+                skipped[project.id] = ('Project state is not valid for %s' %
+                                       (state,))
+            else:
+                started.append(project)
+
+        # Plan the projects of each account together.
+        prefetch_categories(started)
+        accounts = {}
+
+        for project in started:
+            accounts.setdefault(project.account_id, []).append(
+                (project.id, start_operation(project, state)))
+
+        for account_id, operations in accounts.items():
+            dispatch(task.si(account_id, operations))
+
+        return Response({'projects': [project.id for project in started],
+                         'skipped': skipped},
+                        status=status.HTTP_202_ACCEPTED)
+
+
+class ChangesView(util.Logger, APIView):
+    """Long-poll change feed for projects, instances and log entries.
+
+    A request without `cursor` returns immediately with the current
+    cursor. A request with `cursor` waits up to `timeout` seconds for
+    anything to change after that cursor, and then returns the changed
+    projects and instances, new log entries, ids of deleted objects
+    and a new cursor to use in the next request.
+
+    The cursor is a safe watermark (see safe_sequence): every change
+    at or below it has been committed, so a client following the
+    cursors sees every change, even when transactions commit in a
+    different order than they allocated their sequence values.
+
+    While waiting only the latest sequence value is polled, so idle
+    clients cost one trivial query per poll interval.
+
+    If the cursor is older than the tombstone horizon (see Tombstone),
+    deletions after it are no longer known. Then no changes are
+    returned, but `resync` is true in the response and the client
+    should reload everything (e.g. with `since=-1` on the lists)
+    before following the new cursor."""
+
+    def get(self, request):
+        cursor = request.QUERY_PARAMS.get('cursor')
+
+        if cursor is None:
+            return Response(self.changes(None))
+
+        try:
+            cursor = int(cursor)
+            timeout = float(request.QUERY_PARAMS.get('timeout',
+                                                     CHANGES_TIMEOUT))
+        except ValueError:
+            return Response({'error': 'Invalid cursor or timeout value'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        deadline = time.time() + max(0, min(timeout, CHANGES_TIMEOUT_MAX))
+
+        while safe_sequence() <= cursor and time.time() < deadline:
+            time.sleep(CHANGES_POLL_INTERVAL)
+
+        return Response(self.changes(cursor))
+
+    def changes(self, cursor):
+        # Only changes up to the new cursor are returned: changes
+        # after it may still be followed by changes with lower
+        # sequence values from transactions that are still open (see
+        # safe_sequence). They are returned in a later request
+        # instead.
+        result = {'cursor': safe_sequence(),
+                  'projects': [],
+                  'instances': [],
+                  'log_entries': [],
+                  'deleted': {'project': [], 'instance': []},
+                  'resync': False}
+
+        if cursor is None or result['cursor'] <= cursor:
+            return result
+
+        if cursor < Tombstone.horizon():
+            result['resync'] = True
+            return result
+
+        context = {'request': self.request}
+
+        window = {'sequence__gt': cursor, 'sequence__lte': result['cursor']}
+
+        projects = list(ProjectViewSet.queryset
+                        .prefetch_related('account__instances')
+                        .filter(**window))
+        prefetch_recent_log_entries(projects, log_entry_count(self.request))
+        prefetch_categories(projects)
+        result['projects'] = ProjectSerializer(
+            projects, many=True, context=context).data
+
+        result['instances'] = InstanceSerializer(
+            InstanceViewSet.queryset.filter(**window),
+            many=True, context=context).data
+
+        result['log_entries'] = StandaloneLogEntrySerializer(
+            LogEntry.objects.filter(**window)
+            .select_related('user', 'stored_details')
+            .order_by('sequence', 'id'),
+            many=True, context=context).data
+
+        for tombstone in Tombstone.objects.filter(**window):
+            result['deleted'].setdefault(tombstone.kind, []).append(
+                tombstone.object_id)
+
+        return result
@@ -33,6 +33,10 @@ CELERYBEAT_SCHEDULE = {
     'reissue-operations': {
         'task': 'freezr.backend.tasks.reissue_operations',
         'schedule': timedelta(minutes=10),
+        },
+    'expire-log-entries': {
+        'task': 'freezr.backend.tasks.expire_log_entries',
+        'schedule': timedelta(hours=1),
         }
 }
 
@@ -51,4 +55,54 @@ STATIC_URL = '/static/'
 
 FREEZR_CLOUD_BACKEND = 'freezr.backend.aws.AwsInterface'
 
+# Log entry retention, see freezr.core.retention. Ages after which log
+# entries of given types are rolled up into daily summaries, and
+# deleted. Archive directory for rolled up and deleted entries (None
+# to not archive).
+FREEZR_LOG_ROLLUP = {
+    'verbose': timedelta(days=1),
+    }
+FREEZR_LOG_RETENTION = {
+    'verbose': timedelta(days=7),
+    }
+FREEZR_LOG_ARCHIVE_DIR = None
+
+# Tombstones of deleted objects older than this are deleted. Change
+# feed clients with older cursors have to start over with a full
+# listing. See freezr.core.retention.
+FREEZR_TOMBSTONE_RETENTION = timedelta(days=7)
+
+# EC2 API call rate limits per access key, region and action, in calls
+# per second, see freezr.backend.ratelimit.
+FREEZR_RATE_LIMIT = 5
+FREEZR_RATE_LIMITS = {
+    'DescribeInstances': 10,
+    }
+
+# Socket timeout (for both connecting and reading) of EC2 calls in
+# seconds, and how many times boto retries calls failing on network
+# errors. See also freezr.backend.breaker.
+FREEZR_EC2_TIMEOUT = 10
+FREEZR_EC2_RETRIES = 1
+
+# Queue of EC2 instance state-change events, see
+# freezr.backend.events. E.g. 'freezr.backend.events.SqsQueue' with
+# options {'name': 'freezr-events', 'region': 'us-east-1'}.
+FREEZR_EVENT_QUEUE = None
+FREEZR_EVENT_QUEUE_OPTIONS = {}
+
+# Cache holding the rate limiter and circuit breaker state. It must
+# be shared by all workers, so by default it is a database cache. Its
+# table is created by the upgrade command (or createcachetable).
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    'freezr': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'freezr_cache',
+        },
+    }
+FREEZR_BACKEND_CACHE = 'freezr'
+
 #import freezr.celery
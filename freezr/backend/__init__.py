@@ -1,22 +1,31 @@
 from django.conf import settings
+from contextlib import contextmanager
 from importlib import import_module
 import logging
+import os
+import threading
+import time
 
 log = logging.getLogger('freezr.backend')
 
 
-def get_backend_class():
-    setting = settings.FREEZR_CLOUD_BACKEND
-
-    log.debug("FREEZR_CLOUD_BACKEND = %r", setting)
-
+def load_class(setting):
+    """Return the class given by `setting`, either a class or its
+    dotted path."""
     if not isinstance(setting, basestring):
-        log.debug("backend = %r", setting)
         return setting
 
     (module_name, cls_name) = setting.rsplit(".", 1)
     module = import_module(module_name)
-    cls = getattr(module, cls_name)
+    return getattr(module, cls_name)
+
+
+def get_backend_class():
+    setting = settings.FREEZR_CLOUD_BACKEND
+
+    log.debug("FREEZR_CLOUD_BACKEND = %r", setting)
+
+    cls = load_class(setting)
 
     log.debug("backend %r = %r",
               settings.FREEZR_CLOUD_BACKEND, cls)
@@ -30,3 +39,127 @@ def get_backend(access_key=None, secret_key=None):
     ret = cls(access_key=access_key, secret_key=secret_key)
     log.debug("backend for %r = %r", access_key, ret)
     return ret
+
+
+# Pooled backends unused for longer than this many seconds are closed
+# instead of being reused.
+POOL_TTL = 300
+
+# Pool statistics are logged every this many acquisitions.
+POOL_REPORT_INTERVAL = 100
+
+
+class BackendPool(object):
+    """Per-process pool of backend objects keyed by backend class and
+    access key. Backends (and thus their open connections, which
+    `AwsInterface` keeps per region) are reused across tasks instead
+    of reconnecting for every task.
+
+    A backend is used by only one thread at a time: `acquire` hands
+    out an idle pooled backend (or a new one) and `release` returns
+    it to the pool. Only backend classes with a true `poolable`
+    attribute are pooled, others are created anew every time.
+
+    Pooled backends are discarded when they have been idle for longer
+    than `ttl` seconds, and when the secret key of the access key has
+    changed. Statistics of the pool (see `stats`) are logged every
+    `POOL_REPORT_INTERVAL` acquisitions."""
+
+    def __init__(self, ttl=POOL_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.pid = os.getpid()
+            self.idle = {}
+            self.counts = {'created': 0, 'reused': 0, 'expired': 0,
+                           'invalidated': 0, 'discarded': 0}
+
+    def acquire(self, access_key=None, secret_key=None):
+        cls = get_backend_class()
+
+        if not getattr(cls, 'poolable', False):
+            return cls(access_key=access_key, secret_key=secret_key)
+
+        key = (cls, access_key)
+        backend = None
+
+        with self.lock:
+            # Connections are not to be shared with the parent
+            # process, start afresh in forked worker processes.
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.idle = {}
+
+            idle = self.idle.get(key, [])
+            limit = time.time() - self.ttl
+
+            while idle and backend is None:
+                backend, released = idle.pop()
+
+                if backend.secret_key != secret_key:
+                    self.counts['invalidated'] += 1
+                    backend = None
+                elif released < limit:
+                    self.counts['expired'] += 1
+                    backend = None
+
+            self.counts['reused' if backend else 'created'] += 1
+            report = (self.counts['reused'] + self.counts['created']) % \
+                POOL_REPORT_INTERVAL == 0
+
+        if report:
+            log.info("backend pool: %r", self.stats())
+
+        if backend is None:
+            backend = cls(access_key=access_key, secret_key=secret_key)
+
+        return backend
+
+    def release(self, backend, discard=False):
+        """Return `backend` to the pool, or close it if `discard` is
+        true (e.g. after an error that may have left its connections
+        in an unknown state)."""
+        if not getattr(backend, 'poolable', False):
+            return
+
+        if discard:
+            backend.disconnect()
+
+            with self.lock:
+                self.counts['discarded'] += 1
+
+            return
+
+        with self.lock:
+            self.idle.setdefault((type(backend), backend.access_key),
+                                 []).append((backend, time.time()))
+
+    def stats(self):
+        """Return counts of created, reused, expired, invalidated
+        (secret key changed) and discarded backends, and the number of
+        currently idle ones."""
+        with self.lock:
+            stats = dict(self.counts)
+            stats['idle'] = sum(len(idle) for idle in self.idle.values())
+
+        return stats
+
+    @contextmanager
+    def backend(self, access_key=None, secret_key=None):
+        """Context manager acquiring a backend for the duration of the
+        block."""
+        backend = self.acquire(access_key, secret_key)
+
+        try:
+            yield backend
+        except:
+            self.release(backend, discard=True)
+            raise
+
+        self.release(backend)
+
+
+pool = BackendPool()
@@ -1,9 +1,30 @@
 from __future__ import absolute_import
 import boto.ec2
+import boto.exception
+from boto.ec2.instancestatus import InstanceStatusSet
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
+from django.utils import timezone
 import freezr.common.util as util
+from .breaker import breaker, RegionUnavailable
+from .ratelimit import limiter
+import httplib
+import socket
 
 TERMINAL_STATES = ('shutting-down', 'terminated')
+
+# Number of instance ids to describe the status of at a time.
+STATUS_BATCH_SIZE = 100
+
+# Number of instances to stop, start or terminate in one call.
+CHANGE_BATCH_SIZE = 100
+
+# API action and boto method for each kind of change_instances.
+CHANGE_ACTIONS = {
+    'stop': ('StopInstances', 'stop_instances'),
+    'start': ('StartInstances', 'start_instances'),
+    'terminate': ('TerminateInstances', 'terminate_instances'),
+    }
 DRY_RUN = False  # really only for debugging
 
 
@@ -14,7 +35,12 @@ class AwsInterface(util.Logger):
     allowed to modify and update accounts, projects, instances
     etc. This is a separate class to make testing easier, and also to
     move a lot of aws-specific code out of the model classes
-    themselves (lest they bloat)."""
+    themselves (lest they bloat).
+
+    Instances keep their EC2 connections open, and are reused between
+    tasks via `freezr.backend.pool`."""
+
+    poolable = True
 
     def __init__(self, access_key=None, secret_key=None):
         super(AwsInterface, self).__init__()
@@ -29,27 +55,59 @@ class AwsInterface(util.Logger):
         if region in self.conns:
             return self.conns[region]
 
-        self.conns[region] = boto.ec2.connect_to_region(
+        conn = self.conns[region] = boto.ec2.connect_to_region(
             region,
             aws_access_key_id=self.access_key,
             aws_secret_access_key=self.secret_key)
 
+        # httplib uses the same timeout for connecting and reading.
+        if conn:
+            conn.http_connection_kwargs['timeout'] = \
+                settings.FREEZR_EC2_TIMEOUT
+            conn.num_retries = settings.FREEZR_EC2_RETRIES
+
         self.log.debug("Connected to region %s with key %s: %r",
                        region, self.access_key, self.conns[region])
 
         return self.conns[region]
 
+    def call(self, region, action, method, *args, **kwargs):
+        """Call `method` of the EC2 connection to `region` with given
+        arguments, rate limited as API `action` (see
+        freezr.backend.ratelimit).
+
+        Raises `RegionUnavailable` if the call fails due to a network
+        or server error, or if the region has had too many such
+        failures recently (see freezr.backend.breaker)."""
+        breaker.check(region)
+        conn = self.connect_ec2(region)
+
+        try:
+            result = limiter.call(self.access_key, region, action,
+                                  getattr(conn, method), *args, **kwargs)
+        except (socket.error, httplib.HTTPException) as ex:
+            breaker.failure(region)
+            raise RegionUnavailable(region, ex)
+        except boto.exception.BotoServerError as ex:
+            if ex.status < 500:
+                raise
+
+            breaker.failure(region)
+            raise RegionUnavailable(region, ex)
+
+        breaker.success(region)
+        return result
+
     def refresh_instance(self, instance):
         """Refreshes information on the given instance."""
-        conn = self.connect_ec2(instance.region)
-
-        for instance_data in conn.get_only_instances(instance_ids=[
-                instance.instance_id]):
+        for instance_data in self.call(
+                instance.region, 'DescribeInstances', 'get_only_instances',
+                instance_ids=[instance.instance_id]):
 
             assert instance_data.id == instance.instance_id
             if instance_data.state not in TERMINAL_STATES:
-                self.update_instance_record(instance, instance_data)
-                instance.save()
+                if self.update_instance_record(instance, instance_data):
+                    instance.save()
                 return
 
         # Fall through here if instance doesn't exist, or it is or is
@@ -59,18 +117,118 @@ class AwsInterface(util.Logger):
         instance.delete()
 
     def update_instance_record(self, record, instance):
+        """Update `record` from the AWS `instance` data. Returns True
+        if any of the persisted fields changed, e.g. the record needs
+        to be saved."""
+        before = (record.state, record.vpc_id, record.store, record.type)
+
         record.state = instance.state
         record.vpc_id = instance.vpc_id
         record.store = instance.root_device_type
         record.type = instance.instance_type
         record.aws_instance = instance  # this is not persisted
 
+        if before[0] != record.state:
+            record.state_time = timezone.now()
+
+        return before != (record.state, record.vpc_id,
+                          record.store, record.type)
+
         # self.log.debug("instance data: %r", instance)
         # self.log.debug("instance data dir: %r", dir(instance))
         # for n in dir(instance):
         #     if n[0] != '_':
         #         self.log.debug("instance: %s = %r", n, getattr(instance, n))
 
+    def instance_states(self, region, instance_ids=None):
+        """Return a dict from instance ids to their states in
+        `region`, either of the given instances (if they all exist) or
+        of all instances in the region. Uses DescribeInstanceStatus,
+        which is much cheaper than describing the whole instances."""
+        conn = self.connect_ec2(region)
+        states = {}
+
+        if instance_ids is None:
+            batches = [None]
+        else:
+            batches = [instance_ids[i:i + STATUS_BATCH_SIZE]
+                       for i in range(0, len(instance_ids),
+                                      STATUS_BATCH_SIZE)]
+
+        for batch in batches:
+            token = None
+
+            while True:
+                # boto's get_all_instance_status does not support
+                # IncludeAllInstances, which we need to see other than
+                # running instances.
+                params = {'IncludeAllInstances': 'true'}
+
+                if batch:
+                    conn.build_list_params(params, batch, 'InstanceId')
+                else:
+                    params['MaxResults'] = 1000
+
+                if token:
+                    params['NextToken'] = token
+
+                try:
+                    result = self.call(region, 'DescribeInstanceStatus',
+                                       'get_object', 'DescribeInstanceStatus',
+                                       params, InstanceStatusSet, verb='POST')
+                except boto.exception.EC2ResponseError as ex:
+                    # Some of the instances are gone, so look at all
+                    # of them instead.
+                    if batch and ex.error_code == 'InvalidInstanceID.NotFound':
+                        return self.instance_states(region)
+
+                    raise
+
+                for status in result:
+                    states[status.id] = status.state_name
+
+                token = result.next_token
+
+                if not token:
+                    break
+
+        return states
+
+    def refresh_states(self, account, region, instances=None):
+        """Update only the states of known `instances` (by default all
+        instances of `account` in `region`), deleting those that have
+        gone away. Tags and other attributes are not updated, and new
+        instances are not found -- see `refresh_region` for that.
+        Returns (total, changed, deleted) counts."""
+        if instances is None:
+            instances = list(account.instances.filter(region=region))
+
+        if not instances:
+            return (0, 0, 0)
+
+        states = self.instance_states(
+            region, [instance.instance_id for instance in instances])
+        changed, deleted = 0, 0
+
+        for instance in instances:
+            state = states.get(instance.instance_id)
+
+            if state is None or state in TERMINAL_STATES:
+                self.log.debug('Instance %s gone away, removing', instance)
+                instance.delete()
+                deleted += 1
+            elif state != instance.state:
+                instance.state = state
+                instance.state_time = timezone.now()
+                instance.save(update_fields=['state', 'state_time'])
+                changed += 1
+
+        self.log.debug("Updated states of account %s in region %s: "
+                       "#total=%d #changed=%d #deleted=%d",
+                       account, region, len(instances), changed, deleted)
+
+        return (len(instances) - deleted, changed, deleted)
+
     def refresh_region(self, account, region):
         """Refreshes given `account` information on `region`. Returns
         a three-value tuple (total, added, deleted) where `total` is
@@ -95,7 +253,8 @@ class AwsInterface(util.Logger):
         # Set of instances added
         added_instances = set()
 
-        for instance in conn.get_only_instances():
+        for instance in self.call(region, 'DescribeInstances',
+                                  'get_only_instances'):
             self.log.debug("Got instance id %s: region=%s state=%s "
                            "vpc_id=%s store=%s",
                            instance.id, region,
@@ -127,31 +286,24 @@ class AwsInterface(util.Logger):
             # been dead for 50 hours and new instances with the same
             # id could have gotten around (in the same account and
             # region).
-            self.update_instance_record(record, instance)
+            #
+            # Only changed records are written, as every save bumps
+            # the record's modification sequence (and thus pushes it
+            # to all clients following the change feed).
+            changed = self.update_instance_record(record, instance)
 
             seen_instances.add(record)
-            record.save()
 
-            tags = set(record.tags.all())
-            seen_tags = set()
-
-            for key, value in instance.tags.iteritems():
-                try:
-                    tag = record.tags.get(key=key)
-                except ObjectDoesNotExist:
-                    tag = record.new_tag(key=key)
+            if changed or record.pk is None:
+                record.save()
+                changed = False
 
-                if tag.value != value:
-                    tag.value = value
+            # Tag changes are changes of the instance, too.
+            if record.set_tags(instance.tags):
+                record.save()
 
-                seen_tags.add(tag)
-                tag.save()
-
-            # See which tags have been removed
-            for missing_tag in (tags - seen_tags):
-                missing_tag.delete()
-
-            self.log.debug("Instance %s tags: %r", instance.id, seen_tags)
+            self.log.debug("Instance %s tags: %r", instance.id,
+                           instance.tags)
 
             # TODO: zone, ami, sgs (sg[foo] for test?), product codes,
             # monitoring state, subnet id, arch, virt, hypervisor,
@@ -180,6 +332,64 @@ class AwsInterface(util.Logger):
                 len(added_instances),
                 len(disappeared_instances))
 
+    def change_instances(self, action, instances, on_error=None):
+        """Stop, start or terminate (`action` is "stop", "start" or
+        "terminate") the given instances, with one call per region for
+        up to CHANGE_BATCH_SIZE instances.
+
+        Errors are raised, unless `on_error` is given: then a call
+        failing on an error response (e.g. due to one protected or
+        already terminated instance) is retried for each instance
+        separately, and `on_error(instance, exception)` is called for
+        each instance that could not be changed, after which the
+        remaining batches are still changed."""
+        api_action, method = CHANGE_ACTIONS[action]
+        by_region = {}
+
+        for instance in instances:
+            by_region.setdefault(instance.region, []).append(instance)
+
+        def change(region, batch):
+            instance_ids = [instance.instance_id for instance in batch]
+
+            if DRY_RUN:
+                return
+
+            result = self.call(region, api_action, method,
+                               instance_ids=instance_ids)
+
+            self.log.debug("change_instances: %s %s => %s",
+                           action, instance_ids, result)
+
+        for region, region_instances in sorted(by_region.items()):
+            for start in range(0, len(region_instances), CHANGE_BATCH_SIZE):
+                batch = region_instances[start:start + CHANGE_BATCH_SIZE]
+
+                try:
+                    change(region, batch)
+                except (RegionUnavailable,
+                        boto.exception.BotoServerError) as ex:
+                    if on_error is None:
+                        raise
+
+                    if (isinstance(ex, RegionUnavailable) or
+                            len(batch) == 1):
+                        for instance in batch:
+                            on_error(instance, ex)
+
+                        continue
+
+                    self.log.warning("change_instances: %s of %d instances "
+                                     "in %s failed, retrying one by one: %s",
+                                     action, len(batch), region, ex)
+
+                    for instance in batch:
+                        try:
+                            change(region, [instance])
+                        except (RegionUnavailable,
+                                boto.exception.BotoServerError) as ex:
+                            on_error(instance, ex)
+
     def terminate_instance(self, instance):
         """Terminates the given instance, updating its status as
         needed.
@@ -188,42 +398,88 @@ class AwsInterface(util.Logger):
         the instance metadata. We'll leave it lingering so humans can
         also see that result from AWS console, if needed."""
 
-        if DRY_RUN:
-            return
-
-        conn = self.connect_ec2(instance.region)
-        result = conn.terminate_instances(instance_ids=[instance.instance_id])
-
-        self.log.debug("terminate_instance: %s => %s", instance, result)
+        self.change_instances('terminate', [instance])
 
     def freeze_instance(self, instance):
         """Freeze the given instance."""
         self.log.debug("freeze_instance: %s, state %s",
                        instance, instance.state)
 
-        if DRY_RUN:
-            return
-
         if instance.state != 'running':
             # TODO: add suitable exception
             return
 
-        conn = self.connect_ec2(instance.region)
-        result = conn.stop_instances(instance_ids=[instance.instance_id])
-
-        self.log.debug("freeze_instance: %s => %s", instance, result)
+        self.change_instances('stop', [instance])
 
     def thaw_instance(self, instance):
         """Thaw the given instance."""
         self.log.debug("thaw_instance: %s, state %s",
                        instance, instance.state)
-        if DRY_RUN:
-            return
 
         if instance.state != 'stopped':
             return
 
-        conn = self.connect_ec2(instance.region)
-        result = conn.start_instances(instance_ids=[instance.instance_id])
+        self.change_instances('start', [instance])
+
+
+class InstanceBatch(object):
+    """Stand-in for `AwsInterface` in Project.freeze and thaw that
+    collects the instances to terminate, stop and start, changing
+    them on `flush` with as few calls as possible (see
+    AwsInterface.change_instances). Used to freeze or thaw many
+    projects of an account at once: set `project` to the project
+    whose instances are being added, so that failures can be traced
+    back to it."""
+
+    def __init__(self, aws):
+        self.aws = aws
+        self.project = None
+        self.pending = {'terminate': [], 'stop': [], 'start': []}
+
+    def terminate_instance(self, instance):
+        self.pending['terminate'].append((instance, self.project))
+
+    def freeze_instance(self, instance):
+        if instance.state == 'running':
+            self.pending['stop'].append((instance, self.project))
+
+    def thaw_instance(self, instance):
+        if instance.state == 'stopped':
+            self.pending['start'].append((instance, self.project))
+
+    def flush(self, renew=None):
+        """Make the collected changes, terminations first. A failure
+        to change some instances does not stop the others from being
+        changed. Returns a list of (project, action, instance,
+        exception) tuples for the instances that could not be
+        changed.
+
+        If given, `renew` is called before each kind of change and
+        returns the projects whose instances may still be changed,
+        e.g. those whose operation lease could be renewed."""
+        failures = []
+
+        for action in ('terminate', 'stop', 'start'):
+            pending, self.pending[action] = self.pending[action], []
+
+            if pending and renew is not None:
+                active = set(renew())
+                pending = [(instance, project)
+                           for instance, project in pending
+                           if project in active]
+
+            if not pending:
+                continue
+
+            projects = {id(instance): project
+                        for instance, project in pending}
+
+            def failed(instance, ex):
+                failures.append((projects[id(instance)], action,
+                                 instance, ex))
+
+            self.aws.change_instances(
+                action, [instance for instance, _ in pending],
+                on_error=failed)
 
-        self.log.debug("thaw_instance: %s => %s", instance, result)
+        return failures
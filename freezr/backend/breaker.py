@@ -0,0 +1,78 @@
+"""Per-region circuit breaker for EC2 calls.
+
+A region that is unreachable or very slow would otherwise stall every
+call to it for the full socket timeout. After `THRESHOLD` failed calls
+to a region within `WINDOW` seconds the region is considered
+unavailable for `COOL_DOWN` seconds, during which calls to it fail
+immediately with `RegionUnavailable`. Any successful call resets the
+failure count.
+
+The state is kept in the Django cache given by `FREEZR_BACKEND_CACHE`
+(see freezr.backend.ratelimit.backend_cache)."""
+
+from __future__ import absolute_import
+from .ratelimit import backend_cache
+import logging
+
+log = logging.getLogger('freezr.backend.breaker')
+
+THRESHOLD = 3
+WINDOW = 300
+COOL_DOWN = 300
+
+
+class RegionUnavailable(Exception):
+    """Raised for calls to a region that has failed recently, or whose
+    call failed due to a network error."""
+
+    def __init__(self, region, reason=None):
+        super(RegionUnavailable, self).__init__(
+            'Region {0} is unavailable{1}'.format(
+                region, ': {0}'.format(reason) if reason else ''))
+        self.region = region
+        self.reason = reason
+
+
+class CircuitBreaker(object):
+    def cache(self):
+        return backend_cache()
+
+    def key(self, region, name):
+        return 'freezr.breaker:{0}:{1}'.format(region, name)
+
+    def is_open(self, region):
+        return bool(self.cache().get(self.key(region, 'open')))
+
+    def check(self, region):
+        """Raise `RegionUnavailable` if `region` is cooling down."""
+        if self.is_open(region):
+            raise RegionUnavailable(region, 'too many recent failures')
+
+    def success(self, region):
+        self.cache().delete(self.key(region, 'failures'))
+
+    def failure(self, region):
+        """Record a failure, opening the circuit of `region` if there
+        have been `THRESHOLD` failures."""
+        cache = self.cache()
+        key = self.key(region, 'failures')
+        cache.add(key, 0, WINDOW)
+
+        try:
+            failures = cache.incr(key)
+        except ValueError:
+            failures = 1
+            cache.set(key, failures, WINDOW)
+
+        if failures >= THRESHOLD:
+            log.warning('Region %s failed %d times, not using it for '
+                        '%d seconds', region, failures, COOL_DOWN)
+            cache.set(self.key(region, 'open'), True, COOL_DOWN)
+            cache.delete(key)
+
+    def reset(self, region):
+        self.cache().delete_many([self.key(region, 'open'),
+                                  self.key(region, 'failures')])
+
+
+breaker = CircuitBreaker()
@@ -0,0 +1,274 @@
+"""Instance state updates from EC2 state-change notifications.
+
+Instead of waiting for the next poll, instance states can be updated
+from "EC2 Instance State-change Notification" events, as sent by
+EventBridge (CloudWatch Events) to an SQS queue:
+
+    {"detail-type": "EC2 Instance State-change Notification",
+     "source": "aws.ec2", "region": "us-east-1",
+     "time": "2014-07-01T12:00:00Z",
+     "detail": {"instance-id": "i-12345678", "state": "stopped"}}
+
+The queue is given by `FREEZR_EVENT_QUEUE` (a class, or a dotted path
+to one) and `FREEZR_EVENT_QUEUE_OPTIONS` (keyword arguments for the
+class). Queues have `receive` and `delete` methods like `SqsQueue`.
+`FileQueue` and `MemoryQueue` are stand-ins for testing and
+development.
+
+Events are consumed by the `ingest_events` management command, which
+uses `ingest`."""
+
+from __future__ import absolute_import
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from freezr.core.models import (Instance, Project, INSTANCE_STATES,
+                                next_sequence)
+from . import load_class
+import boto.sqs
+import collections
+import json
+import logging
+import os
+
+log = logging.getLogger('freezr.backend.events')
+
+EVENT_DETAIL_TYPE = 'EC2 Instance State-change Notification'
+
+# Maximum number of messages to receive at a time (the SQS maximum).
+BATCH_SIZE = 10
+
+
+class SqsQueue(object):
+    """SQS queue `name` in `region`. Receiving uses long polling of up
+    to `wait` seconds."""
+
+    def __init__(self, name, region, access_key=None, secret_key=None,
+                 wait=20):
+        self.connection = boto.sqs.connect_to_region(
+            region, aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key)
+        self.queue = self.connection.get_queue(name)
+        self.wait = wait
+
+        if self.queue is None:
+            raise ValueError('No SQS queue {0} in {1}'.format(name, region))
+
+    def receive(self, count=BATCH_SIZE):
+        """Return a list of up to `count` (handle, body) pairs."""
+        return [(message, message.get_body())
+                for message in self.queue.get_messages(
+                    count, wait_time_seconds=self.wait)]
+
+    def delete(self, handles):
+        """Delete received messages (given by their handles)."""
+        if handles:
+            self.queue.delete_message_batch(handles)
+
+
+class MemoryQueue(object):
+    """In-process queue."""
+
+    def __init__(self):
+        self.messages = collections.deque()
+
+    def put(self, body):
+        self.messages.append(body)
+
+    def receive(self, count=BATCH_SIZE):
+        # Delivered messages are removed right away.
+        result = []
+
+        while self.messages and len(result) < count:
+            result.append((None, self.messages.popleft()))
+
+        return result
+
+    def delete(self, handles):
+        pass
+
+
+class FileQueue(object):
+    """Queue of messages appended one per line to file `path`. The
+    position up to which the messages have been processed is kept in
+    `path` + ".offset"."""
+
+    def __init__(self, path):
+        self.path = path
+        self.offset_path = path + '.offset'
+
+    def put(self, body):
+        with open(self.path, 'a') as f:
+            f.write(body.replace('\n', ' ') + '\n')
+
+    def offset(self):
+        try:
+            with open(self.offset_path) as f:
+                return int(f.read() or 0)
+        except IOError:
+            return 0
+
+    def receive(self, count=BATCH_SIZE):
+        result = []
+
+        if not os.path.exists(self.path):
+            return result
+
+        with open(self.path) as f:
+            f.seek(self.offset())
+
+            while len(result) < count:
+                line = f.readline()
+
+                if not line.endswith('\n'):
+                    break
+
+                result.append((f.tell(), line))
+
+        return result
+
+    def delete(self, handles):
+        if handles:
+            with open(self.offset_path, 'w') as f:
+                f.write(str(max(handles)))
+
+
+def get_queue():
+    """Return the queue configured in settings, or None."""
+    if not settings.FREEZR_EVENT_QUEUE:
+        return None
+
+    cls = load_class(settings.FREEZR_EVENT_QUEUE)
+    return cls(**settings.FREEZR_EVENT_QUEUE_OPTIONS)
+
+
+def parse(body):
+    """Return (region, instance id, state, time) of a state-change
+    event message `body`, or None if it is not one."""
+    try:
+        event = json.loads(body)
+        detail = event['detail']
+
+        if event.get('detail-type') != EVENT_DETAIL_TYPE:
+            return None
+
+        if detail['state'] not in INSTANCE_STATES:
+            return None
+
+        return (event['region'], detail['instance-id'], detail['state'],
+                event.get('time', ''))
+    except (ValueError, KeyError, TypeError):
+        log.warning('Invalid event message: %r', body)
+        return None
+
+
+def event_time(time):
+    """Return the event `time` as an aware datetime, or the current
+    time if it is missing or invalid."""
+    try:
+        value = parse_datetime(time)
+    except ValueError:
+        value = None
+
+    if value is None:
+        return timezone.now()
+
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.utc)
+
+    return value
+
+
+def set_states(state, times):
+    """Set the state of instances to `state` with one UPDATE, and
+    their state times from `times`, a list of (id, time) pairs."""
+    table = Instance._meta.db_table
+    params = [state, next_sequence()]
+
+    for id, time in times:
+        params.extend([id, connection.ops.value_to_db_datetime(time)])
+
+    params.extend(id for id, time in times)
+    connection.cursor().execute(
+        "UPDATE {0} SET state = %s, sequence = %s, "
+        "state_time = CASE id {1} END WHERE id IN ({2})".format(
+            table, ' '.join(['WHEN %s THEN %s'] * len(times)),
+            ', '.join(['%s'] * len(times))),
+        params)
+
+
+@transaction.atomic
+def update_states(events):
+    """Update instance states from parsed `events` and refresh the
+    projects in transitioning states of the affected accounts. Only
+    the latest event of each instance is used, and only if it is newer
+    than the latest state known for the instance (see
+    Instance.state_time): events may be delivered late, more than
+    once and out of order. Returns the number of instances updated."""
+    latest = {}
+
+    for region, instance_id, state, time in events:
+        key = (region, instance_id)
+        time = event_time(time)
+
+        if key not in latest or latest[key][1] <= time:
+            latest[key] = (state, time)
+
+    by_state = collections.defaultdict(dict)
+
+    for (region, instance_id), (state, time) in latest.items():
+        by_state[state, region][instance_id] = time
+
+    updated = 0
+    accounts = set()
+
+    for (state, region), times in by_state.items():
+        candidates = (Instance.objects
+                      .filter(region=region, instance_id__in=times.keys())
+                      .exclude(state=state)
+                      .values_list('id', 'account', 'instance_id',
+                                   'state_time'))
+        changed = [(id, account, times[instance_id])
+                   for id, account, instance_id, state_time in candidates
+                   if state_time is None or state_time < times[instance_id]]
+
+        if not changed:
+            continue
+
+        set_states(state, [(id, time) for id, account, time in changed])
+        updated += len(changed)
+        accounts.update(account for id, account, time in changed)
+
+    if not accounts:
+        return updated
+
+    # Bulk update bypasses Instance.touch_dependents, but that does
+    # not matter as state changes do not change projects.
+    for project in Project.objects.filter(
+            account__in=accounts, state_actual__in=('freezing', 'thawing')):
+        project.refresh()
+
+    return updated
+
+
+def ingest(queue, count=BATCH_SIZE):
+    """Receive up to `count` messages from `queue` and update
+    instance states from them. The messages are deleted from the queue
+    after the states have been updated. Returns the number of messages
+    received."""
+    messages = queue.receive(count)
+
+    if not messages:
+        return 0
+
+    events = [event for event in (parse(body) for handle, body in messages)
+              if event is not None]
+
+    updated = update_states(events)
+    queue.delete([handle for handle, body in messages])
+
+    log.debug('Received %d messages, %d events, updated %d instances',
+              len(messages), len(events), updated)
+
+    return len(messages)
@@ -0,0 +1,161 @@
+"""Client-side rate limiting of EC2 API calls.
+
+EC2 throttles API calls per account and region, failing calls with
+`RequestLimitExceeded` when too many are made. When lots of tasks run
+against the same account at once (like refreshes of all the instances
+of a project being frozen) that is easy to hit, so calls are limited
+on the client side too:
+
+- Calls are counted per (access key, region, API action) in one
+  second windows, `FREEZR_RATE_LIMIT` calls per second by default
+  (`FREEZR_RATE_LIMITS` gives limits for specific actions). Calls over
+  the limit wait for the next window.
+- Calls that are throttled anyway are retried with exponential
+  backoff.
+
+The counters are kept in the Django cache given by
+`FREEZR_BACKEND_CACHE` (see `backend_cache`), which must be shared by
+all workers for the limits to apply across them."""
+
+from __future__ import absolute_import
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.cache.backends.locmem import LocMemCache
+import threading
+import logging
+import random
+import time
+
+log = logging.getLogger('freezr.backend.ratelimit')
+
+# Error codes of throttled calls.
+THROTTLE_CODES = ('RequestLimitExceeded', 'Throttling')
+
+# Backoff of throttled calls: first delay and maximum delay in
+# seconds, and how many times to retry before giving up.
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 20
+BACKOFF_RETRIES = 6
+
+# Longest time in seconds to wait for the limiter before making the
+# call anyway (throttled calls are still backed off).
+MAX_WAIT = 60
+
+# Statistics are logged every this many calls.
+REPORT_INTERVAL = 100
+
+
+# Whether backend_cache has warned of a local memory cache.
+_warned = False
+
+
+def backend_cache():
+    """Return the cache given by `FREEZR_BACKEND_CACHE`, holding the
+    rate limiter and circuit breaker state. Warns (once) if it is a
+    local memory cache, as that is not shared between processes."""
+    global _warned
+    cache = get_cache(settings.FREEZR_BACKEND_CACHE)
+
+    if isinstance(cache, LocMemCache) and not _warned:
+        _warned = True
+        log.warning("FREEZR_BACKEND_CACHE %r is a local memory cache, "
+                    "rate limits and circuit breakers are not shared "
+                    "by worker processes", settings.FREEZR_BACKEND_CACHE)
+
+    return cache
+
+
+class RateLimiter(object):
+    """Rate limiter and backoff for API calls, see module
+    documentation. Keeps statistics of calls (see `stats`)."""
+
+    # For tests
+    sleep = staticmethod(time.sleep)
+    time = staticmethod(time.time)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {'calls': 0, 'waited': 0, 'wait_time': 0.0,
+                       'throttled': 0, 'failed': 0}
+
+    def limit(self, action):
+        return settings.FREEZR_RATE_LIMITS.get(action,
+                                               settings.FREEZR_RATE_LIMIT)
+
+    def count(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                self.counts[name] += value
+
+            report = (counts.get('calls') and
+                      self.counts['calls'] % REPORT_INTERVAL == 0)
+
+        if report:
+            log.info("EC2 calls: %r", self.stats())
+
+    def stats(self):
+        """Return counts of calls, calls that waited for the limiter,
+        total time waited, throttled calls and calls failed due to
+        throttling."""
+        with self.lock:
+            return dict(self.counts)
+
+    def wait(self, access_key, region, action):
+        """Wait until a call of `action` is allowed, returning the time
+        waited."""
+        cache = backend_cache()
+        limit = self.limit(action)
+        started = now = self.time()
+
+        while now - started < MAX_WAIT:
+            key = 'freezr.ratelimit:{0}:{1}:{2}:{3}'.format(
+                access_key, region, action, int(now))
+
+            cache.add(key, 0, 5)
+
+            try:
+                if cache.incr(key) <= limit:
+                    break
+            except ValueError:
+                # Expired in between, just try again
+                continue
+
+            # Wait for the next window, with a bit of jitter to not
+            # have all the waiters wake up at the same time.
+            self.sleep(int(now) + 1 - now + random.uniform(0, 0.1))
+            now = self.time()
+
+        return now - started
+
+    def call(self, access_key, region, action, func, *args, **kwargs):
+        """Call `func` with given arguments, rate limited as `action`
+        of `access_key` in `region`, and retrying with backoff if
+        throttled."""
+        for attempt in range(BACKOFF_RETRIES + 1):
+            waited = self.wait(access_key, region, action)
+            self.count(calls=1, waited=1 if waited else 0,
+                       wait_time=waited)
+
+            try:
+                return func(*args, **kwargs)
+            except Exception as ex:
+                if getattr(ex, 'error_code', None) not in THROTTLE_CODES:
+                    raise
+
+                self.count(throttled=1)
+
+                if attempt == BACKOFF_RETRIES:
+                    self.count(failed=1)
+                    raise
+
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+                delay = random.uniform(delay / 2, delay)
+
+                log.info("%s in %s throttled, retrying in %.1f seconds",
+                         action, region, delay)
+
+                self.count(wait_time=delay)
+                self.sleep(delay)
+
+
+limiter = RateLimiter()
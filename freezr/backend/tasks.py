@@ -1,7 +1,11 @@
 from __future__ import absolute_import
 from .celery import app
-from . import get_backend
-from freezr.core.models import Account, Project, Instance
+from . import pool
+from freezr.core.models import (Account, Project, Instance,
+                                prefetch_categories, refresh_picked_states)
+from .aws import InstanceBatch
+from freezr.core import retention
+from django.db.models import Q
 from django.utils import timezone
 from datetime import timedelta
 import logging
@@ -15,6 +19,8 @@ log = logging.getLogger('freezr.backend.tasks')
 STABLE_INSTANCE_STATES = ('running', 'stopped',
                           'terminated', 'shutting-down')
 REFRESH_INSTANCE_INTERVAL = 5
+# Instance state transitions signaling a problem starting an instance
+PROBLEM_TRANSITIONS = (('pending', 'stopped'), ('stopping', 'running'))
 STABLE_PROJECT_STATES = ('error', 'running', 'frozen')
 REFRESH_PROJECT_INTERVAL = 15
 ACCOUNT_UPDATE_INTERVAL = 3600  # 1 hour
@@ -45,7 +51,8 @@ def retry(func, *args, **kwargs):
 
 
 def get_aws(account):
-    return get_backend(account.access_key, account.secret_key)
+    """Context manager giving a (pooled) backend for `account`."""
+    return pool.backend(account.access_key, account.secret_key)
 
 
 def dispatch(task, **kwargs):
@@ -135,23 +142,115 @@ def refresh_account(self, pk, regions=None,
 
     # Ah well, probably should get a database transaction or something
     # like that here.
-    account.refresh(regions=regions, aws=get_aws(account))
+    with get_aws(account) as aws:
+        account.refresh(regions=regions, aws=aws)
 
-    # See if any of the instances ended up in a "transitioning" state,
-    # fire separate update tasks for them.
-    for instance in account.instances.all():
+    schedule_transitioning(account.instances.all())
+
+
+@app.task(bind=True)
+@retry
+def refresh_project_states(self, pk):
+    """Refresh only the states of the instances picked by the given
+    `pk` project, see Project.refresh_states."""
+    try:
+        project = Project.objects.get(id=pk)
+    except Project.DoesNotExist:
+        log.error('Refresh Project States: Unexistent project %d', pk)
+        return
+
+    log.info('Refresh Project States: %r', project)
+
+    if not project.account.active:
+        return
+
+    with get_aws(project.account) as aws:
+        project.refresh_states(aws=aws)
+
+    schedule_transitioning(project.picked_instances)
+
+
+def schedule_transitioning(instances):
+    """See if any of `instances` are in a "transitioning" state, and
+    fire an update task for them, one per account (see
+    refresh_instance_states)."""
+    by_account = {}
+
+    for instance in instances:
         if instance.state not in STABLE_INSTANCE_STATES:
             log.debug('Refresh Account: Instance %s in transitioning '
                       'state "%s", scheduling refresh',
                       instance, instance.state)
 
-            dispatch(refresh_instance.si(instance.id),
-                     countdown=REFRESH_INSTANCE_INTERVAL)
+            by_account.setdefault(instance.account_id, []).append(
+                instance.id)
+
+    for account_pk, pks in sorted(by_account.items()):
+        dispatch(refresh_instance_states.si(account_pk, pks),
+                 countdown=REFRESH_INSTANCE_INTERVAL)
 
 
 @app.task(bind=True)
 @retry
-def refresh_project(self, pk):
+def refresh_instance_states(self, account_pk, pks):
+    """Refresh the states of the `pks` instances of the `account_pk`
+    account with as few calls as possible (see
+    Account.refresh_states), rescheduling itself for those still in a
+    transitioning state. Like refresh_instance, this is done
+    regardless of the account being active."""
+    try:
+        account = Account.objects.get(id=account_pk)
+    except Account.DoesNotExist:
+        log.error('Refresh Instance States: Unexistent account %d',
+                  account_pk)
+        return
+
+    instances = list(account.instances.filter(id__in=pks))
+
+    log.info('Refresh Instance States: %r, %d instances',
+             account, len(instances))
+
+    if not instances:
+        return
+
+    prev_states = dict((instance.id, instance.state)
+                       for instance in instances)
+
+    with get_aws(account) as aws:
+        account.refresh_states(
+            aws, regions=sorted(set(i.region for i in instances)),
+            instances=instances)
+
+        # Deleted instances have lost their id.
+        instances = [i for i in instances if i.id is not None]
+        problems = [i for i in instances
+                    if (prev_states[i.id], i.state) in PROBLEM_TRANSITIONS]
+
+        # As in refresh_instance, get the full data of the instances
+        # that did not start for the reason.
+        for instance in problems:
+            instance.refresh(aws=aws)
+
+    for instance in problems:
+        report_problem_transition(instance, prev_states[instance.id])
+
+    pks = [i.id for i in instances if i.state not in STABLE_INSTANCE_STATES]
+
+    if pks:
+        log.info('Refresh Instance States: %d instances still in '
+                 'a transitioning state, rescheduling', len(pks))
+
+        dispatch(refresh_instance_states.si(account_pk, pks),
+                 countdown=REFRESH_INSTANCE_INTERVAL)
+
+
+@app.task(bind=True)
+@retry
+def refresh_project(self, pk, operation=None):
+    """Refresh the `pk` project, rescheduling itself until the project
+    has reached a stable state. If `operation` is given, the refresh
+    is part of it and renews its lease, stopping if the lease has
+    been lost to another operation."""
     try:
         project = Project.objects.get(id=pk)
     except Project.DoesNotExist:
@@ -161,50 +260,185 @@ def refresh_project(self, pk):
 
     # If project in transient state, schedule refresh.
     if project.state not in STABLE_PROJECT_STATES:
-        dispatch(refresh_project.si(project.id),
+        if operation and not project.acquire_operation(operation):
+            log.info('Refresh Project: %r operation %s superseded',
+                     project, operation)
+            return
+
+        dispatch(refresh_project.si(project.id, operation=operation),
                  countdown=REFRESH_PROJECT_INTERVAL)
+    elif operation:
+        project.release_operation(operation)
 
 
-@app.task(bind=True)
-@retry
-def freeze_project(self, pk):
-    try:
-        project = Project.objects.get(id=pk)
-    except Project.DoesNotExist:
-        log.error('Freeze Project : Unexistent project %d', pk)
+def run_operation(project, name, state, operation):
+    """Run `name` ("freeze" or "thaw") on `project` if it is in
+    `state`, as `operation` (see Project.acquire_operation), and
+    schedule refreshes to follow it until completion."""
+    if not project.account.active or project.state != state:
+        return
 
-    log.info('Freeze Project: %r', project)
+    operation = project.acquire_operation(operation)
 
-    if not project.account.active or project.state != 'freezing':
+    if not operation:
+        log.info('%s Project: %r has another operation in progress',
+                 name.capitalize(), project)
         return
 
-    project.freeze(aws=get_aws(project.account))
+    with get_aws(project.account) as aws:
+        getattr(project, name)(aws=aws, operation=operation)
+
+    # Another operation may have taken over meanwhile, in which case it
+    # follows the project from here on.
+    if not project.acquire_operation(operation):
+        log.info('%s Project: %r operation %s superseded',
+                 name.capitalize(), project, operation)
+        return
 
     # Schedule project refresh to watch instance states until all have
     # stabilised.
-    if project.state == 'freezing':
-        dispatch(refresh_project.si(project.id),
+    if project.state == state:
+        dispatch(refresh_project.si(project.id, operation=operation),
                  countdown=REFRESH_PROJECT_INTERVAL)
+    else:
+        project.release_operation(operation)
+
+
+@app.task(bind=True)
+@retry
+def freeze_project(self, pk, operation=None):
+    try:
+        project = Project.objects.get(id=pk)
+    except Project.DoesNotExist:
+        log.error('Freeze Project : Unexistent project %d', pk)
+
+    log.info('Freeze Project: %r', project)
+    run_operation(project, 'freeze', 'freezing', operation)
 
 
 @app.task(bind=True)
 @retry
-def thaw_project(self, pk):
+def thaw_project(self, pk, operation=None):
     try:
         project = Project.objects.get(id=pk)
     except Project.DoesNotExist:
         log.error('Thaw Project : Unexistent project %d', pk)
 
     log.info('Thaw Project: %r', project)
+    run_operation(project, 'thaw', 'thawing', operation)
+
+
+def run_operations(account_pk, name, state, operations):
+    """Run `name` ("freeze" or "thaw") on many projects of the
+    `account_pk` account at once. `operations` is a list of (project
+    id, operation id) pairs, see run_operation.
+
+    The instance states are refreshed once for all the projects before
+    and after, the projects are categorized together, and the
+    instances of all projects are changed with as few calls as
+    possible (see InstanceBatch)."""
+    try:
+        account = Account.objects.get(id=account_pk)
+    except Account.DoesNotExist:
+        log.error('%s Projects: Unexistent account %d',
+                  name.capitalize(), account_pk)
+        return
 
-    if not project.account.active or project.state != 'thawing':
+    if not account.active:
         return
 
-    project.thaw(aws=get_aws(project.account))
+    operations = dict(operations)
+    projects = []
 
-    if project.state == 'thawing':
-        dispatch(refresh_project.si(project.id),
-                 countdown=REFRESH_PROJECT_INTERVAL)
+    for project in account.projects.filter(id__in=operations.keys(),
+                                           state_actual=state):
+        operation = project.acquire_operation(operations[project.id])
+
+        if operation:
+            projects.append((project, operation))
+        else:
+            log.info('%s Projects: %r has another operation in progress',
+                     name.capitalize(), project)
+
+    log.info('%s Projects: %r', name.capitalize(),
+             [project for project, operation in projects])
+
+    if not projects:
+        return
+
+    # Leases still held here, released if anything fails before they
+    # have been handed over to the refresh tasks (or the operations
+    # are resumed by reissue_operations once the leases expire).
+    held = dict((project.id, operation) for project, operation in projects)
+
+    def renew():
+        """Renew the leases between the phases, dropping the projects
+        whose lease has been lost (see run_operation). Returns the
+        projects still held."""
+        for project, operation in list(projects):
+            if not project.acquire_operation(operation):
+                log.info('%s Projects: %r operation %s superseded',
+                         name.capitalize(), project, operation)
+                projects.remove((project, operation))
+                del held[project.id]
+
+        return [project for project, _ in projects]
+
+    try:
+        prefetch_categories([project for project, _ in projects])
+
+        with get_aws(account) as aws:
+            refresh_picked_states(aws, [project for project, _ in projects])
+            batch = InstanceBatch(aws)
+
+            for project, operation in projects:
+                batch.project = project
+                getattr(project, name)(aws=batch)
+
+            failures = batch.flush(renew=renew)
+
+            if renew():
+                refresh_picked_states(aws, [p for p, _ in projects])
+
+        for project, action, instance, ex in failures:
+            log.warning('%s Projects: %r could not %s %s: %s',
+                        name.capitalize(), project, action, instance, ex)
+            project.log_entry('Could not {0} instance {1}'.format(
+                action, instance), details=str(ex), type='error')
+
+        changed = []
+
+        for project, operation in projects:
+            project.refresh()
+
+            if project.state == state:
+                plan = project.plan(state)
+                changed.extend(plan['stop'] + plan['start'])
+                dispatch(refresh_project.si(project.id, operation=operation),
+                         countdown=REFRESH_PROJECT_INTERVAL)
+            else:
+                project.release_operation(operation)
+
+            del held[project.id]
+
+        # The instances of all projects are polled together.
+        schedule_transitioning(changed)
+    finally:
+        for project, operation in projects:
+            if project.id in held:
+                project.release_operation(operation)
+
+
+@app.task(bind=True)
+@retry
+def freeze_projects(self, account_pk, operations):
+    run_operations(account_pk, 'freeze', 'freezing', operations)
+
+
+@app.task(bind=True)
+@retry
+def thaw_projects(self, account_pk, operations):
+    run_operations(account_pk, 'thaw', 'thawing', operations)
 
 # Note: We don't have project.account.active check on instance checks,
 # since refresh_instance cannot be directly triggered from outside, it
@@ -212,6 +446,32 @@ def thaw_project(self, pk):
 # let's do it regardless of account active state.
 
 
+def report_problem_transition(instance, prev_state):
+    """Make an account log entry of `instance` having failed to
+    start or stop, see PROBLEM_TRANSITIONS. If the full instance data
+    has been refreshed, the reason is included in the details."""
+    if getattr(instance, 'aws_instance', None):
+        i = instance.aws_instance
+        details = (
+            'Instance %s was starting, previous state %s and '
+            'current state is %s.\n\n'
+            'Server reason: %s\n'
+            'State reason code: %s\n'
+            'State reason message: %s\n' % (
+                instance.instance_id,
+                prev_state, instance.state,
+                i.reason,
+                i.state_reason['code'],
+                i.state_reason['message']))
+    else:
+        details = None
+
+    instance.account.log_entry(
+        'Problem starting instance %s' % (instance.instance_id,),
+        details=details,
+        type='error')
+
+
 @app.task(bind=True)
 @retry
 def refresh_instance(self, pk):
@@ -233,7 +493,13 @@ def refresh_instance(self, pk):
              instance, instance.state)
 
     prev_state = instance.state
-    instance.refresh(aws=get_aws(instance.account))
+    with get_aws(instance.account) as aws:
+        instance.refresh_state(aws=aws)
+
+        # The state alone does not tell why the instance did not
+        # start, get the full instance data for that.
+        if (prev_state, instance.state) in PROBLEM_TRANSITIONS and get():
+            instance.refresh(aws=aws)
 
     # we want to use the old instance object if it is still valid
     if get():
@@ -244,28 +510,8 @@ def refresh_instance(self, pk):
                   instance.aws_instance)
 
         # Yep, this is possible. Make an account log entry out of it.
-        if (prev_state, instance.state) in (('pending', 'stopped'),
-                                            ('stopping', 'running')):
-            if instance.aws_instance:
-                i = instance.aws_instance
-                details = (
-                    'Instance %s was starting, previous state %s and '
-                    'current state is %s.\n\n'
-                    'Server reason: %s\n'
-                    'State reason code: %s\n'
-                    'State reason message: %s\n' % (
-                        instance.instance_id,
-                        prev_state, instance.state,
-                        i.reason,
-                        i.state_reason['code'],
-                        i.state_reason['message']))
-            else:
-                details = None
-
-            instance.account.log_entry(
-                'Problem starting instance %s' % (instance.instance_id,),
-                details=details,
-                type='error')
+        if (prev_state, instance.state) in PROBLEM_TRANSITIONS:
+            report_problem_transition(instance, prev_state)
 
         if instance.state in STABLE_INSTANCE_STATES:
             log.info('Refresh instance: Instance %s stabilized, '
@@ -304,8 +550,33 @@ def log_result(self, result, task=None):
 @app.task(bind=True)
 @retry
 def reissue_operations(self):
-    for project in Project.objects.filter(state_actual='freezing'):
-        dispatch(freeze_project.si(project.id))
+    """Resume freeze and thaw operations that have been lost, i.e.
+    projects freezing or thawing whose operation lease has expired.
+    Operations still running hold their lease and are left alone."""
+    expired = (Project.objects
+               .filter(state_actual__in=('freezing', 'thawing'))
+               .filter(Q(operation_expires__isnull=True) |
+                       Q(operation_expires__lte=timezone.now())))
+
+    for project in expired:
+        # Resumed elsewhere in the meantime?
+        operation = project.acquire_operation()
 
-    for project in Project.objects.filter(state_actual='thawing'):
-        dispatch(thaw_project.si(project.id))
+        if not operation:
+            continue
+
+        log.info('Reissue Operations: resuming %s of %r as %s',
+                 project.state, project, operation)
+
+        task = freeze_project if project.state == 'freezing' else thaw_project
+        dispatch(task.si(project.id, operation=operation))
+
+
+@app.task(bind=True)
+@retry
+def expire_log_entries(self):
+    """Roll up and delete old log entries, and delete old tombstones,
+    according to the retention settings, see freezr.core.retention."""
+    return {'rolled_up': retention.rollup_log_entries(),
+            'expired': retention.expire_log_entries(),
+            'tombstones': retention.expire_tombstones()}
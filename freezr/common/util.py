@@ -40,9 +40,9 @@ def _log_error_for(obj_class, pk_field, func, args, kwargs):
     if ((not obj_class or not pk_field or
          not func or args is None or kwargs is None)):
 
-        LogEntry(type='exception',
-                 message='_log_error_for called with invalid arguments',
-                 details="""Arguments to _log_error_for call:
+        l = LogEntry(type='exception',
+                     message='_log_error_for called with invalid arguments')
+        l.set_details("""Arguments to _log_error_for call:
 
 obj_class={0!r}
 pk_field={1!r}
@@ -60,7 +60,8 @@ Original exception and stack trace:
 
 """.format(obj_class, pk_field, func, args, kwargs,
            "\n".join(format_stack()),
-           format_exc())).save()
+           format_exc()))
+        l.save()
         return
 
     #print("_log_error_for: obj_class={0!r} pk_field={1!r} func={2!r}
@@ -115,8 +116,8 @@ Original exception and stack trace:
         # Construct the base log entry first.
         l = LogEntry(type='exception',
                      message=message,
-                     system_error=True,
-                     details="\n\n".join(details))
+                     system_error=True)
+        l.set_details("\n\n".join(details))
 
         l.set_object(obj)
         l.save()
@@ -0,0 +1,31 @@
+from __future__ import absolute_import
+from django.db import models
+import json
+
+
+class JSONField(models.TextField):
+    """Field storing JSON-serializable values. Uses the `jsonb` type
+    on PostgreSQL (which can be indexed with a GIN index, see the
+    `upgrade` management command) and JSON text on other
+    databases."""
+
+    __metaclass__ = models.SubfieldBase
+
+    def db_type(self, connection):
+        if connection.vendor == 'postgresql':
+            return 'jsonb'
+
+        return super(JSONField, self).db_type(connection)
+
+    def to_python(self, value):
+        # psycopg2 decodes jsonb values by itself
+        if isinstance(value, basestring):
+            return json.loads(value)
+
+        return value
+
+    def get_prep_value(self, value):
+        return json.dumps(value, sort_keys=True)
+
+    def value_to_string(self, obj):
+        return self.get_prep_value(self._get_val_from_obj(obj))
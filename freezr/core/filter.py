@@ -1,6 +1,6 @@
 from pyparsing import (Word, alphanums, Keyword, Group, Suppress,
                        oneOf, dblQuotedString, sglQuotedString,
-                       removeQuotes,
+                       removeQuotes, delimitedList,
                        opAssoc, infixNotation, StringEnd, StringStart)
 import pyparsing
 import re
@@ -63,14 +63,37 @@ def toks00(cls):
 
 
 class Element(object):
+    # Estimated relative costs of evaluating elements, see estimate.
+    COST_LOOKUP = 1
+    COST_COMPARE = 1
+    COST_REGEXP = 10
+
     def __str__(self):
         return unicode(self)
 
+    def optimize(self):
+        """Return an optimized but semantically identical version of
+        this element, see Filter.optimize."""
+        return self
+
+    def estimate(self):
+        """Return a tuple of the estimated cost of evaluating this
+        element and the estimated probability of it being true."""
+        return (0, 0.5)
+
+    @property
+    def children(self):
+        """Boolean subexpressions of this element."""
+        return []
+
 
 class AlwaysFalse(Element):
     def evaluate(self, env):
         return False
 
+    def estimate(self):
+        return (0, 0.0)
+
     def __unicode__(self):
         return "false"
 
@@ -79,6 +102,9 @@ class AlwaysTrue(Element):
     def evaluate(self, env):
         return True
 
+    def estimate(self):
+        return (0, 1.0)
+
     def __unicode__(self):
         return "true"
 
@@ -90,6 +116,9 @@ class Literal(Element):
         self.value = value
 
     def __unicode__(self):
+        if "'" in self.value:
+            return '"{0}"'.format(self.value)
+
         if ((self.value in Variable.VARIABLES or
              not self.SIMPLE_LITERAL_RE.match(self.value))):
             return "'{0}'".format(self.value)
@@ -123,7 +152,7 @@ class Tag(Element):
         self.key = toks[1].evaluate({})
 
     def __unicode__(self):
-        return "tag[{0!s}]".format(self.key)
+        return "tag[{0!s}]".format(Literal(self.key))
 
     def evaluate(self, env):
         value = env.get('tags', dict()).get(self.key, '')
@@ -149,6 +178,110 @@ class Not(Logical):
     def evaluate(self, env):
         return not self.expr.evaluate(env)
 
+    def optimize(self):
+        expr = self.expr.optimize()
+
+        if isinstance(expr, AlwaysTrue):
+            return AlwaysFalse()
+
+        if isinstance(expr, AlwaysFalse):
+            return AlwaysTrue()
+
+        # All elements evaluate to booleans, so double negation can
+        # be dropped.
+        if isinstance(expr, Not):
+            return expr.expr
+
+        return Not(expr)
+
+    def estimate(self):
+        cost, p = self.expr.estimate()
+        return (cost, 1.0 - p)
+
+    @property
+    def children(self):
+        return [self.expr]
+
+
+def merge_memberships(terms, compare_op, membership_op):
+    """Merge `compare_op` comparisons against literals and
+    `membership_op` memberships on the same value into a single
+    membership test, e.g. "type = a or type = b" into "type in (a,
+    b)". The merged term takes the place of the first merged one."""
+    result = []
+    groups = {}
+
+    for term in terms:
+        if ((isinstance(term, Comparison) and term.op == compare_op and
+             isinstance(term.rhs, Literal))):
+            items = [term.rhs.value]
+        elif isinstance(term, Membership) and term.op == membership_op:
+            items = term.items
+        else:
+            result.append(term)
+            continue
+
+        key = unicode(term.lhs)
+
+        if key in groups:
+            groups[key].append(items)
+        else:
+            groups[key] = [term, items]
+            result.append(key)
+
+    def merged(term):
+        if not isinstance(term, basestring):
+            return term
+
+        group = groups[term]
+
+        # Leave lone comparisons as they are.
+        if len(group) == 2:
+            return group[0]
+
+        return Membership([group[0].lhs, membership_op,
+                           [item for items in group[1:] for item in items]])
+
+    return [merged(term) for term in result]
+
+
+def optimize_terms(cls, terms, absorbing, identity, rank, membership):
+    """Optimize the `terms` of an And or Or (`cls`): flatten nested
+    elements of the same class, fold constants (`absorbing` decides
+    the result, `identity` is dropped), remove duplicates, merge
+    comparisons into `membership` (arguments to merge_memberships)
+    and order the terms by their `rank`."""
+    result = []
+    seen = set()
+
+    for term in terms:
+        term = term.optimize()
+        subterms = term.terms if isinstance(term, cls) else [term]
+
+        for subterm in subterms:
+            if isinstance(subterm, absorbing):
+                return subterm
+
+            text = unicode(subterm)
+
+            if isinstance(subterm, identity) or text in seen:
+                continue
+
+            seen.add(text)
+            result.append(subterm)
+
+    if not result:
+        return identity()
+
+    result = merge_memberships(result, *membership)
+
+    if len(result) == 1:
+        return result[0]
+
+    # sorted is stable, so terms of equal rank are kept in the order
+    # they were written in (e.g. "vpc and vpc ~ x")
+    return cls(sorted(result, key=lambda term: rank(*term.estimate())))
+
 
 class And(Logical):
     def __init__(self, exprs):
@@ -165,6 +298,29 @@ class And(Logical):
                 return False
         return True
 
+    @property
+    def terms(self):
+        return self.ands
+
+    children = terms
+
+    def optimize(self):
+        # Cheap terms likely to be false first.
+        return optimize_terms(
+            And, self.ands, AlwaysFalse, AlwaysTrue,
+            lambda cost, p: cost / (1.0 - p) if p < 1.0 else float('inf'),
+            ('!=', 'not in'))
+
+    def estimate(self):
+        cost, p = 0, 1.0
+
+        for expr in self.ands:
+            expr_cost, expr_p = expr.estimate()
+            cost += p * expr_cost
+            p *= expr_p
+
+        return (cost, p)
+
 
 class Or(Logical):
     def __init__(self, exprs):
@@ -183,6 +339,29 @@ class Or(Logical):
 
         return False
 
+    @property
+    def terms(self):
+        return self.ors
+
+    children = terms
+
+    def optimize(self):
+        # Cheap terms likely to be true first.
+        return optimize_terms(
+            Or, self.ors, AlwaysTrue, AlwaysFalse,
+            lambda cost, p: cost / p if p > 0.0 else float('inf'),
+            ('=', 'in'))
+
+    def estimate(self):
+        cost, q = 0, 1.0
+
+        for expr in self.ors:
+            expr_cost, expr_p = expr.estimate()
+            cost += q * expr_cost
+            q *= 1.0 - expr_p
+
+        return (cost, 1.0 - q)
+
 
 class Comparison(Element):
     ops = {
@@ -192,6 +371,14 @@ class Comparison(Element):
         '!~': (lambda a, b: not (re.search(b, a) is not None)),
         }
 
+    # Estimated probabilities of each comparison being true.
+    probabilities = {
+        '=': 0.1,
+        '!=': 0.9,
+        '~': 0.5,
+        '!~': 0.5,
+        }
+
     def __init__(self, exprs):
         self.op = exprs[1]
         self.lhs = exprs[0]
@@ -209,6 +396,68 @@ class Comparison(Element):
                 lhs, self.op, rhs, value))
         return value
 
+    def optimize(self):
+        # Comparing a value to itself has a fixed result for
+        # (in)equality.
+        if unicode(self.lhs) == unicode(self.rhs):
+            if self.op == '=':
+                return AlwaysTrue()
+
+            if self.op == '!=':
+                return AlwaysFalse()
+
+        return self
+
+    def estimate(self):
+        cost = self.COST_LOOKUP
+
+        if not isinstance(self.rhs, Literal):
+            cost += self.COST_LOOKUP
+
+        if self.op in ('~', '!~'):
+            cost += self.COST_REGEXP
+        else:
+            cost += self.COST_COMPARE
+
+        return (cost, self.probabilities[self.op])
+
+
+class Membership(Element):
+    """Test whether a value is (or with `not in`, is not) one of a
+    list of literal values."""
+
+    def __init__(self, exprs):
+        self.lhs = exprs[0]
+        self.op = exprs[1]
+        self.items = []
+
+        for item in exprs[2]:
+            if item not in self.items:
+                self.items.append(item)
+
+        self.values = frozenset(self.items)
+        self.negated = self.op == 'not in'
+
+    def __unicode__(self):
+        return "{0} {1} ({2})".format(
+            self.lhs, self.op,
+            ", ".join(unicode(Literal(item)) for item in self.items))
+
+    def evaluate(self, env):
+        value = self.lhs.evaluate(env)
+        result = (value in self.values) != self.negated
+        log.trace("Membership: {0!r} {1} {2!r} => {3!r}".format(
+            value, self.op, self.items, result))
+        return result
+
+    def estimate(self):
+        p = min(Comparison.probabilities['='] * len(self.values), 0.9)
+
+        if self.negated:
+            p = 1.0 - p
+
+        return (self.COST_LOOKUP + self.COST_COMPARE, p)
+
 
 class NotNull(Element):
     def __init__(self, s, loc, toks):
@@ -223,6 +472,13 @@ class NotNull(Element):
         log.trace("NotNull: {0!r}{0} => {1}".format(self.expr, value))
         return value is not None and value != ""
 
+    def estimate(self):
+        # Of the variables only vpc may be empty.
+        if isinstance(self.expr, Variable) and self.expr.variable != 'vpc':
+            return (self.COST_LOOKUP, 1.0)
+
+        return (self.COST_LOOKUP, 0.5)
+
 
 def get_parser():
     op_literal = ((Word(alphanums + ",.-_")
@@ -254,6 +510,22 @@ def get_parser():
                               + op_rhs)
                              .addParseAction(toks(Comparison)))
 
+    # Note that list items cannot contain commas unless quoted.
+    op_item = (Word(alphanums + ".-_")
+               | dblQuotedString
+               | sglQuotedString)
+
+    op_membership = (Keyword("in")
+                     | (Keyword("not") + Keyword("in"))
+                     .setParseAction(lambda s, l, t: "not in"))
+
+    op_membership_expression = ((op_lhs
+                                 + op_membership
+                                 + Suppress("(")
+                                 + Group(delimitedList(op_item))
+                                 + Suppress(")"))
+                                .addParseAction(toks(Membership)))
+
     op_test_expression = (Group(op_lhs)
                           .addParseAction(lambda s, l, t: t[0])
                           .addParseAction(NotNull))
@@ -261,6 +533,7 @@ def get_parser():
     op_value_expression = (op_false
                            | op_true
                            | op_compare_expression
+                           | op_membership_expression
                            | op_test_expression)
 
     op_expression = (
@@ -292,7 +565,14 @@ class Filter(object):
         return Filter(Or([self.expression, other.expression]))
 
     def NOT(self):
-        return Filter(Not(self))
+        return Filter(Not(self.expression))
+
+    def optimize(self):
+        """Return a semantically identical filter that is cheaper to
+        evaluate: constants are folded, nested and/or flattened,
+        duplicate terms removed and the terms of and/or reordered by
+        their estimated cost and selectivity."""
+        return Filter(self.expression.optimize())
 
     @property
     def expression(self):
@@ -0,0 +1,320 @@
+"""Columnar evaluation of filters over a set of instances.
+
+Evaluating a `Filter` separately for each instance environment gets
+slow for accounts with a lot of instances, as the same comparisons
+(and regular expression searches) are done over and over again on the
+same few distinct values. An `Inventory` instead stores each variable
+and tag referenced by a filter as a column of categorical codes and
+evaluates the filter into a bitmask of matching rows:
+
+- comparisons are evaluated once per distinct value (or distinct pair
+  of values when comparing two columns),
+- and, or and not are done as mask algebra on the row bitmasks.
+
+The masks are plain Python integers with bit N set for row N.
+
+Results are memoized both per subexpression (by its formatted text and
+the rows it was evaluated over) and per distinct column value, so
+evaluating several filters sharing subexpressions against the same
+inventory (like the filters of all projects of an account) does the
+shared work only once.
+
+Each subexpression is evaluated only over the rows that the per-row
+evaluator would evaluate it for (e.g. the rhs of an `and` only for the
+rows where the lhs is true), so the results -- including any exceptions
+raised by comparisons such as regular expression searches on `None`
+values -- are the same as evaluating `Filter.evaluate` row by row."""
+
+from __future__ import absolute_import
+from . import filter
+import logging
+import time
+
+log = logging.getLogger('freezr.inventory')
+
+
+def rows_to_mask(rows, count):
+    """Return a bitmask with the bits of given row indices set."""
+    bits = bytearray('0' * count)
+
+    for row in rows:
+        bits[count - row - 1] = '1'
+
+    return int(str(bits), 2) if count else 0
+
+
+def mask_to_rows(mask):
+    """Return a list of row indices set in the mask, in order."""
+    bits = bin(mask)[:1:-1]
+    rows = []
+    row = bits.find('1')
+
+    while row >= 0:
+        rows.append(row)
+        row = bits.find('1', row + 1)
+
+    return rows
+
+
+def equality_terms(element):
+    """Yield `(value, literals)` pairs for the terms of the top-level
+    conjunction of `element` that can be answered from an index: the
+    tag or variable `value` must either equal one of the non-empty
+    `literals`, or (when `literals` is None) be non-empty.
+
+    Any row matching `element` will also match all of these terms, so
+    they can be used to narrow down the rows to evaluate."""
+    if isinstance(element, filter.And):
+        for expr in element.ands:
+            for term in equality_terms(expr):
+                yield term
+    elif isinstance(element, filter.NotNull):
+        yield element.expr, None
+    elif isinstance(element, filter.Comparison):
+        if ((element.op == '=' and
+             isinstance(element.rhs, filter.Literal) and
+             element.rhs.value != '')):
+            yield element.lhs, [element.rhs.value]
+    elif isinstance(element, filter.Membership):
+        if not element.negated and '' not in element.values:
+            yield element.lhs, element.items
+
+
+class Column(object):
+    """Categorical column: the distinct `values`, a per-row `codes`
+    list indexing into `values` and the list of `rows` for each
+    code."""
+
+    def __init__(self, data):
+        self.values = []
+        self.codes = []
+        self.rows = []
+        index = {}
+
+        for row, value in enumerate(data):
+            code = index.get(value)
+
+            if code is None:
+                code = index[value] = len(self.values)
+                self.values.append(value)
+                self.rows.append([])
+
+            self.codes.append(code)
+            self.rows[code].append(row)
+
+    def present(self, rows):
+        """Codes of values occurring on given rows (all if None)."""
+        if rows is None:
+            return range(len(self.values))
+
+        codes = self.codes
+        return set(codes[row] for row in rows)
+
+
+class Inventory(object):
+    """Columnar view of a list of filter environments (see
+    `Instance.environment`). Columns are built on demand as filters
+    reference them. `items` are returned by `filter` for matching
+    rows, and default to the environments themselves."""
+
+    def __init__(self, environments, items=None):
+        self.environments = list(environments)
+        self.items = self.environments if items is None else list(items)
+        self.count = len(self.environments)
+        self.all = (1 << self.count) - 1
+        self.columns = {}
+        self.results = {}
+        self.predicates = {}
+        self.stats = None
+
+    @classmethod
+    def for_instances(cls, instances):
+        instances = list(instances)
+        return cls([instance.environment for instance in instances],
+                   instances)
+
+    def column(self, element):
+        if isinstance(element, filter.Tag):
+            key = ('tag', element.key)
+        else:
+            key = ('variable', element.variable)
+
+        column = self.columns.get(key)
+
+        if column is None:
+            column = self.columns[key] = Column(
+                element.evaluate(env) for env in self.environments)
+
+        return column
+
+    def evaluate(self, f, mask=None):
+        """Evaluate the `Filter` (or filter element) `f` over the rows
+        in `mask` (all if not given), returning a bitmask of matching
+        rows."""
+        if isinstance(f, filter.Filter):
+            f = f.expression
+
+        return self._evaluate(f, self.all if mask is None else mask)
+
+    def filter(self, f, mask=None):
+        """Return the items matching the filter `f` (within `mask`)."""
+        items = self.items
+        return [items[row] for row in mask_to_rows(self.evaluate(f, mask))]
+
+    def profile(self):
+        """Start collecting statistics of the evaluations, see
+        `tree`."""
+        self.stats = {}
+
+    def tree(self, f):
+        """Return the statistics collected (see `profile`) for the
+        `Filter` (or filter element) `f` as a tree of dicts, each with
+        the formatted `expression`, its `type`, `children` and:
+
+        - `evaluations`: times evaluated (over some set of rows),
+        - `cached`: times the memoized result was used instead,
+        - `rows`, `true` and `false`: rows evaluated over, and how many
+          of them matched or not (both summed over the evaluations),
+        - `predicates`: comparisons done on distinct column values,
+        - `time`: seconds spent evaluating it, including children.
+
+        Subexpressions occurring many times share their statistics."""
+        element = f.expression if isinstance(f, filter.Filter) else f
+        stats = (self.stats or {}).get(unicode(element), {})
+        tree = {'expression': filter.format(element),
+                'type': type(element).__name__,
+                'children': [self.tree(child) for child in element.children]}
+
+        for name in ('evaluations', 'cached', 'rows', 'true', 'false',
+                     'predicates'):
+            tree[name] = stats.get(name, 0)
+
+        tree['time'] = stats.get('time', 0.0)
+        return tree
+
+    def _evaluate(self, element, mask):
+        if not mask:
+            return 0
+
+        key = (unicode(element), mask)
+        result = self.results.get(key)
+
+        if self.stats is not None:
+            stats = self.stats.setdefault(key[0], {})
+
+            if result is not None:
+                stats['cached'] = stats.get('cached', 0) + 1
+                return result
+
+            start = time.time()
+            result = self._evaluate_uncached(element, mask, key)
+            rows = bin(mask).count('1')
+            true = bin(result).count('1')
+
+            for name, value in (('evaluations', 1), ('rows', rows),
+                                ('true', true), ('false', rows - true),
+                                ('time', time.time() - start)):
+                stats[name] = stats.get(name, 0) + value
+
+            return result
+
+        if result is None:
+            result = self._evaluate_uncached(element, mask, key)
+
+        return result
+
+    def _evaluate_uncached(self, element, mask, key):
+        method = getattr(self, '_' + type(element).__name__)
+        result = self.results[key] = method(element, mask)
+        return result
+
+    def _rows(self, mask):
+        return None if mask == self.all else mask_to_rows(mask)
+
+    def _AlwaysTrue(self, element, mask):
+        return mask
+
+    def _AlwaysFalse(self, element, mask):
+        return 0
+
+    def _Not(self, element, mask):
+        return mask & ~self._evaluate(element.expr, mask)
+
+    def _And(self, element, mask):
+        for expr in element.ands:
+            mask = self._evaluate(expr, mask)
+
+        return mask
+
+    def _Or(self, element, mask):
+        matched = 0
+
+        for expr in element.ors:
+            value = self._evaluate(expr, mask)
+            matched |= value
+            mask &= ~value
+
+        return matched
+
+    def _NotNull(self, element, mask):
+        column = self.column(element.expr)
+        return self._select(column, mask, element, lambda value: (
+            value is not None and value != ""))
+
+    def _Comparison(self, element, mask):
+        op = filter.Comparison.ops[element.op]
+        lhs = self.column(element.lhs)
+
+        if isinstance(element.rhs, filter.Literal):
+            rhs = element.rhs.value
+            return self._select(lhs, mask, element,
+                                lambda value: op(value, rhs))
+
+        # Both sides vary by row, so evaluate once per distinct pair
+        # of values.
+        rhs = self.column(element.rhs)
+        rows = self._rows(mask)
+        pairs = {}
+
+        for row in (range(self.count) if rows is None else rows):
+            pairs.setdefault((lhs.codes[row], rhs.codes[row]),
+                             []).append(row)
+
+        matched = []
+
+        for (a, b), pair_rows in pairs.iteritems():
+            self._count_predicate(element)
+
+            if op(lhs.values[a], rhs.values[b]):
+                matched.extend(pair_rows)
+
+        return rows_to_mask(matched, self.count)
+
+    def _Membership(self, element, mask):
+        values, negated = element.values, element.negated
+        return self._select(self.column(element.lhs), mask, element,
+                            lambda value: (value in values) != negated)
+
+    def _count_predicate(self, element):
+        if self.stats is not None:
+            stats = self.stats.setdefault(unicode(element), {})
+            stats['predicates'] = stats.get('predicates', 0) + 1
+
+    def _select(self, column, mask, element, predicate):
+        """Mask of rows within `mask` whose value in `column`
+        satisfies `predicate` (for `element`), calling it only once
+        per distinct value."""
+        results = self.predicates.setdefault(unicode(element), {})
+        matched = []
+
+        for code in column.present(self._rows(mask)):
+            result = results.get(code)
+
+            if result is None:
+                result = results[code] = predicate(column.values[code])
+                self._count_predicate(element)
+
+            if result:
+                matched.extend(column.rows[code])
+
+        return rows_to_mask(matched, self.count) & mask
@@ -0,0 +1,143 @@
+from __future__ import absolute_import
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+from django.utils import timezone
+from freezr.core.models import (Domain, Account, Project, Instance,
+                                InstanceTag, LogEntry)
+from optparse import make_option
+import time
+
+# Prefix for query plans by database vendor.
+EXPLAIN = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ANALYZE ',
+    'mysql': 'EXPLAIN ',
+    }
+
+
+class Command(NoArgsCommand):
+    help = ("Create a test database with a synthetic data set, and show "
+            "query plans and timings of freezr's most common queries "
+            "on it. The test database is destroyed afterwards.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--instances', type='int', default=100000,
+                    help='Number of instances to create'),
+        make_option('--accounts', type='int', default=10,
+                    help='Number of accounts to create'),
+        make_option('--repeat', type='int', default=10,
+                    help='Number of times to run each query'),
+        )
+
+    REGIONS = ('us-east-1', 'us-west-1', 'us-west-2', 'eu-west-1')
+
+    def handle_noargs(self, **options):
+        name = connection.creation.create_test_db(verbosity=0,
+                                                  autoclobber=True)
+
+        try:
+            started = time.time()
+            self.populate(options['instances'], options['accounts'])
+            self.stdout.write("Created data set in %.1f seconds" % (
+                time.time() - started,))
+
+            for title, queryset in self.queries():
+                self.benchmark(title, queryset, options['repeat'])
+        finally:
+            connection.creation.destroy_test_db(name, verbosity=0)
+
+    def populate(self, instances, accounts):
+        domain = Domain(name='benchmark', domain='.benchmark')
+        domain.save()
+        now = timezone.now()
+
+        for n in range(accounts):
+            account = Account(domain=domain, name='account %d' % (n,),
+                              access_key='key %d' % (n,),
+                              secret_key='secret')
+            account.save()
+
+            projects = []
+
+            for m in range(10):
+                project = Project(account=account, name='project %d' % (m,),
+                                  regions=",".join(self.REGIONS),
+                                  pick_filter='tag[project] = p%d' % (m,),
+                                  state_actual='running' if m else 'init')
+                project.save()
+                projects.append(project)
+
+            count = instances // accounts
+            Instance.objects.bulk_create(
+                [Instance(account=account,
+                          instance_id='i-%08x' % (i,),
+                          region=self.REGIONS[i % len(self.REGIONS)],
+                          type='m1.small', store='ebs', state='running',
+                          tag_data={'Name': 'instance %d' % (i,),
+                                    'project': 'p%d' % (i % 10,),
+                                    'env': 'prod' if i % 3 else 'test'})
+                 for i in range(count)])
+
+            InstanceTag.objects.bulk_create(
+                [InstanceTag(instance=instance, key=key, value=value)
+                 for instance in account.instances.all()
+                 for key, value in instance.tag_data.iteritems()])
+
+            # Half of the log entries for the account, rest for its
+            # projects.
+            LogEntry.objects.bulk_create(
+                [LogEntry(account=None if i % 2 else account,
+                          project=projects[i % 10] if i % 2 else None,
+                          message='entry %d' % (i,), time=now)
+                 for i in range(count // 10)])
+
+    def queries(self):
+        account = Account.objects.order_by('-id')[0]
+        instance = account.instances.order_by('-id')[0]
+        project = account.projects.order_by('-id')[0]
+
+        return (
+            ('Instances by account and region',
+             Instance.objects.filter(account=account, region='eu-west-1')),
+            ('Instance by account, instance id and region',
+             Instance.objects.filter(account=account,
+                                     instance_id=instance.instance_id,
+                                     region=instance.region)),
+            ('Tag by instance and key',
+             InstanceTag.objects.filter(instance=instance, key='Name')),
+            ('Instances by tag',
+             Instance.objects.filter(
+                 account=account,
+                 id__in=InstanceTag.objects.filter(
+                     key='project', value='p1').values('instance'))),
+            ('Latest log entries of account',
+             LogEntry.objects.filter(account=account).order_by('-time')[:10]),
+            ('Latest log entries of project',
+             LogEntry.objects.filter(project=project).order_by('-time')[:10]),
+            ('Projects in init state',
+             Project.objects.filter(state_actual='init')),
+            )
+
+    def benchmark(self, title, queryset, repeat):
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+
+        self.stdout.write("\n%s:\n  %s" % (title, sql % params))
+
+        explain = EXPLAIN.get(connection.vendor)
+
+        if explain:
+            cursor.execute(explain + sql, params)
+
+            for row in cursor.fetchall():
+                self.stdout.write("    " + " ".join(map(unicode, row)))
+
+        timings = []
+
+        for n in range(repeat):
+            started = time.time()
+            count = len(list(queryset.all()))
+            timings.append(time.time() - started)
+
+        self.stdout.write("  %d rows, min %.2f ms, max %.2f ms" % (
+            count, min(timings) * 1000, max(timings) * 1000))
@@ -0,0 +1,39 @@
+from __future__ import absolute_import
+from django.core.management.base import CommandError, NoArgsCommand
+from freezr.backend import events
+from optparse import make_option
+import time
+
+
+class Command(NoArgsCommand):
+    help = ("Update instance states from EC2 state-change events "
+            "received from the queue configured with FREEZR_EVENT_QUEUE. "
+            "Runs until interrupted, unless --once is given.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--once', action='store_true', default=False,
+                    help='Process queued events and exit'),
+        make_option('--interval', type='float', default=1.0,
+                    help='Seconds to wait after finding the queue empty'),
+        )
+
+    def handle_noargs(self, **options):
+        queue = events.get_queue()
+
+        if queue is None:
+            raise CommandError("FREEZR_EVENT_QUEUE is not set")
+
+        received = 0
+
+        while True:
+            count = events.ingest(queue)
+            received += count
+
+            if not count:
+                if options['once']:
+                    break
+
+                time.sleep(options['interval'])
+
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write("Received %d messages" % (received,))
@@ -0,0 +1,283 @@
+from __future__ import absolute_import
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.cache.backends.db import BaseDatabaseCache
+from django.core.management import call_command
+from django.core.management.base import NoArgsCommand
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Count, Max, get_models
+from django.utils import timezone
+from freezr.core.models import (Account, Domain, Instance, InstanceTag,
+                                LogEntry, Project, Tombstone)
+import freezr.core.models
+import re
+
+# Name and column list of a CREATE INDEX statement, see add_indexes.
+INDEX_SQL = re.compile(r'CREATE INDEX (\S+) ON \S+ \((.*)\)')
+
+
+class Command(NoArgsCommand):
+    help = ("Upgrade the database of an existing installation to the "
+            "current schema. Run after syncdb, which only creates "
+            "missing tables.")
+
+    # Number of instances to update at a time.
+    chunk_size = 1000
+
+    def handle_noargs(self, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+
+        with transaction.atomic():
+            self.add_sequence_columns()
+            self.add_tag_data()
+            self.fill_tag_data()
+            self.add_stored_details()
+            self.add_project_columns()
+            self.add_state_time()
+            self.add_tombstone_time()
+            self.remove_duplicate_tags()
+            self.add_indexes()
+            self.add_cache_tables()
+
+    def message(self, msg, *args):
+        if self.verbosity > 0:
+            self.stdout.write(msg % args)
+
+    def columns(self, model):
+        cursor = connection.cursor()
+        return [column[0] for column in
+                connection.introspection.get_table_description(
+                    cursor, model._meta.db_table)]
+
+    def add_sequence_columns(self):
+        """Add the `sequence` column of sequenced models (see
+        SequencedModel). Existing rows get sequence 0, i.e. they are
+        older than any cursor of the change feed. The index on it is
+        created by add_indexes."""
+        for model in (Domain, Account, Instance, Project, LogEntry):
+            table = model._meta.db_table
+            field = model._meta.get_field('sequence')
+
+            if field.column not in self.columns(model):
+                self.message("Adding %s.%s", table, field.column)
+                connection.cursor().execute(
+                    "ALTER TABLE %s ADD COLUMN %s %s NOT NULL DEFAULT 0" % (
+                        table, field.column, field.db_type(connection)))
+
+    def add_tag_data(self):
+        """Add Instance.tag_data column, and on PostgreSQL a GIN
+        index on it."""
+        table = Instance._meta.db_table
+        field = Instance._meta.get_field('tag_data')
+        cursor = connection.cursor()
+
+        if field.column not in self.columns(Instance):
+            self.message("Adding %s.%s", table, field.column)
+            cursor.execute(
+                "ALTER TABLE %s ADD COLUMN %s %s NOT NULL DEFAULT '{}'" % (
+                    table, field.column, field.db_type(connection)))
+
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS %s_%s_gin ON %s "
+                "USING gin (%s)" % (table, field.column, table,
+                                    field.column))
+
+    def fill_tag_data(self):
+        """Copy tags from InstanceTag rows to Instance.tag_data."""
+        ids = list(Instance.objects.order_by('id')
+                   .values_list('id', flat=True))
+        updated = 0
+
+        for start in range(0, len(ids), self.chunk_size):
+            chunk = ids[start:start + self.chunk_size]
+            tags = {id: {} for id in chunk}
+
+            for id, key, value in (InstanceTag.objects
+                                   .filter(instance__in=chunk)
+                                   .values_list('instance', 'key', 'value')):
+                tags[id][key] = value
+
+            for instance in Instance.objects.filter(id__in=chunk):
+                if instance.tag_data != tags[instance.id]:
+                    (Instance.objects.filter(pk=instance.pk)
+                     .update(tag_data=tags[instance.id]))
+                    updated += 1
+
+        self.message("Updated tag data of %d instances", updated)
+
+    def add_stored_details(self):
+        """Add LogEntry.stored_details column (the LogDetails table
+        itself is created by syncdb)."""
+        table = LogEntry._meta.db_table
+        field = LogEntry._meta.get_field('stored_details')
+
+        if field.column not in self.columns(LogEntry):
+            self.message("Adding %s.%s", table, field.column)
+            connection.cursor().execute(
+                "ALTER TABLE %s ADD COLUMN %s %s NULL REFERENCES %s (id)" % (
+                    table, field.column, field.db_type(connection),
+                    field.rel.to._meta.db_table))
+
+    def add_project_columns(self):
+        """Add Project operation lease and plan columns (the index on
+        the lease and the PlanItem table are created by add_indexes
+        and syncdb)."""
+        table = Project._meta.db_table
+        columns = self.columns(Project)
+
+        for name in ('operation_owner', 'operation_expires',
+                     'plan_state', 'plan_digest'):
+            field = Project._meta.get_field(name)
+
+            if field.column not in columns:
+                self.message("Adding %s.%s", table, field.column)
+                connection.cursor().execute(
+                    "ALTER TABLE %s ADD COLUMN %s %s %s" % (
+                        table, field.column, field.db_type(connection),
+                        "NULL" if field.null else "NOT NULL DEFAULT ''"))
+
+    def add_state_time(self):
+        """Add Instance.state_time column. Existing instances get
+        null, i.e. any state-change event is newer."""
+        table = Instance._meta.db_table
+        field = Instance._meta.get_field('state_time')
+
+        if field.column not in self.columns(Instance):
+            self.message("Adding %s.%s", table, field.column)
+            connection.cursor().execute(
+                "ALTER TABLE %s ADD COLUMN %s %s NULL" % (
+                    table, field.column, field.db_type(connection)))
+
+    def add_cache_tables(self):
+        """Create the tables of database caches (like the default
+        FREEZR_BACKEND_CACHE) that do not exist yet."""
+        tables = connection.introspection.table_names()
+
+        for alias in settings.CACHES:
+            cache = get_cache(alias)
+
+            if (isinstance(cache, BaseDatabaseCache) and
+                    cache._table not in tables):
+                self.message("Adding cache table %s", cache._table)
+                call_command('createcachetable', cache._table,
+                             verbosity=self.verbosity)
+
+    def add_tombstone_time(self):
+        """Add Tombstone.time column. Existing tombstones get the
+        current time, i.e. they are kept for the full retention
+        period."""
+        table = Tombstone._meta.db_table
+        field = Tombstone._meta.get_field('time')
+
+        if field.column not in self.columns(Tombstone):
+            self.message("Adding %s.%s", table, field.column)
+            connection.cursor().execute(
+                "ALTER TABLE %s ADD COLUMN %s %s NULL" % (
+                    table, field.column, field.db_type(connection)))
+            Tombstone.objects.update(time=timezone.now())
+
+    def remove_duplicate_tags(self):
+        """Remove duplicate tags of an instance (keeping the latest
+        one) that may have accumulated before tags were unique."""
+        duplicates = (InstanceTag.objects.values('instance', 'key')
+                      .annotate(count=Count('id'), latest=Max('id'))
+                      .filter(count__gt=1))
+
+        for duplicate in duplicates:
+            (InstanceTag.objects
+             .filter(instance=duplicate['instance'], key=duplicate['key'])
+             .exclude(id=duplicate['latest'])
+             .delete())
+
+        if duplicates:
+            self.message("Removed duplicates of %d tags", len(duplicates))
+
+    def indexes(self, model):
+        """Return the existing indexes of `model`'s table as a list of
+        (name, unique, columns) tuples. Unique constraints are
+        included, as they are implemented as unique indexes."""
+        table = model._meta.db_table
+        cursor = connection.cursor()
+        result = []
+
+        if connection.vendor == 'sqlite':
+            cursor.execute("PRAGMA index_list(%s)" % (
+                connection.ops.quote_name(table),))
+
+            for row in cursor.fetchall():
+                cursor.execute("PRAGMA index_info(%s)" % (
+                    connection.ops.quote_name(row[1]),))
+                result.append((row[1], bool(row[2]),
+                               tuple(info[2] for info in sorted(
+                                   cursor.fetchall()))))
+        elif connection.vendor == 'postgresql':
+            cursor.execute("SELECT attnum, attname FROM pg_attribute "
+                           "WHERE attrelid = %s::regclass AND attnum > 0",
+                           [table])
+            names = dict(cursor.fetchall())
+            cursor.execute("SELECT c.relname, i.indisunique, i.indkey "
+                           "FROM pg_index i "
+                           "JOIN pg_class c ON c.oid = i.indexrelid "
+                           "WHERE i.indrelid = %s::regclass", [table])
+
+            for name, unique, key in cursor.fetchall():
+                result.append((name, unique,
+                               tuple(names.get(int(n)) for n in key.split())))
+        else:
+            # Only single-column indexes can be introspected.
+            for column, info in connection.introspection.get_indexes(
+                    cursor, table).items():
+                result.append((None, info['unique'], (column,)))
+
+        return result
+
+    def execute_sql(self, sql):
+        """Execute `sql`. Errors are not caught: the upgrade is rolled
+        back and the error reported."""
+        connection.cursor().execute(sql)
+        self.message("Executed %s", sql)
+
+    def add_indexes(self):
+        """Create indexes and unique constraints missing from tables
+        created by earlier versions, skipping those that exist already
+        under any name (e.g. unique constraints created by syncdb).
+        Unique constraints are created as unique indices named like
+        PostgreSQL names the constraints created by syncdb."""
+        qn = connection.ops.quote_name
+
+        for model in get_models(freezr.core.models):
+            existing = self.indexes(model)
+            names = set(name for name, unique, columns in existing)
+
+            for sql in connection.creation.sql_indexes_for_model(
+                    model, no_style()):
+                match = INDEX_SQL.match(sql)
+                name = match.group(1).strip('"`')
+                specs = [spec.split() for spec in match.group(2).split(',')]
+                columns = tuple(spec[0].strip('"`') for spec in specs)
+
+                # Indexes with operator classes (see the PostgreSQL
+                # backend) are told apart only by their name.
+                plain = all(len(spec) == 1 for spec in specs)
+
+                if name in names or (plain and any(
+                        c == columns for n, u, c in existing)):
+                    continue
+
+                self.execute_sql(sql)
+
+            for fields in model._meta.unique_together:
+                columns = tuple(model._meta.get_field(field).column
+                                for field in fields)
+
+                if any(unique and set(c) == set(columns)
+                       for n, unique, c in existing):
+                    continue
+
+                self.execute_sql("CREATE UNIQUE INDEX %s ON %s (%s)" % (
+                    qn("%s_%s_key" % (model._meta.db_table,
+                                      "_".join(columns))),
+                    qn(model._meta.db_table),
+                    ", ".join(qn(column) for column in columns)))
@@ -1,13 +1,25 @@
 from __future__ import absolute_import
 from django.db import models
 from django.core.exceptions import ValidationError
-from django.db import transaction
+from django.db import connection, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.contrib import auth
 from django.utils import timezone
+from datetime import timedelta
+from functools import wraps
 import django.contrib.auth.models  # noqa
+import hashlib
+import json
 import re
+import threading
+import uuid
+import zlib
 import freezr.common.util as util
+from freezr.backend.breaker import RegionUnavailable
 from . import filter
+from .inventory import Inventory, equality_terms
+from .fields import JSONField
 
 VALID_INSTANCE_RE = re.compile(r'^i-[0-9a-f]+$')
 
@@ -20,6 +32,45 @@ def validate_instance_id(value):
 def firsts(elts):
     return map(lambda e: e[0], elts)
 
+
+def is_prefetched(obj, name):
+    """Returns True if the `name` related objects of `obj` have been
+    loaded with `prefetch_related`."""
+    return name in getattr(obj, '_prefetched_objects_cache', {})
+
+
+def prefetch_categories(projects):
+    """Categorize the instances of all `projects` with one
+    Account.categorize call per account, and store the results in the
+    projects for their picked_instances, saved_instances and other
+    properties to use."""
+    accounts = {}
+
+    for project in projects:
+        accounts.setdefault(project.account_id, []).append(project)
+
+    for projects in accounts.values():
+        categories = projects[0].account.categorize(projects)
+
+        for project in projects:
+            project._categories = categories[project.id]
+
+
+def refresh_picked_states(aws, projects):
+    """Refresh the states of the instances picked by `projects` (of
+    the same account) in their regions with one Account.refresh_states
+    call, see Project.refresh_states."""
+    regions = set()
+    instances = set()
+
+    for project in projects:
+        regions.update(project.regions)
+        instances.update(project.picked_instances)
+
+    if projects:
+        projects[0].account.refresh_states(aws, regions=sorted(regions),
+                                           instances=instances)
+
 # Should get this dynamically from AWS instead
 EC2_REGIONS_CHOICES = (
     ('us-east-1', 'US East'),
@@ -74,6 +125,14 @@ INSTANCE_STATE_CHOICES = (
 
 INSTANCE_STATES = firsts(INSTANCE_STATE_CHOICES)
 
+PLAN_ACTIONS_CHOICES = (
+    ('terminate', 'Terminate'),
+    ('stop', 'Stop'),
+    ('start', 'Start')
+    )
+
+PLAN_ACTIONS = firsts(PLAN_ACTIONS_CHOICES)
+
 LOG_ENTRY_TYPES_CHOICES = (
     ('info', 'Informational'),
     ('verbose', 'Verbose information'),  # lower priority than info
@@ -84,6 +143,280 @@ LOG_ENTRY_TYPES_CHOICES = (
 
 LOG_ENTRY_TYPES = firsts(LOG_ENTRY_TYPES_CHOICES)
 
+# Maximum number of log entries held by a `LogBuffer` before they are
+# written to the database.
+LOG_BUFFER_SIZE = 100
+
+# Log entry details longer than this are stored compressed and
+# deduplicated as `LogDetails`.
+LOG_DETAILS_INLINE_MAX = 512
+
+# Object addresses in reprs (e.g. of requests) that would otherwise
+# make identical tracebacks look different.
+ADDRESS_RE = re.compile(r'\b0x[0-9a-fA-F]+\b')
+
+# Seconds a freeze or thaw operation holds the lease on its project
+# without renewing it (see Project.acquire_operation).
+OPERATION_LEASE = 300
+
+
+# Every this many sequence allocations the older allocator rows are
+# pruned (the latest row is always kept so that the allocator cannot
+# restart from a lower value).
+SEQUENCE_PRUNE_INTERVAL = 1000
+
+# Tag in the top 16 bits of the advisory lock keys used to track the
+# sequence values allocated by open transactions on PostgreSQL (see
+# `sequence_floor`). The lower 48 bits hold the sequence value.
+SEQUENCE_LOCK_TAG = 0x6672
+SEQUENCE_LOCK_BASE = SEQUENCE_LOCK_TAG << 48
+
+
+class Sequence(models.Model):
+    """Allocator for the global modification sequence. Each row
+    allocated here is one sequence value, and the largest allocated
+    value is the current "version" of the whole database as seen by
+    the change feed (see `SequencedModel`)."""
+
+    def __unicode__(self):
+        return unicode(self.id)
+
+
+def next_sequence():
+    """Allocate and return a new, monotonically increasing
+    modification sequence value. Should be called within the
+    transaction that saves the objects using the value."""
+    if connection.vendor == 'postgresql':
+        # Until this transaction ends, hold a lock telling that it
+        # may commit objects with sequence values above the latest
+        # one already allocated, see `sequence_floor`.
+        connection.cursor().execute(
+            "SELECT pg_advisory_xact_lock_shared(%s + COALESCE(MAX(id), 0)) "
+            "FROM {0}".format(Sequence._meta.db_table),
+            [SEQUENCE_LOCK_BASE])
+
+    seq = Sequence.objects.create().id
+
+    if seq % SEQUENCE_PRUNE_INTERVAL == 0:
+        Sequence.objects.filter(id__lt=seq).delete()
+
+    return seq
+
+
+def current_sequence():
+    """Return the latest allocated modification sequence value, or 0
+    if nothing has been allocated yet."""
+    latest = Sequence.objects.order_by('-id').values_list('id', flat=True)
+    latest = list(latest[:1])
+    return latest[0] if latest else 0
+
+
+def sequence_floor():
+    """Return the lowest sequence value below which transactions that
+    are still open may commit objects, or None if there are no such
+    transactions.
+
+    Sequence values are allocated within transactions, which may
+    commit in a different order. On PostgreSQL each transaction
+    allocating sequence values holds a shared advisory lock on the
+    latest value allocated before its first one (see
+    `next_sequence`), and the lowest locked value is the floor. SQLite
+    serializes writing transactions, so they always commit in
+    allocation order and there is no floor."""
+    if connection.vendor != 'postgresql':
+        return None
+
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT MIN(((classid::bigint << 32) | objid::bigint) - %s) "
+        "FROM pg_locks WHERE locktype = 'advisory' AND objsubid = 1 "
+        "AND (classid::bigint >> 16) = %s AND database = "
+        "(SELECT oid FROM pg_database WHERE datname = current_database())",
+        [SEQUENCE_LOCK_BASE, SEQUENCE_LOCK_TAG])
+    return cursor.fetchone()[0]
+
+
+def safe_sequence():
+    """Return the latest modification sequence value up to which all
+    changes have been committed, i.e. no object with a sequence value
+    at or below it can appear any more. This is the cursor given to
+    change feed clients (see freezr.api.views.ChangesView): a client
+    that has seen all changes up to it will not miss any change by
+    asking only for those after it."""
+    # Read the latest value first: anything allocated after this
+    # is above it anyway.
+    latest = current_sequence()
+    floor = sequence_floor()
+    return latest if floor is None else min(latest, floor)
+
+
+class SequencedModel(models.Model):
+    """Abstract model that stamps every save with a new modification
+    sequence value. Deletions of sequenced objects are recorded as
+    `Tombstone` objects. Together these allow clients to ask for
+    "everything that has changed since sequence N".
+
+    Note that bulk operations (`QuerySet.update`, `bulk_create`)
+    bypass `save` and have to set `sequence` themselves."""
+
+    sequence = models.BigIntegerField(default=0, db_index=True,
+                                      editable=False)
+
+    def save(self, *args, **kwargs):
+        created = self.pk is None
+
+        # The sequence value must be allocated in the same transaction
+        # as the object is saved, see `safe_sequence`.
+        with transaction.atomic():
+            self.sequence = next_sequence()
+
+            update_fields = kwargs.get('update_fields')
+
+            if update_fields is not None and 'sequence' not in update_fields:
+                kwargs['update_fields'] = list(update_fields) + ['sequence']
+
+            super(SequencedModel, self).save(*args, **kwargs)
+
+            self.touch_dependents(created)
+
+    def touch_dependents(self, created):
+        """Called after this object has been saved or deleted
+        (`created` is True for both creation and deletion). Children
+        should bump the sequence of those objects whose serialized
+        form depends on this object, such as lists of related
+        objects. See `touch`."""
+        pass
+
+    class Meta:
+        abstract = True
+
+
+def touch(queryset):
+    """Bump the modification sequence of all objects in `queryset`
+    without otherwise modifying them."""
+    with transaction.atomic():
+        queryset.update(sequence=next_sequence())
+
+
+class TouchBuffer(object):
+    """Context manager deferring the sequence bumps of accounts and
+    their projects made with `touch_account` within it, such as those
+    of `Instance.touch_dependents`. On exit each account and the
+    projects of each account are touched once, instead of once for
+    every instance saved. Buffers are per thread, and nested ones
+    defer to the outermost one. Nothing is touched if the context
+    exits with an exception."""
+
+    local = threading.local()
+
+    def __init__(self):
+        self.accounts = set()
+        self.projects = set()
+
+    @classmethod
+    def current(cls):
+        """Return the outermost active buffer of this thread, or
+        None."""
+        return getattr(cls.local, 'buffer', None)
+
+    def flush(self):
+        if self.accounts:
+            touch(Account.objects.filter(pk__in=self.accounts))
+
+        if self.projects:
+            touch(Project.objects.filter(account__in=self.projects))
+
+        self.accounts, self.projects = set(), set()
+
+    def __enter__(self):
+        self.outermost = self.current() is None
+
+        if self.outermost:
+            self.local.buffer = self
+
+        return self
+
+    def __exit__(self, type, value, tb):
+        if not self.outermost:
+            return False
+
+        self.local.buffer = None
+
+        if type is None:
+            self.flush()
+
+        return False
+
+
+def touch_buffered(func):
+    """Decorator running `func` within a `TouchBuffer`."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with TouchBuffer():
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def touch_account(account_id, account=False, projects=False):
+    """Bump the modification sequence of the `account_id` account
+    and/or its projects, or mark them to be touched when the active
+    `TouchBuffer` exits."""
+    buffer = TouchBuffer.current()
+
+    if buffer is None:
+        if account:
+            touch(Account.objects.filter(pk=account_id))
+
+        if projects:
+            touch(Project.objects.filter(account=account_id))
+
+        return
+
+    if account:
+        buffer.accounts.add(account_id)
+
+    if projects:
+        buffer.projects.add(account_id)
+
+
+class Tombstone(models.Model):
+    """Record of a deleted sequenced object.
+
+    Old tombstones are pruned (see
+    freezr.core.retention.expire_tombstones), leaving a single
+    tombstone of kind `HORIZON` whose sequence is the latest pruned
+    one. Clients that have not seen the changes up to it may have
+    missed deletions, and have to start over (see `horizon`)."""
+
+    HORIZON = ''
+
+    # Model name of the deleted object, e.g. "instance"
+    kind = models.CharField(max_length=30)
+
+    # Primary key of the deleted object
+    object_id = models.IntegerField()
+
+    # Modification sequence of the deletion
+    sequence = models.BigIntegerField(db_index=True)
+
+    # Time of the deletion
+    time = models.DateTimeField(default=timezone.now, editable=False)
+
+    @classmethod
+    def horizon(cls):
+        """Return the sequence up to which tombstones have been
+        pruned, or 0 if none have."""
+        return max(cls.objects.filter(kind=cls.HORIZON)
+                   .values_list('sequence', flat=True) or [0])
+
+    def __unicode__(self):
+        return "{0} {1} deleted at {2}".format(self.kind, self.object_id,
+                                               self.sequence)
+
+    class Meta:
+        index_together = (('kind', 'sequence'),)
+
 
 class BaseModel(util.Logger, models.Model):
     """Just a common base model doing some mixins and stuff."""
@@ -95,9 +428,16 @@ class BaseModel(util.Logger, models.Model):
         define a method _log_entry that (at the least) will fill
         the corresponding log entry reference field (see LogEntry
         model for details)."""
-        l = LogEntry(message=message, type=type, details=details, user=user)
+        l = LogEntry(message=message, type=type, user=user)
+        l.set_details(details)
         self._log_entry(l)
-        l.save()
+
+        buffer = LogBuffer.current()
+
+        if buffer is not None:
+            buffer.add(l)
+        else:
+            l.save()
 
         self.log.info('%s: %s', l.type, l.message)
 
@@ -105,7 +445,113 @@ class BaseModel(util.Logger, models.Model):
         abstract = True
 
 
-class Domain(BaseModel):
+def atomic_depth():
+    """Return the number of `transaction.atomic` blocks the current
+    thread is within."""
+    return (len(connection.savepoint_ids) +
+            (1 if connection.in_atomic_block else 0))
+
+
+class LogBuffer(util.Logger):
+    """Context manager collecting log entries created with
+    `BaseModel.log_entry` within it, and writing them to the database
+    with a single `bulk_create` when the context exits (also on
+    exceptions) or when `size` entries have been collected. Buffers
+    are per thread and may be nested, entries going to the innermost
+    one.
+
+    The entries written together share the same modification
+    sequence value. Entries are only written at the transaction
+    level the buffer was entered at: while within a transaction
+    started inside the buffer, entries are kept even past `size`, and
+    a buffer entered within a transaction passes its entries to an
+    enclosing buffer outside of it. The entries thus survive a
+    rollback of any transaction within the outermost buffer, so place
+    that buffer outside transactions (see `log_buffered`)."""
+
+    local = threading.local()
+
+    def __init__(self, size=LOG_BUFFER_SIZE):
+        super(LogBuffer, self).__init__()
+        self.size = size
+        self.entries = []
+        self.depth = 0
+
+    @classmethod
+    def stack(cls):
+        if not hasattr(cls.local, 'stack'):
+            cls.local.stack = []
+
+        return cls.local.stack
+
+    @classmethod
+    def current(cls):
+        """Return the innermost active buffer of this thread, or
+        None."""
+        stack = cls.stack()
+        return stack[-1] if stack else None
+
+    def add(self, entry):
+        self.entries.append(entry)
+
+        if len(self.entries) >= self.size and atomic_depth() <= self.depth:
+            self.flush()
+
+    def flush(self):
+        if not self.entries:
+            return
+
+        with transaction.atomic():
+            sequence = next_sequence()
+
+            for entry in self.entries:
+                entry.sequence = sequence
+
+            LogEntry.objects.bulk_create(self.entries)
+
+        self.entries = []
+
+    def __enter__(self):
+        self.depth = atomic_depth()
+        self.stack().append(self)
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.stack().remove(self)
+        outer = self.current()
+
+        if outer is not None and outer.depth < self.depth:
+            outer.entries.extend(self.entries)
+            self.entries = []
+            return False
+
+        if type is None:
+            self.flush()
+            return False
+
+        # Don't let a failed flush hide the original exception.
+        try:
+            self.flush()
+        except Exception:
+            self.log.exception('Could not write %d log entries',
+                               len(self.entries))
+
+        return False
+
+
+def log_buffered(func):
+    """Decorator running `func` within a `LogBuffer`. Apply it
+    outside of `transaction.atomic` to keep the log entries even if
+    the transaction is rolled back."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with LogBuffer():
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+class Domain(SequencedModel, BaseModel):
     """"Domain" is just a category for being one abstract "customer",
     holding many accounts. In the default mode with no authentication,
     there is only one domain, the "public" domain which doesn't have
@@ -140,7 +586,7 @@ class Domain(BaseModel):
             )
 
 
-class Account(BaseModel):
+class Account(SequencedModel, BaseModel):
     # TODO: We really would want to add the AWS account ID here as
     # unique key, but getting it via API is stricly not possible,
     # although via a workaround it is. See here:
@@ -169,7 +615,9 @@ class Account(BaseModel):
     # This may be a long-lived transaction, but it shouldn't matter
     # since there shouldn't be multiple updaters on an account during
     # refresh.
+    @log_buffered
     @transaction.atomic
+    @touch_buffered
     def refresh(self, aws, regions=None):
         """Refresh this account contents, updating list of tags,
         instances and EIPs in this account in the given `regions`. If
@@ -181,10 +629,21 @@ class Account(BaseModel):
         self.log.debug("refresh: %s, regions=%r", self, regions)
 
         total, added, deleted = 0, 0, 0
+        refreshed = 0
         started = timezone.now()
 
         for region in regions:
-            (t, a, d) = aws.refresh_region(self, region)
+            # An unavailable region is skipped (rolling back whatever
+            # was done in it) so that the rest can be refreshed.
+            try:
+                with transaction.atomic():
+                    (t, a, d) = aws.refresh_region(self, region)
+            except RegionUnavailable as ex:
+                self.log_entry('Skipped refreshing region %s' % (region,),
+                               details=unicode(ex), type='error')
+                continue
+
+            refreshed += 1
             self.updated = timezone.now()
 
             # Don't use .save() here, even as we're in atomic
@@ -223,11 +682,11 @@ class Account(BaseModel):
 
         # type switch to keep info level events relevant, "nothing
         # changed" isn't that
-        if len(regions):
+        if refreshed:
             self.log_entry(
                 'Refreshed %d regions in %.2f seconds, '
                 'total %d / added %d / deleted %d instances' % (
-                    len(regions),
+                    refreshed,
                     elapsed.seconds + elapsed.microseconds / 1e6,
                     total, added, deleted),
                 type=("info" if (added + deleted) > 0 else "verbose"))
@@ -235,17 +694,91 @@ class Account(BaseModel):
         # Go through projects that are 'init' state and see if they
         # have any picked or saved instances --- then we move them to
         # "running" state.
-        for project in self.projects.filter(state_actual='init'):
+        projects = list(self.projects.filter(state_actual='init'))
+        categories = self.categorize(projects) if projects else {}
+
+        for project in projects:
+            picked = categories[project.id]['picked']
             self.log.debug("Checking in-init-state project %r, "
                            "picked instances: %r",
-                           project, project.picked_instances)
-            if project.picked_instances:
+                           project, picked)
+            if picked:
                 project.log_entry(
                     'Moving {0} from initializing to running state'
                     .format(project))
 
                 project.save_state('running')
 
+    @log_buffered
+    @touch_buffered
+    def refresh_states(self, aws, regions=None, instances=None):
+        """Refresh only the states of the known instances of this
+        account in the given `regions` (by default `self.regions`),
+        removing instances that have gone away. This is much cheaper
+        than `refresh`, but does not find new instances or update
+        tags, and does not change `updated`.
+
+        If `instances` is given, only those instances (within
+        `regions`) are refreshed, see also Project.refresh_states."""
+        if regions is None:
+            regions = self.regions
+
+        self.log.debug("refresh_states: %s, regions=%r", self, regions)
+
+        by_region = None
+
+        if instances is not None:
+            by_region = {}
+
+            for instance in instances:
+                by_region.setdefault(instance.region, []).append(instance)
+
+        for region in regions:
+            if by_region is not None and region not in by_region:
+                continue
+
+            try:
+                with transaction.atomic():
+                    (t, c, d) = aws.refresh_states(
+                        self, region,
+                        by_region[region] if by_region is not None else None)
+            except RegionUnavailable as ex:
+                self.log_entry('Skipped refreshing region %s' % (region,),
+                               details=unicode(ex), type='error')
+                continue
+
+            self.log.debug('%s: Done state refresh of %s, t/c/d %d/%d/%d',
+                           self, region, t, c, d)
+
+    def categorize(self, projects=None):
+        """Categorize the instances of this account for all given
+        `projects` (all projects of the account by default), loading
+        the instances only once and sharing the evaluation of common
+        subexpressions between the projects' filters.
+
+        Returns a dict from project ids to their categories, see
+        Project.categorize."""
+        if projects is None:
+            projects = self.projects.all()
+
+        projects = list(projects)
+        regions = set(region for project in projects
+                      for region in project.regions)
+
+        # As in Project.filter_instances, use prefetched instances if
+        # available.
+        instances = self.instances.all()
+
+        if not is_prefetched(self, 'instances'):
+            instances = instances.filter(region__in=regions)
+
+        inventory = Inventory.for_instances(
+            instance for instance in instances
+            if instance.region in regions)
+
+        return {project.id: project.categorize(inventory)
+                for project in projects}
+
     @property
     def regions(self):
         """Returns list of regions that should be checked for this
@@ -271,6 +804,11 @@ class Account(BaseModel):
     def _log_entry(self, l):
         l.account = self
 
+    def touch_dependents(self, created):
+        # Domain lists its accounts
+        if created:
+            touch(Domain.objects.filter(pk=self.domain_id))
+
 
 class Tag(BaseModel):
     # Tag key
@@ -294,6 +832,12 @@ class InstanceTag(Tag):
     # And their tags have a value (which may be empty)
     value = models.CharField(max_length=TAG_VALUE_LENGTH_MAX)
 
+    class Meta:
+        unique_together = (('instance', 'key'),)
+
+        # Inverted index from tags to instances, see narrow_instances.
+        index_together = (('key', 'value'),)
+
     def __unicode__(self):
         return self.key + "=" + self.value
 
@@ -301,7 +845,7 @@ class InstanceTag(Tag):
         l.account = self.instance.account
 
 
-class Instance(BaseModel):
+class Instance(SequencedModel, BaseModel):
     # Which account this instances has been retrieved from.
     account = models.ForeignKey('Account', related_name='instances')
 
@@ -328,10 +872,23 @@ class Instance(BaseModel):
     # Current instance state
     state = models.CharField(max_length=30, choices=INSTANCE_STATE_CHOICES)
 
+    # When `state` was last observed to change, either by polling or
+    # from a state-change event. Events older than this are stale and
+    # ignored, see freezr.backend.events.update_states.
+    state_time = models.DateTimeField(null=True, blank=True, editable=False)
+
+    # Tags as a dict, kept in sync with InstanceTag rows (which are
+    # used for indexed lookups, see narrow_instances) so reading tags
+    # does not need a join.
+    tag_data = JSONField(default=dict, editable=False)
+
     def __init__(self, *args, **kwargs):
         super(Instance, self).__init__(*args, **kwargs)
         self._aws_instance = None
 
+        # As loaded, to tell whether saving changes project categories
+        self._categorization = self.categorization() if self.pk else None
+
     @property
     def aws_instance(self):
         """Last AWS instance record that was used to update this
@@ -367,9 +924,37 @@ class Instance(BaseModel):
             'type': self.type,
             'storage': self.store,
             'vpc': self.vpc_id,
-            'tags': {tag.key: tag.value for tag in self.tags.all()},
+            'tags': self.tag_data,
             }
 
+    def set_tags(self, tags):
+        """Set the tags of this (saved) instance to the `tags` dict,
+        updating both the tag rows and the tag data of this
+        instance. Returns True if the tags changed. Saving the
+        instance itself is left to the caller."""
+        if tags == self.tag_data:
+            return False
+
+        existing = {tag.key: tag for tag in self.tags.all()}
+        removed = [key for key in existing if key not in tags]
+
+        if removed:
+            self.tags.filter(key__in=removed).delete()
+
+        for key, value in tags.iteritems():
+            tag = existing.get(key)
+
+            if tag is not None and tag.value != value:
+                InstanceTag.objects.filter(pk=tag.pk).update(value=value)
+
+        InstanceTag.objects.bulk_create(
+            [self.new_tag(key=key, value=value)
+             for key, value in tags.iteritems() if key not in existing])
+
+        self.tag_data = dict(tags)
+        Instance.objects.filter(pk=self.pk).update(tag_data=self.tag_data)
+        return True
+
     def __hash__(self):
         return self.instance_id.__hash__()
 
@@ -379,18 +964,84 @@ class Instance(BaseModel):
     def _log_entry(self, l):
         l.account = self.account
 
+    def categorization(self):
+        """Return the attributes of this instance that project
+        instance categories depend on (see `environment`). The state
+        is not one of them."""
+        return (self.instance_id, self.region, self.type, self.store,
+                self.vpc_id, dict(self.tag_data or {}))
+
+    def touch_dependents(self, created):
+        # Account lists its instances, and project instance
+        # categories depend on the categorization attributes.
+        categorization = self.categorization()
+        changed = created or categorization != self._categorization
+        self._categorization = categorization
+
+        touch_account(self.account_id, account=created, projects=changed)
+
     @transaction.atomic
     def refresh(self, aws):
             aws.refresh_instance(self)
 
         # Do not do anything after this, we might have been deleted.
 
+    @transaction.atomic
+    def refresh_state(self, aws):
+        """Refresh only the state of this instance, see
+        Account.refresh_states."""
+        aws.refresh_states(self.account, self.region, [self])
+
+        # As above, we might have been deleted.
+
     class Meta:
         # Actually region + instance_id is unique, but we do not want
         # to leak information between domains. Conflicts within
         # domains are ok.
         unique_together = (('account', 'instance_id', 'region'))
 
+        # Indices for narrowing down instances by filter terms, see
+        # narrow_instances.
+        index_together = (('account', 'region'), ('account', 'type'),
+                          ('account', 'store'), ('account', 'vpc_id'))
+
+
+# Instance fields for filter variables.
+INSTANCE_VARIABLE_FIELDS = {
+    'region': 'region',
+    'storage': 'store',
+    'type': 'type',
+    'vpc': 'vpc_id',
+    }
+
+
+def narrow_instances(instances, f):
+    """Narrow down the `instances` queryset to those that may match
+    the filter `f`, using the tag and instance field indices for the
+    equality, membership and non-empty terms of its top-level
+    conjunction. The filter still needs to be evaluated on the
+    result."""
+    for value, literals in equality_terms(f.expression):
+        if isinstance(value, filter.Tag):
+            tags = InstanceTag.objects.filter(key=value.key)
+
+            if literals is None:
+                tags = tags.exclude(value='')
+            else:
+                tags = tags.filter(value__in=literals)
+
+            instances = instances.filter(id__in=tags.values('instance'))
+        else:
+            field = INSTANCE_VARIABLE_FIELDS[value.variable]
+
+            if literals is None:
+                instances = (instances.exclude(**{field + '__isnull': True})
+                             .exclude(**{field: ''}))
+            else:
+                instances = instances.filter(**{field + '__in': literals})
+
+    return instances
+
 
 class ElasticIp(BaseModel):
     # Which project this is from, note if multiple projects use the
@@ -406,14 +1057,14 @@ class ElasticIp(BaseModel):
 
 
 # Projects
-class Project(BaseModel):
+class Project(SequencedModel, BaseModel):
     # Project name
     name = models.CharField(max_length=255)
 
     # State of this project
     state_actual = models.CharField(
         max_length=30, choices=PROJECT_STATES_CHOICES,
-        default='init')
+        default='init', db_index=True)
 
     @property
     def state(self):
@@ -464,9 +1115,39 @@ class Project(BaseModel):
     # Terminate filter
     terminate_filter = models.TextField(blank=True, default='')
 
+    # Lease of the freeze or thaw operation in progress: id of the
+    # operation holding it and when it expires unless renewed.
+    operation_owner = models.CharField(max_length=32, blank=True, default='')
+    operation_expires = models.DateTimeField(null=True, blank=True)
+
+    # Plan of the freeze or thaw operation in progress: the state it
+    # was made for and digest of the categorization it is based on.
+    # The instances are in `plan_items`.
+    plan_state = models.CharField(max_length=30, blank=True, default='')
+    plan_digest = models.CharField(max_length=40, blank=True, default='')
+
     def __unicode__(self):
         return unicode(self.account) + "/" + self.name
 
+    def instance_filter(self, filter_text, filter_from=None,
+                        filter_not=None):
+        """Return the `Filter` for instances matching `filter_text`,
+        limited to those matching `filter_from` and not matching
+        `filter_not`. Returns None if `filter_text` is empty."""
+
+        if not filter_text or len(filter_text) == 0:
+            return None
+
+        f = filter.Filter.parse(filter_text)
+
+        if filter_from:
+            f = filter.Filter.parse(filter_from).AND(f)
+
+        if filter_not:
+            f = filter.Filter.parse(filter_not).NOT().AND(f)
+
+        return f
+
     def filter_instances(self, filter_text, filter_from=None, filter_not=None):
         """Return a list of instances that match the `filter_text`
         filter pattern under the account of this project.
@@ -477,47 +1158,124 @@ class Project(BaseModel):
         under an account you'd have to write an always-true statement
         like "region = region"."""
 
-        if not filter_text or len(filter_text) == 0:
+        f = self.instance_filter(filter_text, filter_from, filter_not)
+
+        if f is None:
             return []
 
-        f = filter.Filter.parse(filter_text)
+        f = f.optimize()
+
+        regions = set(self.regions)
+
+        # Use instances prefetched via the account
+        # if available, as when listing many projects.
+        instances = self.account.instances.all()
+
+        if not is_prefetched(self.account, 'instances'):
+            instances = narrow_instances(
+                instances.filter(region__in=regions), f)
+
+        return list(set(Inventory.for_instances(
+            instance for instance in instances
+            if instance.region in regions).filter(f)))
+
+    def explain(self):
+        """Profile the pick, save and terminate filters against the
+        instances of this project, evaluating them as
+        `filter_instances` does: the optimized filter over the
+        instances narrowed down by the indexes (see
+        `narrow_instances`), using an `Inventory`. Returns a dict of
+        the results for each filter (None for empty filters), see
+        Inventory.tree."""
+        instances = self.account.instances.filter(region__in=self.regions)
+        total = instances.count()
+        results = {}
+
+        for name, args in (
+                ('pick', (self.pick_filter,)),
+                ('save', (self.save_filter, self.pick_filter)),
+                ('terminate', (self.terminate_filter, self.pick_filter,
+                               self.save_filter))):
+            f = self.instance_filter(*args)
+
+            if f is None:
+                results[name] = None
+                continue
 
-        if filter_from:
-            f = filter.Filter.parse(filter_from).AND(f)
+            optimized = f.optimize()
+            inventory = Inventory.for_instances(
+                narrow_instances(instances, optimized))
+            inventory.profile()
+            matched = len(inventory.filter(optimized))
 
-        if filter_not:
-            f = filter.Filter.parse(filter_not).NOT().AND(f)
+            results[name] = {'filter': f.format(),
+                             'optimized': optimized.format(),
+                             'instances': total,
+                             'narrowed': inventory.count,
+                             'matched': matched,
+                             'tree': inventory.tree(optimized)}
+
+        return results
+
+    def categorize(self, inventory):
+        """Categorize instances in the `inventory` (see
+        freezr.core.inventory.Inventory) of this project's account.
+        Returns a dict with lists of `picked`, `saved`, `terminated`
+        and `skipped` instances, as given by the corresponding
+        properties."""
+        regions = inventory.evaluate(filter.Membership(
+            [filter.Variable('region'), 'in', self.regions]))
 
-        picked = set()
+        def select(*args):
+            f = self.instance_filter(*args)
 
-        for instance in self.account.instances.filter(region__in=self.regions):
-            #self.log.debug("filter: looking at %s with %r", instance,
-            #f.format())
-            if f.evaluate(instance.environment):
-                picked.add(instance)
+            if f is None:
+                return []
 
-        return list(picked)
+            return list(set(inventory.filter(f.optimize(), regions)))
 
-    # TODO: Think about caching some of these values internally, we
-    # probably hit DB repeatedly on same queries when determining
-    # different instance filter results.
+        picked = select(self.pick_filter)
+        saved = select(self.save_filter, self.pick_filter)
+        terminated = select(self.terminate_filter, self.pick_filter,
+                            self.save_filter)
+
+        return {'picked': picked,
+                'saved': saved,
+                'terminated': terminated,
+                'skipped': list(set(picked) - set(saved) - set(terminated))}
+
+    # Categories set by prefetch_categories, used instead of
+    # evaluating the filters on every access.
+    _categories = None
 
     @property
     def picked_instances(self):
+        if self._categories is not None:
+            return self._categories['picked']
+
         return self.filter_instances(self.pick_filter)
 
     @property
     def saved_instances(self):
+        if self._categories is not None:
+            return self._categories['saved']
+
         return self.filter_instances(self.save_filter, self.pick_filter)
 
     @property
     def terminated_instances(self):
+        if self._categories is not None:
+            return self._categories['terminated']
+
         return self.filter_instances(self.terminate_filter,
                                      filter_not=self.save_filter,
                                      filter_from=self.pick_filter)
 
     @property
     def skipped_instances(self):
+        if self._categories is not None:
+            return self._categories['skipped']
+
         return list(set(self.picked_instances)
                     - set(self.saved_instances)
                     - set(self.terminated_instances))
@@ -538,44 +1296,152 @@ class Project(BaseModel):
     def _log_entry(self, l):
         l.project = self
 
-    def freeze(self, aws):
+    def touch_dependents(self, created):
+        # Account lists its projects, and its regions are derived
+        # from project regions.
+        touch(Account.objects.filter(pk=self.account_id))
+
+    def make_plan(self, state):
+        """Plan the operation moving this project to `state`
+        ("freezing" or "thawing"), replacing any earlier plan. The
+        instances to terminate and stop (when freezing) or start (when
+        thawing) are fixed at this point, see `plan`."""
+        items, digest = self._plan_items(state)
+
+        with transaction.atomic():
+            self.plan_items.all().delete()
+            PlanItem.objects.bulk_create(items)
+            Project.objects.filter(pk=self.pk).update(plan_state=state,
+                                                      plan_digest=digest)
+
+        self.plan_state = state
+        self.plan_digest = digest
+
+    def _plan_items(self, state):
+        """Return the plan items for `state` from the current
+        inventory, and their digest over the filters and the planned
+        instances (but not their states, which change during the
+        operation)."""
+        if state == 'freezing':
+            picked_instances = set(self.picked_instances)
+            save_instances = set(self.saved_instances)
+            terminate_instances = set(self.terminated_instances)
+            skip_instances = set(self.skipped_instances)
+
+            self.log.debug("make_plan: self=%r picked_instances=%r "
+                           "save_instances=%r terminate_instances=%r "
+                           "skip_instances=%r",
+                           self, picked_instances, save_instances,
+                           terminate_instances, skip_instances)
+
+            # Sanity check. Should never happen, but .. this is the
+            # time to be paranoid, terminating instances that
+            # shouldn't be terminated is a bad thing.
+            assert((len(picked_instances -
+                        (save_instances | terminate_instances
+                         | skip_instances)) == 0),
+                   "some instances are not categorized at all")
+
+            assert len(save_instances & terminate_instances) == 0, \
+                "some instances are marked for both termination and saving"
+
+            assert len(skip_instances & terminate_instances) == 0, \
+                "some instances are marked for both termination and skipping"
+
+            actions = (('terminate', terminate_instances),
+                       ('stop', save_instances))
+        else:
+            actions = (('start', set(self.saved_instances)),)
+
+        items = [PlanItem(project=self, instance=instance,
+                          ec2_instance_id=instance.instance_id,
+                          action=action)
+                 for action, instances in actions
+                 for instance in sorted(instances, key=lambda i: i.id)]
+
+        digest = hashlib.sha1(json.dumps(
+            [state, self.pick_filter, self.save_filter,
+             self.terminate_filter,
+             [(item.action, item.instance.region, item.ec2_instance_id)
+              for item in items]])).hexdigest()
+
+        return items, digest
+
+    def check_plan(self, state):
+        """Check that the plan for `state` still matches the
+        inventory, planning again if not. Called when executing the
+        plan, after the instance states have been refreshed, so that
+        instances or filters changed since planning (e.g. while the
+        operation was queued) are not acted on with a stale plan.
+        Returns True if the plan was made again."""
+        if self.plan_state != state:
+            return False
+
+        items, digest = self._plan_items(state)
+
+        if digest == self.plan_digest:
+            return False
+
+        self.log_entry('Instances or filters changed since planning, '
+                       'planning again')
+        self.make_plan(state)
+        return True
+
+    def plan(self, state):
+        """Return the plan of the operation moving this project to
+        `state` as a dict of plan actions to lists of instances
+        (instances gone since planning are left out), making it first
+        if there is none. The plan is kept until the operation
+        completes, so that it is checked for completion against the
+        instances it was executed for even if the inventory changes
+        meanwhile (it is checked against the inventory only when
+        executed, see `check_plan`)."""
+        if self.plan_state != state:
+            self.make_plan(state)
+
+        plan = {action: [] for action in PLAN_ACTIONS}
+
+        for item in (self.plan_items.filter(instance__isnull=False)
+                     .select_related('instance')):
+            plan[item.action].append(item.instance)
+
+        return plan
+
+    def clear_plan(self):
+        if self.plan_state:
+            with transaction.atomic():
+                self.plan_items.all().delete()
+                Project.objects.filter(pk=self.pk).update(plan_state='',
+                                                          plan_digest='')
+
+            self.plan_state = self.plan_digest = ''
+
+    @log_buffered
+    def freeze(self, aws, operation=None):
+        """Freeze the project with `aws`. If run as `operation`, its
+        lease is renewed before changing each instance, and the freeze
+        stops if another operation has taken over (see
+        renew_operation)."""
         if self.state not in ('running', 'freezing'):
             return
 
         self.log_entry('Freezing project')
 
-        picked_instances = set(self.picked_instances)
-        save_instances = set(self.saved_instances)
-        terminate_instances = set(self.terminated_instances)
-        skip_instances = set(self.skipped_instances)
-
-        self.log.debug("freeze: self=%r picked_instances=%r "
-                       "save_instances=%r terminate_instances=%r "
-                       "skip_instances=%r",
-                       self, picked_instances, save_instances,
-                       terminate_instances, skip_instances)
-
-        # Sanity check. Should never happen, but .. this is the time
-        # to be paranoid, terminating instances that shouldn't be
-        # terminated is a bad thing.
-        assert((len(picked_instances -
-                    (save_instances | terminate_instances
-                     | skip_instances)) == 0),
-               "some instances are not categorized at all")
-
-        assert len(save_instances & terminate_instances) == 0, \
-            "some instances are marked for both termination and saving"
-
-        assert len(skip_instances & terminate_instances) == 0, \
-            "some instances are marked for both termination and skipping"
-
+        self.check_plan('freezing')
+        plan = self.plan('freezing')
         self.save_state('freezing')
 
-        for instance in terminate_instances:
+        for instance in plan['terminate']:
+            if not self.renew_operation(operation):
+                return
+
             self.log_entry('Terminating instance {0}'.format(instance))
             aws.terminate_instance(instance)
 
-        for instance in save_instances:
+        for instance in plan['stop']:
+            if not self.renew_operation(operation):
+                return
+
             self.log_entry('Freezing instance {0}'.format(instance))
             aws.freeze_instance(instance)
 
@@ -584,8 +1450,8 @@ class Project(BaseModel):
         self.log_entry(
             'Freezing project, terminating %d instances, '
             'stopping %d instances' % (
-                len(terminate_instances),
-                len(save_instances)))
+                len(plan['terminate']),
+                len(plan['stop'])))
 
         self.account.log_entry('Froze project %s' % (self,))
 
@@ -593,25 +1459,33 @@ class Project(BaseModel):
         # instance states even during the call.
         self.refresh()
 
-    def thaw(self, aws):
+    @log_buffered
+    def thaw(self, aws, operation=None):
+        """Thaw the project with `aws`, see `freeze`."""
         if self.state not in ('frozen', 'thawing'):
             return
 
         self.log_entry('Thawing project')
 
+        self.check_plan('thawing')
+        plan = self.plan('thawing')
+
         self.log.debug("Thawing project %s, instances: %r",
-                       self, self.saved_instances)
+                       self, plan['start'])
 
         self.save_state('thawing')
 
         saved_instances = []
 
-        for instance in self.saved_instances:
+        for instance in plan['start']:
             # Don't thaw instances that are actually running. User might
             # have added those manually to the environment after freeze.
             if instance.state != 'stopped':
                 continue
 
+            if not self.renew_operation(operation):
+                return
+
             self.log_entry('Thawing instance {0}'.format(instance))
             aws.thaw_instance(instance)
             saved_instances.append(instance)
@@ -626,22 +1500,83 @@ class Project(BaseModel):
         # instance states even during the call.
         self.refresh()
 
+    def acquire_operation(self, operation=None, force=False,
+                          lease=OPERATION_LEASE):
+        """Acquire the lease of the freeze or thaw operation on this
+        project for `operation` (a new operation if None), or renew it
+        if `operation` holds it already. Fails if another operation
+        holds an unexpired lease, unless `force` is true.
+
+        Returns the operation id, or None if the lease could not be
+        acquired. Operations renew their lease while they run, so
+        expired leases are those of operations that have been lost
+        (see the reissue_operations task)."""
+        operation = operation or uuid.uuid4().hex
+        now = timezone.now()
+        expires = now + timedelta(seconds=lease)
+        projects = Project.objects.filter(pk=self.pk)
+
+        if not force:
+            projects = projects.filter(
+                models.Q(operation_owner=operation) |
+                models.Q(operation_expires__isnull=True) |
+                models.Q(operation_expires__lte=now))
+
+        # Lease changes are not visible through the API, so they don't
+        # bump the sequence.
+        if not projects.update(operation_owner=operation,
+                               operation_expires=expires):
+            return None
+
+        self.operation_owner = operation
+        self.operation_expires = expires
+        return operation
+
+    def renew_operation(self, operation):
+        """Renew the lease of `operation` (if not None), returning
+        False if another operation has taken over. Long freezes and
+        thaws renew their lease while changing instances so that it
+        does not expire while they are still running."""
+        if operation is None or self.acquire_operation(operation):
+            return True
+
+        self.log.info('Operation %s on %r superseded', operation, self)
+        return False
+
+    def release_operation(self, operation):
+        """Release the lease held by `operation`, if it still holds
+        it."""
+        if (Project.objects.filter(pk=self.pk, operation_owner=operation)
+                .update(operation_owner='', operation_expires=None)):
+            self.operation_owner = ''
+            self.operation_expires = None
+
+    def refresh_states(self, aws):
+        """Refresh the states of the instances picked by this project
+        in its regions, see Account.refresh_states. Used around freeze
+        and thaw so that they do not wait for the rest of the
+        account."""
+        refresh_picked_states(aws, [self])
+
     def refresh(self):
         """Refresh project state. Calling this is useful only if the
         project is in a transitioning state, in which case it will
         check if it can change to a final state.
 
-        E.g. if 'freezing', will move to 'frozen' if terminated
-        instances have been terminated and saved ones
-        stopped. Similarly for 'thawing'."""
+        E.g. if 'freezing', will move to 'frozen' if the instances
+        planned to be terminated have been terminated and those to be
+        stopped stopped (see `plan`). Similarly for 'thawing'."""
 
         def seconds():
             delta = timezone.now() - self.state_updated
             return delta.seconds + delta.microseconds / 1e6
 
-        self.log.debug("refresh: state=%r, saved=%r, terminated=%r",
-                       self.state,
-                       self.saved_instances, self.terminated_instances)
+        if self.state not in ('freezing', 'thawing'):
+            return
+
+        plan = self.plan(self.state)
+
+        self.log.debug("refresh: state=%r, plan=%r", self.state, plan)
 
         # IMPORTANT! Although refresh_account *will* remove terminated
         # instances from the database, it is possible that the
@@ -650,24 +1585,47 @@ class Project(BaseModel):
         # pop up in here (in rare cases).
 
         if ((self.state == 'freezing' and
-             all(i.state == 'terminated'
-                 for i in self.terminated_instances) and
-             all(i.state == 'stopped' for i in self.saved_instances))):
+             all(i.state == 'terminated' for i in plan['terminate']) and
+             all(i.state == 'stopped' for i in plan['stop']))):
             self.log_entry('Project frozen (%.1fs elapsed)' % (seconds()))
             self.save_state('frozen')
+            self.clear_plan()
 
         if ((self.state == 'thawing' and
-             all(i.state == 'running' for i in self.saved_instances))):
+             all(i.state == 'running' for i in plan['start']))):
             self.log_entry('Project thawed (%.1fs elapsed)' % (seconds()))
             self.save_state('running')
+            self.clear_plan()
 
     class Meta:
+        # For finding operations with expired leases
+        index_together = (('state_actual', 'operation_expires'),)
+
         permissions = (
             ('freeze_project', 'Can freeze linked project assets'),
             ('thaw_project', 'Can thaw linked project assets'),
             )
 
 
+class PlanItem(models.Model):
+    """Instance acted on by the freeze or thaw operation of a
+    project, see Project.plan."""
+    project = models.ForeignKey('Project', related_name='plan_items',
+                                on_delete=models.CASCADE)
+
+    # Null if the instance has been removed since planning
+    instance = models.ForeignKey('Instance', related_name='plan_items',
+                                 null=True, on_delete=models.SET_NULL)
+
+    # EC2 instance id, kept for reference even if `instance` is gone
+    ec2_instance_id = models.CharField(max_length=30)
+
+    action = models.CharField(max_length=10, choices=PLAN_ACTIONS_CHOICES)
+
+    def __unicode__(self):
+        return "{0} {1}".format(self.action, self.ec2_instance_id)
+
+
 class ProjectGroupRelation(BaseModel):
     """Relation object telling what permission is connected to which
     Django Group object. This allows us to attach permissions to
@@ -698,13 +1656,67 @@ class ProjectGroupRelation(BaseModel):
         l.project = self.project
 
 
-class LogEntry(models.Model):
+class LogDetails(models.Model):
+    """Log entry details, stored compressed and only once for each
+    distinct text. Recurring errors write the same multi-kilobyte
+    tracebacks over and over again, with these they cost only a log
+    entry referring to the details and a bump of `count`."""
+
+    # SHA-1 of the normalized text (see `digest`)
+    digest = models.CharField(max_length=40, unique=True)
+
+    # zlib-compressed UTF-8 text, as first seen
+    data = models.BinaryField()
+
+    # Number of times these details have been logged, and when
+    count = models.PositiveIntegerField(default=0)
+    first_seen = models.DateTimeField(default=timezone.now)
+    last_seen = models.DateTimeField(default=timezone.now)
+
+    def __unicode__(self):
+        return "{0} ({1} times)".format(self.digest, self.count)
+
+    @property
+    def text(self):
+        return zlib.decompress(self.data).decode('utf-8')
+
+    @staticmethod
+    def digest_of(text):
+        """Return the digest of `text`, ignoring object addresses."""
+        return hashlib.sha1(
+            ADDRESS_RE.sub('0x?', text).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def store(cls, text):
+        """Return the details object for `text`, creating it if
+        necessary and counting the occurrence."""
+        if isinstance(text, str):
+            text = text.decode('utf-8', 'replace')
+
+        details, created = cls.objects.get_or_create(
+            digest=cls.digest_of(text),
+            defaults={'data': zlib.compress(text.encode('utf-8'))})
+
+        now = timezone.now()
+        cls.objects.filter(pk=details.pk).update(
+            count=models.F('count') + 1, last_seen=now)
+        details.count += 1
+        details.last_seen = now
+
+        return details
+
+    class Meta:
+        verbose_name_plural = "log details"
+
+
+class LogEntry(SequencedModel):
     # Entry type
     type = models.CharField(max_length=10, default='info',
                             choices=LOG_ENTRY_TYPES_CHOICES)
 
-    # Entry time
-    time = models.DateTimeField(auto_now_add=True)
+    # Entry time, set on creation rather than on save as entries may
+    # be saved later in bulk (see `LogBuffer`)
+    time = models.DateTimeField(default=timezone.now, editable=False)
 
     # User who initiated the action, if applicable (may be null for
     # scheduled tasks, for example)
@@ -715,8 +1727,12 @@ class LogEntry(models.Model):
     # Main entry message text, should never be empty
     message = models.TextField()
 
-    # Additional details, may be empty
+    # Additional details, may be empty. Long details are stored in
+    # `stored_details` instead, see `set_details` and `get_details`.
     details = models.TextField(blank=True, null=True)
+    stored_details = models.ForeignKey(LogDetails, blank=True, null=True,
+                                       related_name="log_entries",
+                                       on_delete=models.SET_NULL)
 
     # System error flag .. this is used for two things, first, system
     # errors are not normally shown for regular users, and
@@ -743,6 +1759,22 @@ class LogEntry(models.Model):
                                            (self.domain or self.account
                                             or self.project))
 
+    def set_details(self, details):
+        """Set details of this entry, storing long details as
+        `LogDetails`."""
+        if details is not None and len(details) > LOG_DETAILS_INLINE_MAX:
+            self.details = None
+            self.stored_details = LogDetails.store(details)
+        else:
+            self.details = details
+            self.stored_details = None
+
+    def get_details(self):
+        if self.stored_details_id is not None:
+            return self.stored_details.text
+
+        return self.details
+
     def set_object(self, obj):
         """Utility routine that tries to set `obj` to the correct slot,
         either `domain`, `account` or `project`. If none matches,
@@ -756,3 +1788,36 @@ class LogEntry(models.Model):
 
     class Meta:
         verbose_name_plural = "log entries"
+
+        # Log entries are listed per object, newest first.
+        index_together = (('domain', 'time'), ('account', 'time'),
+                          ('project', 'time'))
+
+
+@receiver(post_save, sender=InstanceTag)
+@receiver(post_delete, sender=InstanceTag)
+def update_tag_data(sender, instance, **kwargs):
+    """Keep Instance.tag_data in sync with individually saved and
+    deleted tags (Instance.set_tags does this by itself)."""
+    tags = dict(InstanceTag.objects.filter(instance=instance.instance_id)
+                .values_list('key', 'value'))
+    Instance.objects.filter(pk=instance.instance_id).update(tag_data=tags)
+
+    # Update also the instance object the tag was created from, if any.
+    cache_name = InstanceTag._meta.get_field('instance').get_cache_name()
+    tagged = getattr(instance, cache_name, None)
+
+    if tagged is not None:
+        tagged.tag_data = tags
+
+
+@receiver(post_delete, sender=Domain)
+@receiver(post_delete, sender=Account)
+@receiver(post_delete, sender=Instance)
+@receiver(post_delete, sender=Project)
+def record_tombstone(sender, instance, **kwargs):
+    Tombstone(kind=sender._meta.model_name,
+              object_id=instance.pk,
+              sequence=next_sequence()).save()
+
+    instance.touch_dependents(True)
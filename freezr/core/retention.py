@@ -0,0 +1,209 @@
+"""Retention of log entries and tombstones.
+
+Without this, log entries would accumulate forever -- every account
+refresh adds a "verbose" entry. Old entries are handled in two ways,
+configured per entry type in settings:
+
+- `FREEZR_LOG_ROLLUP` maps types to the age after which the entries
+  of the type are rolled up: on each day, similar entries (entries of
+  the same object whose messages differ only by numbers, like the
+  "Refreshed N regions" entries) are replaced by a single summary
+  entry.
+- `FREEZR_LOG_RETENTION` maps types to the age after which the
+  entries of the type are deleted altogether. Types not listed are
+  kept forever.
+
+If `FREEZR_LOG_ARCHIVE_DIR` is set, rolled up and deleted entries
+(along with their stored details) are first written there as
+gzip-compressed JSON fixtures, which can be loaded back with
+`manage.py loaddata` if needed. Stored details no longer referred to
+by any entry are deleted.
+
+Entries are processed in chunks of `CHUNK_SIZE`, each in its own
+transaction, so that the log entry table is not locked for long. See
+the `expire_log_entries` task.
+
+Tombstones of deleted objects (see `freezr.core.models.Tombstone`)
+older than `FREEZR_TOMBSTONE_RETENTION` are deleted too, see
+`expire_tombstones`."""
+
+from __future__ import absolute_import
+from django.conf import settings
+from django.core import serializers
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from datetime import timedelta
+from .models import LogDetails, LogEntry, Tombstone
+import gzip
+import logging
+import os
+import re
+
+log = logging.getLogger('freezr.retention')
+
+# Number of log entries to archive and delete at a time.
+CHUNK_SIZE = 1000
+
+# Numbers in log messages, ignored when looking for similar entries.
+NUMBER_RE = re.compile(r'\d+(\.\d+)?')
+
+# Fields identifying the object a log entry belongs to.
+OWNER_FIELDS = ('domain_id', 'account_id', 'project_id')
+
+
+def archive_log_entries(entries, directory=None):
+    """Write `entries` to a compressed JSON fixture file in
+    `directory` (by default `FREEZR_LOG_ARCHIVE_DIR`), returning the
+    file name, or None if archiving is not enabled."""
+    if directory is None:
+        directory = settings.FREEZR_LOG_ARCHIVE_DIR
+
+    if not directory or not entries:
+        return None
+
+    ids = [entry.id for entry in entries]
+    filename = os.path.join(directory, 'log-entries-%d-%d.json.gz' % (
+        min(ids), max(ids)))
+
+    details = list(LogDetails.objects.filter(
+        id__in=set(entry.stored_details_id for entry in entries)))
+    stream = gzip.open(filename, 'wb')
+
+    try:
+        serializers.serialize('json', details + entries, stream=stream)
+    finally:
+        stream.close()
+
+    log.debug('Archived %d log entries to %s', len(entries), filename)
+    return filename
+
+
+def delete_log_entries(queryset):
+    """Archive and delete log entries in `queryset` in chunks,
+    returning the number of entries deleted."""
+    deleted = 0
+
+    while True:
+        ids = list(queryset.order_by('id')
+                   .values_list('id', flat=True)[:CHUNK_SIZE])
+
+        if not ids:
+            return deleted
+
+        archive_log_entries(list(LogEntry.objects.filter(id__in=ids)
+                                 .order_by('id')))
+
+        with transaction.atomic():
+            LogEntry.objects.filter(id__in=ids).delete()
+
+        deleted += len(ids)
+
+
+def expire_log_entries(now=None):
+    """Delete log entries older than their retention period, returning
+    the number of entries deleted."""
+    now = now or timezone.now()
+    deleted = 0
+
+    for type, age in settings.FREEZR_LOG_RETENTION.items():
+        deleted += delete_log_entries(
+            LogEntry.objects.filter(type=type, time__lt=now - age))
+
+    if deleted:
+        log.info('Expired %d log entries', deleted)
+
+        # Drop details only referred to by the deleted entries.
+        LogDetails.objects.filter(log_entries__isnull=True).delete()
+
+    return deleted
+
+
+def expire_tombstones(now=None):
+    """Delete tombstones older than `FREEZR_TOMBSTONE_RETENTION`,
+    moving the tombstone horizon (see Tombstone) past them. Returns
+    the number of tombstones deleted."""
+    now = now or timezone.now()
+
+    with transaction.atomic():
+        expired = (Tombstone.objects.exclude(kind=Tombstone.HORIZON)
+                   .filter(time__lt=now - settings.FREEZR_TOMBSTONE_RETENTION))
+        latest = expired.aggregate(Max('sequence'))['sequence__max']
+
+        if latest is None:
+            return 0
+
+        deleted = expired.count()
+        expired.delete()
+
+        horizon = Tombstone.horizon()
+        Tombstone.objects.filter(kind=Tombstone.HORIZON).delete()
+        Tombstone(kind=Tombstone.HORIZON, object_id=0,
+                  sequence=max(horizon, latest), time=now).save()
+
+    log.info('Expired %d tombstones', deleted)
+    return deleted
+
+
+def similarity_key(entry):
+    """Return a key that is the same for entries which can be rolled
+    up into one."""
+    return (tuple(getattr(entry, field) for field in OWNER_FIELDS) +
+            (entry.type, entry.user_id, NUMBER_RE.sub('#', entry.message)))
+
+
+def rollup_day(entries):
+    """Replace groups of similar entries among `entries` (all from the
+    same day) with summary entries, returning the number of entries
+    removed."""
+    groups = {}
+
+    for entry in entries:
+        groups.setdefault(similarity_key(entry), []).append(entry)
+
+    removed = []
+
+    for group in groups.itervalues():
+        if len(group) < 2:
+            continue
+
+        first, last = group[0], group[-1]
+        archive_log_entries(group)
+
+        with transaction.atomic():
+            LogEntry.objects.filter(id__in=[e.id for e in group]).delete()
+            LogEntry(type=last.type, time=last.time, user_id=last.user_id,
+                     domain_id=last.domain_id, account_id=last.account_id,
+                     project_id=last.project_id,
+                     message='{0} ({1} similar entries since {2:%H:%M})'
+                     .format(last.message, len(group), first.time),
+                     details=last.details,
+                     stored_details_id=last.stored_details_id).save()
+
+        removed.extend(group[1:])
+
+    return len(removed)
+
+
+def rollup_log_entries(now=None):
+    """Roll up similar log entries of the types and ages given in
+    `FREEZR_LOG_ROLLUP` into one entry per day, returning the number
+    of entries removed. Only whole days are rolled up."""
+    now = timezone.localtime(now or timezone.now())
+    removed = 0
+
+    for type, age in settings.FREEZR_LOG_ROLLUP.items():
+        end = (now - age).replace(hour=0, minute=0, second=0,
+                                  microsecond=0)
+        queryset = LogEntry.objects.filter(type=type, time__lt=end)
+
+        for day in queryset.datetimes('time', 'day'):
+            removed += rollup_day(
+                queryset.filter(time__gte=day,
+                                time__lt=day + timedelta(days=1))
+                .order_by('time', 'id'))
+
+    if removed:
+        log.info('Rolled up %d log entries', removed)
+
+    return removed
@@ -3,7 +3,10 @@ from django import test
 import logging
 import time
 from freezr.core.models import Account, Domain, Project, Instance
+from freezr.backend.breaker import RegionUnavailable
 from django.db.models import Q
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
 from .util import AwsMock, FreezrTestCaseMixin
 
 log = logging.getLogger(__file__)
@@ -59,6 +62,30 @@ class TestAccount(FreezrTestCaseMixin, test.TestCase):
         self.assertEqual(8, len(self.account.regions))
         self.assertEqual(3, self.account.projects.count())
 
+    def testUnavailableRegion(self):
+        class FailingAwsMock(AwsMock):
+            def refresh_region(self, account, region):
+                super(FailingAwsMock, self).refresh_region(account, region)
+
+                if region == 'b':
+                    # changes in the skipped region are rolled back
+                    account.new_instance(instance_id='i-1', region=region,
+                                         type='m1.small').save()
+                    raise RegionUnavailable(region, 'timed out')
+
+                return (1, 0, 0)
+
+        Project(name="Test project", account=self.account,
+                regions="a,b,c").save()
+
+        self.account.refresh(aws=FailingAwsMock())
+        self.assertEqual(0, self.account.instances.count())
+        self.assertIsNotNone(self.account.updated)
+        entries = dict((l.type, l.message)
+                       for l in self.account.log_entries.all())
+        self.assertEqual('Skipped refreshing region b', entries['error'])
+        self.assertTrue(entries['verbose'].startswith('Refreshed 2 regions'))
+
     def testAccountNewInstance(self):
         # test instance creation via account instance
         self.account.new_instance(instance_id="123", type="small",
@@ -73,6 +100,42 @@ class TestAccount(FreezrTestCaseMixin, test.TestCase):
         self.assertEqual("a", i.store)
         self.assertEqual("running", i.state)
 
+    def testInstanceTags(self):
+        i = self.instance(tag_Name='one', tag_env='test')
+        self.assertEqual(i.tag_data, {'Name': 'one', 'env': 'test'})
+        self.assertEqual(Instance.objects.get(pk=i.pk).tag_data,
+                         {'Name': 'one', 'env': 'test'})
+
+        self.assertFalse(i.set_tags({'Name': 'one', 'env': 'test'}))
+        self.assertTrue(i.set_tags({'Name': 'two', 'new': ''}))
+
+        for instance in (i, Instance.objects.get(pk=i.pk)):
+            self.assertEqual(instance.tag_data, {'Name': 'two', 'new': ''})
+            self.assertEqual({t.key: t.value for t in instance.tags.all()},
+                             {'Name': 'two', 'new': ''})
+
+        i.tags.get(key='new').delete()
+        self.assertEqual(Instance.objects.get(pk=i.pk).tag_data,
+                         {'Name': 'two'})
+
+    def testUpgradeTagData(self):
+        i = self.instance(tag_Name='one')
+        Instance.objects.update(tag_data={})
+
+        call_command('upgrade', verbosity=0)
+        self.assertEqual(Instance.objects.get(pk=i.pk).tag_data,
+                         {'Name': 'one'})
+
+        # and it can be run again
+        call_command('upgrade', verbosity=0)
+
+    def testUniqueTags(self):
+        i = self.instance(tag_Name='one')
+
+        with transaction.atomic():
+            self.assertRaises(IntegrityError,
+                              i.new_tag(key='Name', value='two').save)
+
     def testAccountInstances(self):
         # test multiple instances already in db show up correctly in
         # account
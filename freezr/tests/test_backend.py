@@ -0,0 +1,381 @@
+from django import test
+import logging
+from freezr.backend import BackendPool
+from freezr.backend.aws import AwsInterface, InstanceBatch
+import freezr.backend.aws as aws_module
+from freezr.backend.breaker import breaker, RegionUnavailable, THRESHOLD
+from freezr.backend.ratelimit import RateLimiter, BACKOFF_RETRIES
+from freezr.core.models import Account, Domain
+from .util import AwsMock, AttrDict, FreezrTestCaseMixin
+import boto.exception
+import socket
+
+log = logging.getLogger(__file__)
+
+
+class PoolableAwsMock(AwsMock):
+    poolable = True
+
+    def __init__(self, access_key=None, secret_key=None):
+        super(PoolableAwsMock, self).__init__()
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.disconnected = False
+
+    def disconnect(self):
+        self.disconnected = True
+
+
+class TestBackendPool(test.TestCase):
+    @test.utils.override_settings(FREEZR_CLOUD_BACKEND=PoolableAwsMock)
+    def testReuse(self):
+        pool = BackendPool()
+
+        with pool.backend('a', 'secret') as first:
+            # in use, so not handed out again
+            with pool.backend('a', 'secret') as second:
+                self.assertIsNot(first, second)
+
+            with pool.backend('b', 'secret') as other:
+                self.assertIsNot(second, other)
+
+        with pool.backend('a', 'secret') as aws:
+            self.assertIn(aws, (first, second))
+            self.assertEqual(('a', 'secret'), (aws.access_key,
+                                               aws.secret_key))
+
+        self.assertEqual({'created': 3, 'reused': 1, 'expired': 0,
+                          'invalidated': 0, 'discarded': 0, 'idle': 3},
+                         pool.stats())
+
+        # changed secret key invalidates pooled backends
+        with pool.backend('a', 'changed') as aws:
+            self.assertEqual('changed', aws.secret_key)
+
+        self.assertEqual(2, pool.stats()['invalidated'])
+
+        # failures discard the backend
+        try:
+            with pool.backend('b', 'secret') as aws:
+                raise ValueError()
+        except ValueError:
+            pass
+
+        self.assertTrue(aws.disconnected)
+        self.assertEqual(1, pool.stats()['discarded'])
+        self.assertEqual(1, pool.stats()['idle'])
+
+    @test.utils.override_settings(FREEZR_CLOUD_BACKEND=PoolableAwsMock)
+    def testExpiry(self):
+        pool = BackendPool(ttl=-1)
+
+        with pool.backend('a', 'secret') as first:
+            pass
+
+        with pool.backend('a', 'secret') as second:
+            self.assertIsNot(first, second)
+
+        self.assertEqual(1, pool.stats()['expired'])
+
+    @test.utils.override_settings(FREEZR_CLOUD_BACKEND=AwsMock)
+    def testNotPoolable(self):
+        pool = BackendPool()
+
+        with pool.backend('a', 'secret') as first:
+            pass
+
+        with pool.backend('a', 'secret') as second:
+            self.assertIsNot(first, second)
+
+        self.assertEqual(0, pool.stats()['idle'])
+
+
+class Throttled(Exception):
+    error_code = 'RequestLimitExceeded'
+
+
+class TestRateLimiter(test.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.sleeps = []
+        self.limiter = RateLimiter()
+        self.limiter.time = lambda: self.now
+        self.limiter.sleep = self.sleep
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    @test.utils.override_settings(FREEZR_RATE_LIMIT=2, FREEZR_RATE_LIMITS={
+        'StopInstances': 3})
+    def testLimit(self):
+        def call(action, region='a'):
+            return self.limiter.call('limit', region, action, lambda: 1)
+
+        for n in range(2):
+            self.assertEqual(1, call('StartInstances'))
+
+        self.assertEqual([], self.sleeps)
+
+        # other actions and regions are counted separately
+        for n in range(3):
+            call('StopInstances')
+            call('StartInstances', region='b')
+
+        self.assertEqual(1, len(self.sleeps))
+        self.assertEqual(1001, int(self.now))
+
+        # third call within a second waits for the next second
+        call('StartInstances')
+        call('StartInstances')
+        self.assertEqual(1, len(self.sleeps))
+
+        call('StartInstances')
+        self.assertEqual(2, len(self.sleeps))
+        self.assertEqual(1002, int(self.now))
+
+        stats = self.limiter.stats()
+        self.assertEqual(11, stats['calls'])
+        self.assertEqual(2, stats['waited'])
+        self.assertAlmostEqual(sum(self.sleeps), stats['wait_time'])
+
+    def testBackoff(self):
+        calls = []
+
+        def throttled(fail):
+            calls.append(fail)
+
+            if len(calls) <= fail:
+                raise Throttled()
+
+            return len(calls)
+
+        self.assertEqual(3, self.limiter.call('backoff', 'a', 'Start',
+                                              throttled, 2))
+        self.assertEqual(2, len(self.sleeps))
+        self.assertTrue(self.sleeps[0] < self.sleeps[1])
+
+        del calls[:]
+        self.assertRaises(Throttled, self.limiter.call, 'backoff', 'a',
+                          'Start', throttled, 100)
+        self.assertEqual(BACKOFF_RETRIES + 1, len(calls))
+
+        # other errors are not retried
+        del calls[:]
+        self.assertRaises(ValueError, self.limiter.call, 'backoff', 'a',
+                          'Start', int, 'x')
+
+        stats = self.limiter.stats()
+        self.assertEqual(2 + BACKOFF_RETRIES + 1, stats['throttled'])
+        self.assertEqual(1, stats['failed'])
+
+
+class TestCircuitBreaker(test.TestCase):
+    def setUp(self):
+        breaker.reset('good')
+        breaker.reset('bad')
+
+        self.calls = []
+        self.aws = AwsInterface()
+        self.aws.conns = {'good': self, 'bad': self}
+
+    def get_only_instances(self, fail=False):
+        self.calls.append(fail)
+
+        if fail:
+            raise socket.timeout('timed out')
+
+        return []
+
+    def testBreaker(self):
+        for n in range(THRESHOLD):
+            self.assertRaises(RegionUnavailable, self.aws.call, 'bad',
+                              'DescribeInstances', 'get_only_instances',
+                              fail=True)
+
+        self.assertEqual(THRESHOLD, len(self.calls))
+        self.assertTrue(breaker.is_open('bad'))
+
+        # now fails without calling
+        self.assertRaises(RegionUnavailable, self.aws.call, 'bad',
+                          'DescribeInstances', 'get_only_instances')
+        self.assertEqual(THRESHOLD, len(self.calls))
+
+        # other regions work
+        self.assertEqual([], self.aws.call('good', 'DescribeInstances',
+                                           'get_only_instances'))
+        self.assertFalse(breaker.is_open('good'))
+
+        breaker.reset('bad')
+        self.assertEqual([], self.aws.call('bad', 'DescribeInstances',
+                                           'get_only_instances'))
+
+    def testSuccessResets(self):
+        for n in range(THRESHOLD * 2):
+            if n % THRESHOLD == THRESHOLD - 1:
+                self.aws.call('bad', 'DescribeInstances',
+                              'get_only_instances')
+            else:
+                self.assertRaises(RegionUnavailable, self.aws.call, 'bad',
+                                  'DescribeInstances', 'get_only_instances',
+                                  fail=True)
+
+        self.assertFalse(breaker.is_open('bad'))
+
+
+class StatusSet(list):
+    next_token = None
+
+
+class TestStateRefresh(FreezrTestCaseMixin, test.TestCase):
+    def setUp(self):
+        breaker.reset('us-east-1')
+
+        self.domain = Domain(name="test", domain=".test")
+        self.domain.save()
+        self.account = Account(domain=self.domain, name="test",
+                               access_key="1234", secret_key="abcd")
+        self.account.save()
+
+        self.states = {'i-1': 'running', 'i-2': 'stopped',
+                       'i-3': 'terminated', 'i-5': 'running'}
+        self.requests = []
+        self.aws = AwsInterface()
+        self.aws.conns = {'us-east-1': self}
+
+    def build_list_params(self, params, items, label):
+        for n, item in enumerate(items):
+            params['%s.%d' % (label, n + 1)] = item
+
+    def get_object(self, action, params, cls, verb):
+        self.requests.append(dict(params))
+        ids = [v for k, v in params.items() if k.startswith('InstanceId.')]
+
+        if any(id not in self.states for id in ids):
+            raise boto.exception.EC2ResponseError(
+                400, 'Bad Request', '<Response><Errors><Error><Code>'
+                'InvalidInstanceID.NotFound</Code></Error></Errors>'
+                '</Response>')
+
+        result = StatusSet(AttrDict(id=id, state_name=state)
+                           for id, state in sorted(self.states.items())
+                           if not ids or id in ids)
+        return result
+
+    def testRefreshStates(self):
+        for n in range(1, 5):
+            self.instance(instance_id='i-%d' % (n,), state='pending',
+                          tag_Name='x')
+
+        self.assertEqual((2, 2, 2), self.aws.refresh_states(
+            self.account, 'us-east-1'))
+
+        self.assertEqual(
+            [('i-1', 'running', {'Name': 'x'}),
+             ('i-2', 'stopped', {'Name': 'x'})],
+            [(i.instance_id, i.state, i.tag_data) for i in
+             self.account.instances.order_by('instance_id')])
+
+        # i-4 was not found, so all instances were described
+        self.assertEqual(2, len(self.requests))
+        self.assertEqual('true', self.requests[0]['IncludeAllInstances'])
+        self.assertIn('InstanceId.4', self.requests[0])
+        self.assertNotIn('InstanceId.1', self.requests[1])
+
+        # nothing changes now
+        self.assertEqual((2, 0, 0), self.aws.refresh_states(
+            self.account, 'us-east-1'))
+        self.assertEqual(3, len(self.requests))
+
+
+class TestInstanceBatch(test.TestCase):
+    class Connection(object):
+        def __init__(self, region, requests):
+            self.region = region
+            self.requests = requests
+
+        def __getattr__(self, method):
+            def call(instance_ids):
+                self.requests.append((self.region, method, instance_ids))
+
+                if 'i-bad' in instance_ids:
+                    raise boto.exception.EC2ResponseError(
+                        400, 'Bad Request', '<Response><Errors><Error><Code>'
+                        'OperationNotPermitted</Code></Error></Errors>'
+                        '</Response>')
+
+            return call
+
+    def setUp(self):
+        self.requests = []
+        self.aws = AwsInterface()
+        self.aws.conns = {region: self.Connection(region, self.requests)
+                          for region in ('us-east-1', 'eu-west-1')}
+        self.saved_batch_size = aws_module.CHANGE_BATCH_SIZE
+        aws_module.CHANGE_BATCH_SIZE = 2
+
+        for region in self.aws.conns:
+            breaker.reset(region)
+
+    def tearDown(self):
+        aws_module.CHANGE_BATCH_SIZE = self.saved_batch_size
+
+    def testBatch(self):
+        batch = InstanceBatch(self.aws)
+
+        for n, (region, state) in enumerate(
+                [('us-east-1', 'running')] * 3 +
+                [('eu-west-1', 'running'), ('eu-west-1', 'stopped')]):
+            batch.freeze_instance(AttrDict(instance_id='i-%d' % (n,),
+                                           region=region, state=state))
+
+        batch.terminate_instance(AttrDict(instance_id='i-9',
+                                          region='us-east-1',
+                                          state='running'))
+        self.assertEqual([], self.requests)
+
+        batch.flush()
+
+        self.assertEqual(
+            [('us-east-1', 'terminate_instances', ['i-9']),
+             ('eu-west-1', 'stop_instances', ['i-3']),
+             ('us-east-1', 'stop_instances', ['i-0', 'i-1']),
+             ('us-east-1', 'stop_instances', ['i-2'])],
+            self.requests)
+
+        # nothing left
+        batch.flush()
+        self.assertEqual(4, len(self.requests))
+
+    def testBatchErrors(self):
+        batch = InstanceBatch(self.aws)
+        instances = [AttrDict(instance_id=instance_id, region=region,
+                              state='running')
+                     for instance_id, region in (('i-0', 'us-east-1'),
+                                                 ('i-bad', 'us-east-1'),
+                                                 ('i-2', 'us-east-1'),
+                                                 ('i-3', 'eu-west-1'))]
+
+        for n, instance in enumerate(instances):
+            batch.project = 'project-%d' % (n % 2,)
+            batch.freeze_instance(instance)
+
+        failures = batch.flush()
+
+        # the failing call is retried one by one, others are unaffected
+        self.assertEqual(
+            [('eu-west-1', 'stop_instances', ['i-3']),
+             ('us-east-1', 'stop_instances', ['i-0', 'i-bad']),
+             ('us-east-1', 'stop_instances', ['i-0']),
+             ('us-east-1', 'stop_instances', ['i-bad']),
+             ('us-east-1', 'stop_instances', ['i-2'])],
+            self.requests)
+
+        self.assertEqual([('project-1', 'stop', instances[1])],
+                         [f[:3] for f in failures])
+        self.assertIsInstance(failures[0][3],
+                              boto.exception.EC2ResponseError)
+
+        # without error handling the error is raised
+        with self.assertRaises(boto.exception.EC2ResponseError):
+            self.aws.change_instances('stop', instances[1:2])
@@ -0,0 +1,311 @@
+from __future__ import absolute_import
+import logging
+from freezr.api import views
+from freezr.core import models
+from freezr.core.models import (Account, Domain, Project, Instance,
+                                LogEntry, Tombstone, TouchBuffer,
+                                current_sequence, next_sequence)
+from rest_framework import test
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection, DatabaseError
+
+log = logging.getLogger(__file__)
+
+
+class TestChanges(test.APITestCase):
+    fixtures = ('rest_tests',)
+
+    def changes(self, cursor=None, **kwargs):
+        params = dict(kwargs)
+
+        if cursor is not None:
+            params['cursor'] = cursor
+            params.setdefault('timeout', 0)
+
+        response = self.client.get(reverse('changes'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def testInitialCursor(self):
+        data = self.changes()
+        self.assertEqual(data['cursor'], current_sequence())
+        self.assertEqual(data['projects'], [])
+        self.assertEqual(data['instances'], [])
+        self.assertEqual(data['log_entries'], [])
+
+    def testNoChanges(self):
+        cursor = self.changes()['cursor']
+        data = self.changes(cursor)
+        self.assertEqual(data['cursor'], cursor)
+        self.assertEqual(data['projects'], [])
+        self.assertEqual(data['instances'], [])
+
+    def testProjectStateChange(self):
+        cursor = self.changes()['cursor']
+
+        project = Project.objects.get(pk=1)
+        project.save_state('running')
+
+        data = self.changes(cursor)
+        self.assertGreater(data['cursor'], cursor)
+        self.assertEqual([p['id'] for p in data['projects']], [1])
+        self.assertEqual(data['projects'][0]['state'], 'running')
+        self.assertEqual(data['instances'], [])
+
+        # and nothing more after that
+        data = self.changes(data['cursor'])
+        self.assertEqual(data['projects'], [])
+
+    def testInstanceChangeAndDelete(self):
+        cursor = self.changes()['cursor']
+
+        instance = Instance.objects.get(pk=1)
+        instance.state = 'stopping'
+        instance.save()
+        Instance.objects.get(pk=2).delete()
+
+        data = self.changes(cursor)
+        self.assertEqual([i['id'] for i in data['instances']], [1])
+        self.assertEqual(data['instances'][0]['state'], 'stopping')
+        self.assertEqual(data['deleted']['instance'], [2])
+
+    def testInstanceTouches(self):
+        # state changes do not change projects
+        cursor = self.changes()['cursor']
+        instances = list(Instance.objects.filter(account=1))
+        instances[0].state = 'stopping'
+        instances[0].save()
+        self.assertEqual(self.changes(cursor)['projects'], [])
+
+        # other changes do, but within a buffer only once
+        with TouchBuffer():
+            for instance in instances:
+                instance.type = 'm3.large'
+                instance.save()
+
+            self.assertEqual(self.changes(cursor)['projects'], [])
+
+        data = self.changes(cursor)
+        self.assertEqual([p['id'] for p in data['projects']], [1])
+        self.assertEqual(Project.objects.get(pk=1).sequence,
+                         current_sequence())
+
+    def testLogEntries(self):
+        cursor = self.changes()['cursor']
+
+        Account.objects.get(pk=1).log_entry('first')
+        Project.objects.get(pk=1).log_entry('second')
+
+        data = self.changes(cursor)
+        self.assertEqual([(l['message'], l['account'], l['project'])
+                          for l in data['log_entries']],
+                         [('first', 1, None), ('second', None, 1)])
+
+    def testOpenTransaction(self):
+        # Simulate a transaction that has allocated a sequence value
+        # but not committed yet, while another one commits after it.
+        cursor = self.changes()['cursor']
+        floor = current_sequence()
+        sequence_floor = models.sequence_floor
+        models.sequence_floor = lambda: floor
+
+        try:
+            pending = next_sequence()
+
+            instance = Instance.objects.get(pk=2)
+            instance.state = 'stopping'
+            instance.save()
+            self.assertGreater(instance.sequence, pending)
+
+            # the later change is held back until the open one commits
+            data = self.changes(cursor)
+            self.assertEqual(data['cursor'], cursor)
+            self.assertEqual(data['instances'], [])
+
+            response = self.client.get(reverse('instance-list'),
+                                       {'since': cursor})
+            self.assertEqual(response.data['cursor'], cursor)
+            self.assertEqual(response.data['results'], [])
+
+            Instance.objects.filter(pk=1).update(state='stopping',
+                                                 sequence=pending)
+        finally:
+            models.sequence_floor = sequence_floor
+
+        data = self.changes(cursor)
+        self.assertEqual(data['cursor'], current_sequence())
+        self.assertEqual(sorted(i['id'] for i in data['instances']), [1, 2])
+
+    def testResync(self):
+        cursor = self.changes()['cursor']
+        Instance.objects.get(pk=2).delete()
+        Instance.objects.get(pk=3).save()
+
+        self.assertFalse(self.changes(cursor)['resync'])
+
+        # the deletion is no longer known after pruning its tombstone
+        sequence = Tombstone.objects.get(object_id=2).sequence
+        Tombstone.objects.filter(object_id=2).update(
+            kind=Tombstone.HORIZON, object_id=0)
+
+        data = self.changes(cursor)
+        self.assertTrue(data['resync'])
+        self.assertEqual(data['instances'], [])
+        self.assertEqual(data['deleted']['instance'], [])
+        self.assertFalse(self.changes(sequence)['resync'])
+
+        # and lists start over from everything
+        response = self.client.get(reverse('instance-list'),
+                                   {'since': cursor})
+        self.assertTrue(response.data['resync'])
+        self.assertEqual(sorted(i['id'] for i in response.data['results']),
+                         sorted(Instance.objects.values_list('id',
+                                                             flat=True)))
+
+        response = self.client.get(reverse('instance-list'),
+                                   {'since': sequence})
+        self.assertFalse(response.data['resync'])
+        self.assertEqual([i['id'] for i in response.data['results']], [3])
+
+    def testSinceBatches(self):
+        def since(cursor):
+            response = self.client.get(reverse('instance-list'),
+                                       {'since': cursor})
+            self.assertEqual(response.status_code, 200)
+            return response.data
+
+        cursor = current_sequence()
+        instances = list(Instance.objects.order_by('id')[:4])
+
+        for instance in instances[:3]:
+            instance.save()
+
+        deleted = instances[3].id
+        instances[3].delete()
+
+        batch_size = views.SINCE_BATCH_SIZE
+        views.SINCE_BATCH_SIZE = 2
+
+        try:
+            data = since(cursor)
+            self.assertTrue(data['more'])
+            self.assertEqual([i['id'] for i in data['results']],
+                             [i.id for i in instances[:2]])
+            self.assertEqual(data['deleted'], [])
+            self.assertEqual(data['cursor'], instances[1].sequence)
+
+            data = since(data['cursor'])
+            self.assertFalse(data['more'])
+            self.assertEqual([i['id'] for i in data['results']],
+                             [instances[2].id])
+            self.assertEqual(data['deleted'], [deleted])
+            self.assertEqual(data['cursor'], current_sequence())
+
+            # objects with the same sequence are not split
+            cursor = data['cursor']
+            models.touch(Instance.objects.all())
+            data = since(cursor)
+            self.assertFalse(data['more'])
+            self.assertEqual(len(data['results']), Instance.objects.count())
+        finally:
+            views.SINCE_BATCH_SIZE = batch_size
+
+    def testInvalidCursor(self):
+        response = self.client.get(reverse('changes'), {'cursor': 'bad'})
+        self.assertEqual(response.status_code, 400)
+
+
+def drop_column(model, column):
+    """Drop `column` of `model`'s table and the indexes on it, as in a
+    database created before the column was added (SQLite only)."""
+    table = model._meta.db_table
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA index_list(%s)" % (table,))
+
+    for index in [row[1] for row in cursor.fetchall()]:
+        cursor.execute("PRAGMA index_info(%s)" % (index,))
+
+        if column in [row[2] for row in cursor.fetchall()]:
+            cursor.execute("DROP INDEX %s" % (index,))
+
+    cursor.execute("ALTER TABLE %s DROP COLUMN %s" % (table, column))
+
+
+class TestUpgrade(test.APITestCase):
+    fixtures = ('rest_tests',)
+
+    def testSequenceColumns(self):
+        if connection.vendor != 'sqlite':
+            return
+
+        for model in (Domain, Account, Instance, Project, LogEntry):
+            drop_column(model, 'sequence')
+
+        call_command('upgrade', verbosity=0)
+
+        for model in (Domain, Account, Instance, Project, LogEntry):
+            self.assertTrue(model.objects.exists())
+            sequences = model.objects.values_list('sequence', flat=True)
+            self.assertEqual([0], list(set(sequences)))
+
+        # and the feed works on the upgraded tables
+        instance = Instance.objects.all()[0]
+        instance.save()
+        self.assertEqual([instance.id],
+                         list(Instance.objects.filter(sequence__gt=0)
+                              .values_list('id', flat=True)))
+
+    def testTombstoneTime(self):
+        if connection.vendor != 'sqlite':
+            return
+
+        Instance.objects.get(pk=2).delete()
+        drop_column(Tombstone, 'time')
+
+        call_command('upgrade', verbosity=0)
+        self.assertIsNotNone(Tombstone.objects.get(object_id=2).time)
+
+    def testIndexes(self):
+        if connection.vendor != 'sqlite':
+            return
+
+        def indexes():
+            cursor = connection.cursor()
+            cursor.execute("SELECT tbl_name, sql FROM sqlite_master "
+                           "WHERE type = 'index'")
+            return sorted(cursor.fetchall())
+
+        # missing indexes are created, and existing ones (including
+        # the unique constraints created by syncdb) not duplicated
+        before = indexes()
+        name = [sql.split()[2] for table, sql in before
+                if table == 'core_instance' and
+                '("sequence")' in (sql or '')][0]
+        connection.cursor().execute('DROP INDEX %s' % (name,))
+        call_command('upgrade', verbosity=0)
+        self.assertEqual(before, indexes())
+
+        # and errors are not hidden
+        connection.cursor().execute('DROP INDEX %s' % (name,))
+        connection.cursor().execute('CREATE TABLE %s (id integer)' % (name,))
+
+        with self.assertRaises(DatabaseError):
+            call_command('upgrade', verbosity=0)
+
+    def testCacheTables(self):
+        cache = get_cache(settings.FREEZR_BACKEND_CACHE)
+        connection.cursor().execute('DROP TABLE %s' % (cache._table,))
+        self.assertNotIn(cache._table,
+                         connection.introspection.table_names())
+
+        call_command('upgrade', verbosity=0)
+        self.assertIn(cache._table, connection.introspection.table_names())
+
+        # and it is used, e.g. the state is shared by processes
+        cache.set('freezr.test', 1)
+        cursor = connection.cursor()
+        cursor.execute('SELECT COUNT(*) FROM %s' % (cache._table,))
+        self.assertEqual(1, cursor.fetchone()[0])
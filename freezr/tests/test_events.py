@@ -0,0 +1,145 @@
+from django import test
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.dateparse import parse_datetime
+from django.utils import timezone
+import json
+import logging
+import os
+import shutil
+import tempfile
+from freezr.backend import events
+from freezr.core.models import Account, Domain, Instance, Project
+from .util import FreezrTestCaseMixin
+
+log = logging.getLogger(__file__)
+
+
+def event(instance_id, state, region='us-east-1',
+          time='2014-07-01T12:00:00Z'):
+    return json.dumps({'detail-type': events.EVENT_DETAIL_TYPE,
+                       'source': 'aws.ec2', 'region': region, 'time': time,
+                       'detail': {'instance-id': instance_id,
+                                  'state': state}})
+
+
+class TestEvents(FreezrTestCaseMixin, test.TestCase):
+    def setUp(self):
+        self.domain = Domain(name="test", domain=".test")
+        self.domain.save()
+        self.account = Account(domain=self.domain, name="test",
+                               access_key="1234", secret_key="abcd")
+        self.account.save()
+        self.project = Project(account=self.account, name="test",
+                               regions="us-east-1",
+                               pick_filter='tag[project] = a',
+                               save_filter='tag[save]')
+        self.project.save()
+
+        for n in range(3):
+            self.instance(instance_id='i-%d' % (n,), tag_project='a',
+                          tag_save='yes')
+
+        self.other = self.instance(instance_id='i-9', region='eu-west-1')
+
+    def states(self):
+        return dict(Instance.objects.values_list('instance_id', 'state'))
+
+    def testParse(self):
+        self.assertEqual(('us-east-1', 'i-1', 'stopped',
+                          '2014-07-01T12:00:00Z'),
+                         events.parse(event('i-1', 'stopped')))
+        self.assertIsNone(events.parse(event('i-1', 'unknown')))
+        self.assertIsNone(events.parse('{"detail-type": "other", '
+                                       '"detail": {}}'))
+        self.assertIsNone(events.parse('not json'))
+
+    def testIngest(self):
+        queue = events.MemoryQueue()
+        self.project.save_state('freezing')
+
+        queue.put(event('i-0', 'stopping'))
+        queue.put(event('i-0', 'stopped', time='2014-07-01T12:00:01Z'))
+        queue.put(event('i-1', 'stopped'))
+        # wrong region
+        queue.put(event('i-9', 'stopped'))
+        queue.put('garbage')
+
+        self.assertEqual(5, events.ingest(queue))
+        self.assertEqual({'i-0': 'stopped', 'i-1': 'stopped',
+                          'i-2': 'running', 'i-9': 'running'},
+                         self.states())
+        self.assertEqual('freezing',
+                         Project.objects.get(pk=self.project.pk).state)
+
+        # last one completes the freeze
+        queue.put(event('i-2', 'stopped'))
+        self.assertEqual(1, events.ingest(queue))
+        self.assertEqual('frozen',
+                         Project.objects.get(pk=self.project.pk).state)
+
+        self.assertEqual(0, events.ingest(queue))
+
+    def testStaleEvents(self):
+        def update(*events_):
+            return events.update_states([events.parse(e) for e in events_])
+
+        self.assertEqual(1, update(event('i-0', 'stopped',
+                                         time='2014-07-01T12:00:02Z')))
+
+        # late and redelivered events do not override newer states
+        self.assertEqual(0, update(event('i-0', 'stopping',
+                                         time='2014-07-01T12:00:01Z')))
+        self.assertEqual(0, update(event('i-0', 'stopped',
+                                         time='2014-07-01T12:00:02Z')))
+        self.assertEqual('stopped', self.states()['i-0'])
+
+        # and neither do events older than a polled state
+        Instance.objects.filter(instance_id='i-0').update(
+            state='pending', state_time=timezone.now())
+        self.assertEqual(0, update(event('i-0', 'running',
+                                         time='2014-07-01T12:00:03Z')))
+        self.assertEqual('pending', self.states()['i-0'])
+
+    def testGroupedUpdates(self):
+        times = ['2014-07-01T12:00:0%dZ' % (n,) for n in range(3)]
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(3, events.update_states(
+                [events.parse(event('i-%d' % (n,), 'stopped', time=time))
+                 for n, time in enumerate(times)]))
+
+        # one update for all the instances, with their own state times
+        self.assertEqual(1, len([q for q in queries
+                                 if 'UPDATE ' + Instance._meta.db_table
+                                 in q['sql'].replace('"', '')]))
+        self.assertEqual(
+            dict(('i-%d' % (n,), parse_datetime(time))
+                 for n, time in enumerate(times)),
+            dict(Instance.objects.filter(region='us-east-1')
+                 .values_list('instance_id', 'state_time')))
+
+    def testFileQueue(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'events')
+
+        try:
+            queue = events.FileQueue(path)
+            self.assertEqual([], queue.receive())
+
+            for n in range(3):
+                queue.put(event('i-%d' % (n,), 'stopped'))
+
+            with self.settings(FREEZR_EVENT_QUEUE=events.FileQueue,
+                               FREEZR_EVENT_QUEUE_OPTIONS={'path': path}):
+                call_command('ingest_events', once=True, verbosity=0)
+
+            self.assertEqual(3, self.states().values().count('stopped'))
+
+            # already processed
+            self.assertEqual([], queue.receive())
+            queue.put(event('i-0', 'running'))
+            self.assertEqual(1, len(queue.receive()))
+        finally:
+            shutil.rmtree(directory)
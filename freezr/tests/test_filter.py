@@ -24,6 +24,9 @@ class TestFilter(unittest.TestCase):
         '(region (region and region))',  # invalid parenthesis
         'region = (region or region)',  # invalid rhs
         '',                     # empty input
+        'type in ()',           # empty list
+        'type in (a, tag[b])',  # only literals in lists
+        'type in a, b',         # lists must be parenthesized
         )
 
     # These should succeed, and give the expected result (true or
@@ -88,6 +91,16 @@ class TestFilter(unittest.TestCase):
         ('storage = tag[lit3]', True),
         ('storage != tag[lit2]', True),
         ('tag[lit1] = tag[lit1]', True),
+
+        # Set membership
+        ('region in (us-east-1)', True),
+        ('region in (us-west-1, "us-east-1", \'eu-west-1\')', True),
+        ('region not in (us-west-1, eu-west-1)', True),
+        ('type in (m1.large, m1.xlarge)', False),
+        ('tag[class] in (other, test)', True),
+        ('tag[unexistent] in ("", x)', True),
+        ('tag[unexistent] not in (a)', True),
+        ('not tag[class] not in (test) and storage in (ebs)', True),
         )
 
     # Environment for the case above
@@ -159,3 +172,52 @@ class TestFilter(unittest.TestCase):
                                   .format(*t) for t in failed])))
 
         self.assertEqual(len(failed), 0, msg)
+
+    # Optimizations and their expected results
+    OPTIMIZE = (
+        ('true and tag[a]', 'tag[a]'),
+        ('tag[a] and false', 'false'),
+        ('tag[a] or true', 'true'),
+        ('false or false', 'false'),
+        ('not true', 'false'),
+        ('not not tag[a]', 'tag[a]'),
+        ('region = region', 'true'),
+        ('tag[a] != tag[a]', 'false'),
+        ('tag[a] and (tag[b] and tag[c])', 'tag[a] and tag[b] and tag[c]'),
+        ('tag[a] or (tag[b] or (tag[c] or tag[d]))',
+         'tag[a] or tag[b] or tag[c] or tag[d]'),
+        ('tag[a] and tag[b] and tag[a]', 'tag[a] and tag[b]'),
+        ('tag[a] ~ "^(a|b)" and region = us-east-1',
+         'region = us-east-1 and tag[a] ~ \'^(a|b)\''),
+        ('region = us-east-1 or tag[a] != x',
+         'tag[a] != x or region = us-east-1'),
+        ('vpc and vpc ~ "^vpc-"', 'vpc and vpc ~ \'^vpc-\''),
+        ('region and tag[a]', 'tag[a] and region'),
+        ('(tag[a] or false) and not (true and tag[b])',
+         'tag[a] and (not tag[b])'),
+        ('type = a or type = b or tag[x] = c or type in (d, a)',
+         'type in (a, b, d) or tag[x] = c'),
+        ('tag[e] != a and tag[e] != "b,c" and region = x',
+         'region = x and tag[e] not in (a, \'b,c\')'),
+        ('type = a or type != b or region = a', 'type != b or '
+         'type = a or region = a'),
+        )
+
+    def testOptimize(self):
+        for text, expected in self.OPTIMIZE:
+            self.assertEqual(Filter.parse(text).optimize().format(),
+                             expected)
+
+    def testOptimizeSemantics(self):
+        for text, expected in self.SUCCESS:
+            f = Filter.parse(text).optimize()
+            self.assertEqual(f.evaluate(self.ENVIRONMENT), expected, text)
+
+            # and round-trip through format
+            self.assertEqual(Filter.parse(f.format()).format(), f.format())
+
+    def testFormatRoundTrip(self):
+        for text in ('tag["aws:stack"] = "it\'s"', "region = 'vpc'",
+                     'tag[a] and (tag[b] or not tag[c])'):
+            f = Filter.parse(text)
+            self.assertEqual(Filter.parse(f.format()).format(), f.format())
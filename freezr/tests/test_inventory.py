@@ -0,0 +1,133 @@
+import unittest
+import logging
+from freezr.core.filter import Filter
+from freezr.core.inventory import (Inventory, equality_terms, mask_to_rows,
+                                   rows_to_mask)
+from .test_filter import TestFilter
+
+log = logging.getLogger('freezr.tests.test_inventory')
+
+
+class TestInventory(unittest.TestCase):
+    # Environments with a bit of variety in values, including missing
+    # tags and vpc values.
+    ENVIRONMENTS = [
+        TestFilter.ENVIRONMENT,
+        {'region': 'us-east-1', 'type': 'm1.small', 'storage': 'ebs',
+         'vpc': None, 'tags': {}},
+        {'region': 'eu-west-1', 'type': 'm1.large', 'storage': 'instance',
+         'vpc': 'vpc-1', 'tags': {'class': 'other', 't': 'x',
+                                  'lit3': 'instance'}},
+        {'region': 'us-east-1', 'type': 'm1.large', 'storage': 'ebs',
+         'vpc': 'vpc-2', 'tags': {'class': 'test', 'f': 'y',
+                                  'lit1': 'a', 'lit2': 'b'}},
+        ]
+
+    EXTRA = (
+        'vpc',
+        'vpc and vpc ~ "^vpc-"',
+        'not vpc or vpc = "vpc-2"',
+        'type = m1.large and not (tag[class] = test or storage = ebs)',
+        'tag[class] ~ "^t" or tag[t] and region != us-east-1',
+        'tag[lit1] != tag[lit2] and (tag[t] or tag[f])',
+        'vpc in ("vpc-1", "vpc-3") or type not in (m1.small)',
+        'tag[class] not in (test, "")',
+        )
+
+    def assertSame(self, environments, text):
+        f = Filter.parse(text)
+        expected = [env for env in environments if f.evaluate(env)]
+        result = Inventory(environments).filter(f)
+        self.assertEqual(result, expected,
+                         "{0!r}: got {1!r}, expected {2!r}".format(
+                             text, result, expected))
+
+    def testMasks(self):
+        for rows, count in (([], 0), ([], 5), ([0, 3, 4], 5),
+                            (range(100), 100), ([70], 71)):
+            mask = rows_to_mask(rows, count)
+            self.assertEqual(mask, sum(1 << row for row in rows))
+            self.assertEqual(mask_to_rows(mask), list(rows))
+
+    def testSameAsEvaluate(self):
+        for text in [case[0] for case in TestFilter.SUCCESS] + list(
+                self.EXTRA):
+            self.assertSame(self.ENVIRONMENTS, text)
+
+    def testEmpty(self):
+        self.assertEqual(Inventory([]).filter(Filter.parse('true')), [])
+
+    def testNot(self):
+        f = Filter.parse('region = us-east-1').NOT()
+        self.assertEqual(Inventory(self.ENVIRONMENTS).filter(f),
+                         [self.ENVIRONMENTS[2]])
+
+    def testShortCircuit(self):
+        # regexp search on None vpc raises like with Filter.evaluate,
+        # but not if guarded by a test
+        environments = self.ENVIRONMENTS[1:]
+        f = Filter.parse('vpc ~ "^vpc-"')
+        self.assertRaises(TypeError, f.evaluate, environments[0])
+        self.assertRaises(TypeError, Inventory(environments).evaluate, f)
+        self.assertSame(environments, 'vpc and vpc ~ "^vpc-"')
+        self.assertSame(environments, 'not vpc or vpc ~ "^vpc-"')
+
+    def testDistinctValues(self):
+        # comparisons are done once per distinct value
+        calls = []
+
+        def predicate(value):
+            calls.append(value)
+            return value == 'b'
+
+        inventory = Inventory([{'tags': {'x': v}} for v in 'abcab' * 100],
+                              range(500))
+        column = inventory.column(Filter.parse('tag[x]').expression.expr)
+        element = Filter.parse('tag[x] = b').expression
+        mask = inventory._select(column, inventory.all, element, predicate)
+
+        self.assertEqual(sorted(calls), ['a', 'b', 'c'])
+
+        # and only once per inventory
+        self.assertEqual(
+            mask, inventory._select(column, inventory.all, element,
+                                    predicate))
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(mask_to_rows(mask),
+                         [i for i in range(500) if i % 5 in (1, 4)])
+
+    def testProfile(self):
+        inventory = Inventory([{'tags': {'x': v}} for v in 'abcab' * 100])
+        inventory.profile()
+        f = Filter.parse('tag[x] = b or tag[x] = c')
+        inventory.filter(f)
+        inventory.filter(f)
+
+        tree = inventory.tree(f)
+        self.assertEqual((tree['evaluations'], tree['cached'], tree['rows'],
+                          tree['true'], tree['false']),
+                         (1, 1, 500, 300, 200))
+
+        # the second term is evaluated only over the rows not matched
+        # by the first, once per distinct value
+        first, second = tree['children']
+        self.assertEqual((first['rows'], first['predicates']), (500, 3))
+        self.assertEqual((second['rows'], second['true'],
+                          second['predicates']), (300, 100, 2))
+
+    def testEqualityTerms(self):
+        def terms(text):
+            return [(unicode(value), literal) for value, literal in
+                    equality_terms(Filter.parse(text).expression)]
+
+        self.assertEqual(terms('tag[a] = x'), [('tag[a]', ['x'])])
+        self.assertEqual(terms('tag[a] and (region = b and vpc)'),
+                         [('tag[a]', None), ('region', ['b']),
+                          ('vpc', None)])
+        self.assertEqual(terms('type in (a, b) and tag[a] not in (c)'),
+                         [('type', ['a', 'b'])])
+        self.assertEqual(terms('type in (a, "")'), [])
+        self.assertEqual(terms('tag[a] = "" and tag[b] != x and '
+                               'tag[c] ~ x and tag[d] = tag[e]'), [])
+        self.assertEqual(terms('tag[a] = x or tag[b] = y'), [])
+        self.assertEqual(terms('not tag[a] = x'), [])
@@ -1,6 +1,8 @@
 from django import test
+from django.db import transaction
 import logging
-from freezr.core.models import Account, Domain, LogEntry
+from freezr.core.models import (Account, Domain, LogEntry, LogBuffer,
+                                LogDetails, LOG_DETAILS_INLINE_MAX)
 from freezr.api.exceptions import LoggedException
 
 log = logging.getLogger(__file__)
@@ -71,3 +73,110 @@ class TestLogEntry(test.TestCase):
         self.assertEqual(self.domain, l.domain)
         self.assertEqual('problem', l.message)
         self.assertEqual('exception', l.type)
+
+    def testBuffer(self):
+        with LogBuffer():
+            self.account.log_entry('account')
+            self.project.log_entry('project')
+            self.instance.log_entry('instance')
+
+            # Nothing is written until the buffer is flushed
+            self.assertEqual(0, LogEntry.objects.count())
+
+        self.assertEqual(0, len(LogBuffer.stack()))
+        self.assertEqual(['account', 'project', 'instance'],
+                         [l.message for l in
+                          LogEntry.objects.order_by('id')])
+        self.assertEqual(2, self.account.log_entries.count())
+
+        # Written entries share the same sequence
+        self.assertEqual(1, len(set(LogEntry.objects.values_list(
+            'sequence', flat=True))))
+
+        # Unbuffered again
+        self.domain.log_entry('domain')
+        self.assertEqual(4, LogEntry.objects.count())
+
+    def testBufferSize(self):
+        with LogBuffer(size=3) as buffer:
+            with LogBuffer(size=100):
+                self.domain.log_entry('inner')
+
+            self.assertEqual(1, LogEntry.objects.count())
+
+            for n in range(4):
+                self.account.log_entry('entry %d' % (n,))
+
+            self.assertEqual(4, LogEntry.objects.count())
+            self.assertEqual(1, len(buffer.entries))
+
+        self.assertEqual(5, LogEntry.objects.count())
+
+    def testBufferException(self):
+        try:
+            with LogBuffer():
+                self.project.log_entry('before')
+                raise ValueError('problem')
+        except ValueError:
+            pass
+
+        self.assertEqual(0, len(LogBuffer.stack()))
+        self.assertEqual(['before'], [l.message for l in
+                                      self.project.log_entries.all()])
+
+    def testBufferRollback(self):
+        # entries logged within a transaction inside the buffer survive
+        # its rollback, also those of buffers entered within it
+        with LogBuffer(size=2):
+            try:
+                with transaction.atomic():
+                    with LogBuffer():
+                        self.project.log_entry('inner')
+
+                    for n in range(3):
+                        self.account.log_entry('entry %d' % (n,))
+
+                    self.assertEqual(0, LogEntry.objects.count())
+                    raise ValueError('problem')
+            except ValueError:
+                pass
+
+        self.assertEqual(['inner', 'entry 0', 'entry 1', 'entry 2'],
+                         [l.message for l in
+                          LogEntry.objects.order_by('id')])
+
+    def testStoredDetails(self):
+        self.domain.log_entry('short', details='short details')
+        self.assertEqual(0, LogDetails.objects.count())
+
+        def throw():
+            raise LoggedException(self.domain, 'problem ' + (
+                'x' * LOG_DETAILS_INLINE_MAX))
+
+        # Same traceback repeatedly, with a varying object address
+        for n in range(3):
+            try:
+                throw()
+            except LoggedException as ex:
+                ex.save()
+
+            self.account.log_entry(
+                'long', details=u'<object at 0x%x>\n%s' % (
+                    1000 + n, u'\xe4' * LOG_DETAILS_INLINE_MAX))
+
+        self.assertEqual(2, LogDetails.objects.count())
+        self.assertEqual([3, 3], [d.count for d in
+                                  LogDetails.objects.order_by('id')])
+
+        entries = list(LogEntry.objects.filter(
+            message__startswith='problem'))
+        self.assertEqual(3, len(entries))
+        self.assertTrue(all(l.details is None for l in entries))
+        self.assertTrue(entries[0].get_details().startswith('Traceback'))
+
+        long = LogEntry.objects.filter(message='long')[0]
+        self.assertEqual(u'<object at 0x3e8>\n' +
+                         u'\xe4' * LOG_DETAILS_INLINE_MAX,
+                         long.get_details())
+        self.assertEqual('short details', LogEntry.objects.get(
+            message='short').get_details())
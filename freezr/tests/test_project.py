@@ -1,6 +1,8 @@
 from django import test
 import logging
-from freezr.core.models import Account, Domain, Project, Instance
+from freezr.core.models import (Account, Domain, Project, Instance,
+                                narrow_instances)
+from freezr.core.filter import Filter
 import freezr.tests.util as util
 
 log = logging.getLogger(__file__)
@@ -224,6 +226,61 @@ class TestAccount(util.FreezrTestCaseMixin, test.TestCase):
              ('tag[staging] or tag[devtest] or true', 5)),
             )
 
+    def testNarrowing(self):
+        self.createSet2()
+
+        def narrowed(text):
+            return sorted(i.environment['tags']['Name'] for i in
+                          narrow_instances(self.account.instances.all(),
+                                           Filter.parse(text)))
+
+        self.assertEqual(narrowed('tag[class] = fe'), ['ir02', 'ir03'])
+        self.assertEqual(narrowed('tag[class] = fe and tag[Name] = ir03'),
+                         ['ir03'])
+        self.assertEqual(len(narrowed('tag[staging] and region = us-east-1 '
+                                      'and tag[Name] ~ "2$"')), 2)
+        self.assertEqual(narrowed('tag[class] = fe and region = us-east-1'),
+                         [])
+        self.assertEqual(len(narrowed('tag[class] = fe or tag[staging]')),
+                         10)
+        self.assertEqual(narrowed('tag[class] in (fe, bastion) and '
+                                  'region in (eu-west-1, us-west-2)'),
+                         ['ir01', 'ir02', 'ir03'])
+
+        self.case_with_filters(
+            (('tag[class] = fe and tag[Name] = ir03', 1), None, None),
+            (('tag[staging] and tag[Name] ~ "2$"', 1), None, None),
+            (('tag[class] = fe and not tag[Name] = ir03', 1), None, None))
+
+    def testCategorize(self):
+        self.createSet2()
+
+        for name, regions, pick, save, terminate in (
+                ('eu', 'eu-west-1', 'tag[production]', 'tag[class] = db',
+                 'tag[class] = fe'),
+                ('us', 'us-east-1,us-west-2', 'tag[staging] or tag[devtest]',
+                 'tag[staging]', 'true'),
+                ('empty', 'us-east-1', 'tag[devtest]', '', '')):
+            self.account.new_project(name=name, regions=regions,
+                                     pick_filter=pick, save_filter=save,
+                                     terminate_filter=terminate).save()
+
+        projects = list(self.account.projects.all())
+        categories = self.account.categorize()
+        self.assertEqual(sorted(categories.keys()),
+                         sorted(p.id for p in projects))
+
+        for project in projects:
+            for name in ('picked', 'saved', 'terminated', 'skipped'):
+                self.assertEqual(
+                    sorted(ids(categories[project.id][name])),
+                    sorted(ids(getattr(project, name + '_instances'))))
+
+        eu = self.account.projects.get(name='eu')
+        self.assertEqual([len(categories[eu.id][name]) for name in
+                          ('picked', 'saved', 'terminated', 'skipped')],
+                         [5, 2, 2, 1])
+
     def testFreeze(self):
         self.createSet2()
         aws = util.ImmediateAwsMock()
@@ -280,6 +337,32 @@ class TestAccount(util.FreezrTestCaseMixin, test.TestCase):
                           u'i-000004': 'terminate_instance',
                           u'i-000005': 'terminate_instance'})
 
+    def testFreezeLease(self):
+        self.createSet2()
+        aws = util.ImmediateAwsMock()
+        operation = self.project.acquire_operation(lease=10)
+        expires = self.project.operation_expires
+        renewed = []
+
+        def freeze_instance(instance):
+            util.ImmediateAwsMock.freeze_instance(aws, instance)
+            project = Project.objects.get(pk=self.project.pk)
+            renewed.append(project.operation_expires)
+
+            # another operation takes over during the freeze
+            project.acquire_operation(force=True)
+
+        aws.freeze_instance = freeze_instance
+
+        with self.instance_filters('true', 'true'):
+            self.project.freeze(aws=aws, operation=operation)
+
+        # the lease was renewed before changing the first instance,
+        # and the freeze stopped once the lease was lost
+        self.assertGreater(renewed[0], expires)
+        self.assertEqual(len(aws.calls), 1)
+        self.assertState('freezing')
+
     def assertState(self, state):
         self.assertEqual(Project.objects.get(pk=self.project.id).state,
                          state)
@@ -378,3 +461,108 @@ class TestAccount(util.FreezrTestCaseMixin, test.TestCase):
 
         self.project.thaw(aws)
         self.assertEqual(self.project.state, 'running')
+
+    def testPlan(self):
+        # the plan is checked against the inventory when executed, but
+        # completion is checked against the plan last executed
+        self.createSet2()
+        self.project.pick_filter = 'tag[staging] or tag[devtest]'
+        self.project.save_filter = 'tag[staging]'
+        self.project.terminate_filter = 'tag[devtest]'
+        self.project.save()
+
+        aws = util.AwsMock()
+        self.project.freeze(aws)
+        self.assertState('freezing')
+        self.assertEqual(5, len(aws.calls))
+
+        project = Project.objects.get(pk=self.project.pk)
+        self.assertEqual('freezing', project.plan_state)
+        self.assertEqual(40, len(project.plan_digest))
+        self.assertEqual({'terminate': 3, 'stop': 2},
+                         {action: project.plan_items.filter(
+                             action=action).count()
+                          for action in ('terminate', 'stop')})
+
+        # state changes do not invalidate the plan
+        digest = project.plan_digest
+        stopping = project.plan('freezing')['stop'][0]
+        stopping.state = 'stopping'
+        stopping.save()
+        self.assertFalse(project.check_plan('freezing'))
+        self.assertEqual(digest, project.plan_digest)
+
+        # but new instances do, and a re-freeze plans again
+        late = self.instance(tag_staging='yes')
+        self.instance(tag_devtest='yes')
+
+        aws.reset()
+        project.freeze(aws)
+        self.assertEqual(7, len(aws.calls))
+        self.assertIn(late, arg(aws.calls, 1))
+        self.assertNotEqual(digest, project.plan_digest)
+        self.assertTrue(project.log_entries.filter(
+            message__startswith='Instances or filters changed').exists())
+
+        # instances appearing after execution are not waited for
+        self.instance(tag_staging='yes')
+
+        # completes when the planned instances are done, whether the
+        # terminated ones are still around or not
+        for name, instance in aws.calls:
+            if name == 'terminate_instance':
+                instance.delete()
+            else:
+                instance.state = 'stopped'
+                instance.save()
+
+        project.refresh()
+        self.assertState('frozen')
+        self.assertEqual('', Project.objects.get(pk=project.pk).plan_state)
+        self.assertEqual(0, project.plan_items.count())
+
+    def testOperationLease(self):
+        first = self.project.acquire_operation()
+        self.assertIsNotNone(first)
+
+        # held by another, renewable by the owner
+        self.assertIsNone(self.project.acquire_operation())
+        self.assertEqual(first, self.project.acquire_operation(first))
+
+        # forced takeover, after which the first one has lost it
+        second = self.project.acquire_operation(force=True)
+        self.assertNotEqual(first, second)
+        self.assertIsNone(self.project.acquire_operation(first))
+
+        # releasing by a non-owner does nothing
+        self.project.release_operation(first)
+        self.assertEqual(
+            second, Project.objects.get(pk=self.project.pk).operation_owner)
+
+        self.project.release_operation(second)
+        self.assertIsNotNone(self.project.acquire_operation(first))
+
+        # expired leases can be taken over
+        self.project.acquire_operation(first, lease=-1)
+        self.assertIsNotNone(self.project.acquire_operation())
+
+    def testRefreshStates(self):
+        # only regions of the project with picked instances are refreshed
+        self.createSet2()
+        self.project.regions = ['us-east-1', 'us-west-2', 'ap-southeast-1']
+        self.project.pick_filter = 'tag[staging] or tag[devtest]'
+        self.project.save()
+
+        aws = util.AwsMock()
+        self.project.refresh_states(aws)
+
+        self.assertEqual(['us-east-1', 'us-west-2'],
+                         sorted(call[2] for call in aws.calls))
+
+        for name, account, region, instances in aws.calls:
+            self.assertEqual('refresh_states', name)
+            self.assertTrue(all(i.region == region for i in instances))
+
+        self.assertEqual(['nv01', 'nv02', 'nv03', 'or01', 'or02'],
+                         sorted(i.tags.get(key='Name').value
+                                for call in aws.calls for i in call[3]))
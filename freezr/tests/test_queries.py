@@ -0,0 +1,97 @@
+from __future__ import absolute_import
+import logging
+from freezr.core.models import Account, Domain
+from rest_framework import test
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from .util import FreezrTestCaseMixin
+
+log = logging.getLogger(__file__)
+
+
+class TestQueryCount(FreezrTestCaseMixin, test.APITestCase):
+    """List endpoints must use a constant number of queries regardless
+    of the number of objects listed."""
+
+    LISTS = ('domain-list', 'account-list', 'project-list',
+             'instance-list', 'log-list')
+
+    _populated = 0
+
+    def populate(self, count):
+        for n in range(self._populated, self._populated + count):
+            domain = Domain(name="domain %d" % (n,), domain=".test")
+            domain.save()
+            domain.log_entry('domain entry')
+
+            account = Account(domain=domain, name="account %d" % (n,),
+                              access_key="key %d" % (n,),
+                              secret_key="secret")
+            account.save()
+            account.log_entry('account entry')
+
+            for m in range(2):
+                project = account.new_project(
+                    name="project %d" % (m,),
+                    regions="us-east-1",
+                    pick_filter="tag[project] = p%d" % (m,),
+                    save_filter="tag[save]",
+                    terminate_filter="true")
+                project.save()
+                project.log_entry('project entry')
+
+                for k in range(3):
+                    self.instance(account=account,
+                                  tag_project="p%d" % (m,),
+                                  tag_save="yes" if k else "")
+
+        self._populated += count
+
+    def count_queries(self):
+        counts = {}
+
+        for name in self.LISTS:
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(reverse(name))
+                self.assertEqual(response.status_code, 200)
+
+            counts[name] = len(context.captured_queries)
+
+        return counts
+
+    def testConstantQueries(self):
+        self.populate(1)
+        few = self.count_queries()
+
+        self.populate(4)
+        many = self.count_queries()
+
+        log.debug("query counts: few=%r many=%r", few, many)
+
+        self.assertEqual(few, many)
+
+    def testProjectInstances(self):
+        # only listing categorized projects loads all instances of
+        # their accounts
+        self.populate(1)
+        self.instance(account=Account.objects.get(), region='eu-west-1')
+        project = Account.objects.get().projects.all()[0]
+
+        def instance_queries(url, **params):
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url, params)
+                self.assertEqual(response.status_code, 200)
+
+            return [q['sql'] for q in context.captured_queries
+                    if 'FROM "core_instance"' in q['sql']]
+
+        self.assertEqual(1, len(instance_queries(reverse('project-list'))))
+        self.assertEqual([], instance_queries(reverse('project-list'),
+                                              fields='name,state'))
+
+        # a single project loads only the instances in its regions
+        queries = instance_queries(reverse('project-detail',
+                                           args=[project.id]))
+        self.assertEqual(1, len(queries))
+        self.assertIn('"region" IN', queries[0])
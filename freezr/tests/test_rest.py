@@ -14,6 +14,10 @@ from django.conf import settings
 log = logging.getLogger(__file__)
 
 
+def ids(instances):
+    return sorted(i.instance_id for i in instances)
+
+
 def flatu(items):
     """flat unique"""
     return list(set(chain.from_iterable(items)))
@@ -35,7 +39,8 @@ class TestREST(Mixin, test.APITestCase):
         self.assertEqual(2, len(response.data))
         self.assertItemsEqual(flatu([d.keys() for d in response.data]),
                               ('id', 'name', 'description', 'active',
-                               'accounts', 'log_entries', 'domain'))
+                               'accounts', 'log_entries', 'domain',
+                               'sequence'))
 
     def testGetDomain(self):
         response = self.client.get(reverse('domain-detail', args=[1]))
@@ -46,7 +51,8 @@ class TestREST(Mixin, test.APITestCase):
                             'active': True,
                             'accounts': [1, 2],
                             'log_entries': [],
-                            'domain': u'test.local'})
+                            'domain': u'test.local',
+                            'sequence': 0})
         response = self.client.get(reverse('domain-detail', args=[2]))
         self.assertSimilar(response.data,
                            {'id': 2,
@@ -55,7 +61,8 @@ class TestREST(Mixin, test.APITestCase):
                             'active': True,
                             'accounts': [3],
                             'log_entries': [],
-                            'domain': u'domain.com'})
+                            'domain': u'domain.com',
+                            'sequence': 0})
 
     def testListAccounts(self):
         response = self.client.get(reverse('account-list'))
@@ -64,7 +71,7 @@ class TestREST(Mixin, test.APITestCase):
         self.assertItemsEqual(flatu([d.keys() for d in response.data]),
                               ('id', 'domain', 'name', 'access_key', 'active',
                                'projects', 'regions', 'instances', 'updated',
-                               'log_entries'))
+                               'log_entries', 'sequence'))
 
     def testGetAccount(self):
         response = self.client.get(reverse('account-detail', args=[1]))
@@ -85,7 +92,8 @@ class TestREST(Mixin, test.APITestCase):
                                         u'eu-west-1'],
                             'instances': [1, 2],
                             'updated': None,
-                            'log_entries': []})
+                            'log_entries': [],
+                            'sequence': 0})
 
         response = self.client.get(reverse('account-detail', args=[2]))
         self.assertSimilar(response.data,
@@ -98,7 +106,8 @@ class TestREST(Mixin, test.APITestCase):
                             'regions': [],
                             'instances': [],
                             'updated': None,
-                            'log_entries': []})
+                            'log_entries': [],
+                            'sequence': 0})
 
         response = self.client.get(reverse('account-detail', args=[3]))
         self.assertSimilar(response.data,
@@ -126,7 +135,8 @@ class TestREST(Mixin, test.APITestCase):
                                              'message': u'Sample log entry',
                                              'details': None,
                                              'user_id': None,
-                                             'user': None}]})
+                                             'user': None}],
+                            'sequence': 0})
 
     def testListProjects(self):
         response = self.client.get(reverse('project-list'))
@@ -138,7 +148,7 @@ class TestREST(Mixin, test.APITestCase):
                                'save_filter', 'terminate_filter',
                                'picked_instances', 'saved_instances',
                                'terminated_instances', 'skipped_instances',
-                               'log_entries', 'state_updated'))
+                               'log_entries', 'state_updated', 'sequence'))
 
     def testGetProject(self):
         response = self.client.get(reverse('project-detail', args=[1]))
@@ -168,6 +178,7 @@ class TestREST(Mixin, test.APITestCase):
                             'state_updated':
                             datetime(2013, 12, 2, 12, 12, 12,
                                      tzinfo=pytz.utc),
+                            'sequence': 0,
                             })
         response = self.client.get(reverse('project-detail', args=[2]))
         self.assertSimilar(response.data,
@@ -196,8 +207,177 @@ class TestREST(Mixin, test.APITestCase):
                             'state_updated':
                             datetime(2013, 12, 2, 12, 12, 12,
                                      tzinfo=pytz.utc),
+                            'sequence': 0,
                             })
 
+    def testListSince(self):
+        response = self.client.get(reverse('project-list'), {'since': -1})
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertEqual(response.data['deleted'], [])
+        cursor = response.data['cursor']
+
+        response = self.client.get(reverse('project-list'),
+                                   {'since': cursor})
+        self.assertEqual(response.data['results'], [])
+        self.assertEqual(response.data['cursor'], cursor)
+
+        project = Project.objects.get(pk=2)
+        project.description = 'changed'
+        project.save()
+        Project.objects.get(pk=1).delete()
+
+        response = self.client.get(reverse('project-list'),
+                                   {'since': cursor})
+        self.assertEqual([p['id'] for p in response.data['results']], [2])
+        self.assertEqual(response.data['deleted'], [1])
+        self.assertGreater(response.data['cursor'], cursor)
+
+        # project change is visible on the account, too
+        response = self.client.get(reverse('account-list'),
+                                   {'since': cursor})
+        self.assertEqual(set(a['id'] for a in response.data['results']),
+                         set([1, 3]))
+
+    def testInstanceListSince(self):
+        response = self.client.get(reverse('instance-list'), {'since': -1})
+        cursor = response.data['cursor']
+
+        instance = Instance.objects.get(pk=3)
+        instance.state = 'stopped'
+        instance.save()
+
+        response = self.client.get(reverse('instance-list'),
+                                   {'since': cursor})
+        self.assertEqual([(i['id'], i['state'])
+                          for i in response.data['results']],
+                         [(3, 'stopped')])
+
+        response = self.client.get(reverse('instance-list'),
+                                   {'since': 'bad'})
+        self.assertEqual(response.status_code, 400)
+
+    def testInstancePagination(self):
+        url = reverse('instance-list') + '?limit=2'
+        ids = []
+
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data['results']), 2)
+            ids.extend(i['id'] for i in response.data['results'])
+            url = response.data['next']
+
+        self.assertEqual(ids, [1, 2, 3, 4, 5])
+
+        response = self.client.get(reverse('instance-list'),
+                                   {'limit': 'bad'})
+        self.assertEqual(response.status_code, 400)
+
+    def testInstanceFields(self):
+        response = self.client.get(reverse('instance-list'),
+                                   {'fields': 'state,region'})
+        self.assertEqual([set(i.keys()) for i in response.data],
+                         [set(('id', 'state', 'region'))] * 5)
+
+    def testInstanceFiltering(self):
+        def ids(**params):
+            response = self.client.get(reverse('instance-list'), params)
+            self.assertEqual(response.status_code, 200)
+            if isinstance(response.data, dict):
+                return [i['id'] for i in response.data['results']]
+            return [i['id'] for i in response.data]
+
+        Instance.objects.filter(pk=4).update(state='stopped')
+
+        self.assertEqual(ids(account='1'), [1, 2])
+        self.assertEqual(ids(account='1,3', state='stopped'), [4])
+        self.assertEqual(ids(region='eu-west-1'), [])
+        self.assertEqual(ids(project='2'), [3, 5])
+        self.assertEqual(ids(project='2', filter='tag[save]'), [5])
+        self.assertEqual(ids(project='2', limit=1, cursor=3), [5])
+        self.assertEqual(ids(filter='tag[save]'), [1, 5])
+        self.assertEqual(ids(filter='tag[save]', limit=1, cursor=1), [5])
+
+        for params in ({'filter': 'tag['}, {'account': '1,abc'},
+                       {'project': 'abc'}):
+            response = self.client.get(reverse('instance-list'), params)
+            self.assertEqual(response.status_code, 400)
+
+    def testExplain(self):
+        response = self.client.get(reverse('project-explain', args=[1]))
+        self.assertEqual(response.status_code, 200)
+
+        # profiled as actually evaluated, see Project.explain
+        pick = response.data['pick']
+        self.assertEqual((pick['filter'], pick['instances'],
+                          pick['narrowed'], pick['matched']),
+                         ('tag[project111]', 2, 2, 2))
+        self.assertEqual((pick['tree']['evaluations'], pick['tree']['rows'],
+                          pick['tree']['true'], pick['tree']['predicates']),
+                         (1, 2, 2, 1))
+
+        save = response.data['save']
+        self.assertEqual((save['narrowed'], save['matched']), (1, 1))
+        self.assertEqual(save['optimized'], save['tree']['expression'])
+        self.assertEqual(save['tree']['rows'], 1)
+
+        self.assertEqual(response.data['terminate']['matched'], 1)
+
+        response = self.client.get(reverse('project-explain', args=[2]))
+        self.assertEqual(response.data['terminate'], None)
+
+    def testNestedLogEntries(self):
+        project = Project.objects.get(pk=1)
+
+        for i in range(15):
+            project.log_entry('entry %d' % (i,))
+
+        response = self.client.get(reverse('project-detail', args=[1]))
+        self.assertEqual([l['message'] for l in response.data['log_entries']],
+                         ['entry %d' % (i,) for i in range(5, 15)])
+
+        response = self.client.get(reverse('project-detail', args=[1]),
+                                   {'log_entries': 2})
+        self.assertEqual([l['message'] for l in response.data['log_entries']],
+                         ['entry 13', 'entry 14'])
+
+        response = self.client.get(reverse('project-detail', args=[1]),
+                                   {'log_entries': 0})
+        self.assertEqual(response.data['log_entries'], [])
+
+    def testLogEntries(self):
+        project = Project.objects.get(pk=1)
+
+        for i in range(5):
+            project.log_entry('entry %d' % (i,), type='verbose')
+
+        self.account.log_entry('account entry', type='error')
+
+        response = self.client.get(reverse('log-list'))
+        self.assertEqual(response.data['count'], 7)
+        self.assertEqual(response.data['results'][0]['message'],
+                         'account entry')
+
+        response = self.client.get(reverse('log-list'),
+                                   {'project': 1, 'page_size': 2})
+        self.assertEqual(response.data['count'], 5)
+        self.assertEqual([l['message'] for l in response.data['results']],
+                         ['entry 4', 'entry 3'])
+        self.assertIsNotNone(response.data['next'])
+
+        response = self.client.get(reverse('log-list'),
+                                   {'type': 'error,info'})
+        self.assertEqual(set(l['message'] for l in response.data['results']),
+                         set(['account entry', 'Sample log entry']))
+
+        response = self.client.get(reverse('log-list'),
+                                   {'before': '2014-01-01T00:00:00Z'})
+        self.assertEqual([l['message'] for l in response.data['results']],
+                         ['Sample log entry'])
+
+        response = self.client.get(reverse('log-list'), {'after': 'bad'})
+        self.assertEqual(response.status_code, 400)
+
     # Note that this absolutely requires that you either have set up a
     # testing celery with the same test database as this test is using
     # (yeah, right), or have set CELERY_ALWAYS_EAGER = True in
@@ -236,7 +416,7 @@ class TestREST(Mixin, test.APITestCase):
 
     ## Note: It is not possible to really test refresh with
     ## transitioning states, since the test suite will run all tasks
-    ## synchronously this would cause tasks.refresh_instance to
+    ## synchronously this would cause tasks.refresh_instance_states to
     ## recursively call itself.
 
     # def testRefreshAccountTransitioningInstances(self):
@@ -284,13 +464,82 @@ class TestREST(Mixin, test.APITestCase):
             # (terminate_instance|freeze_instance)+ refresh_region but
             # oh well. Don't make test cases too elaborate.
             self.assertTrue(
-                (names == ['refresh_region', 'terminate_instance',
-                           'freeze_instance', 'refresh_region'] or
-                 names == ['refresh_region', 'freeze_instance',
-                           'terminate_instance', 'refresh_region']),
+                (names == ['refresh_states', 'terminate_instance',
+                           'freeze_instance', 'refresh_states'] or
+                 names == ['refresh_states', 'freeze_instance',
+                           'terminate_instance', 'refresh_states']),
                 "%r is not expected "
                 "refresh+freeze/terminate+refresh sequence" % (names,))
 
+    def testBulkFreeze(self):
+        for p in Project.objects.all():
+            p.state = 'running'
+            p.save()
+
+        # another project in account 1, not in a state to freeze
+        frozen = Project(account=self.account, name='Frozen',
+                         pick_filter='tag[project111]',
+                         state_actual='frozen')
+        frozen.save()
+
+        factory = AwsMockFactory(ImmediateAwsMock)
+
+        with with_aws(factory):
+            response = self.client.post(reverse('project-bulk',
+                                                args=['freeze']),
+                                        {'projects': [1, 2, frozen.id]})
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response.data['projects'], [1, 2])
+            self.assertEqual(response.data['skipped'],
+                             {frozen.id: 'Project state is not valid '
+                              'for freezing'})
+
+            # one backend per account, which refreshes the instance
+            # states once before and after changing the instances
+            self.assertEqual(len(factory.aws_list), 2)
+
+            for aws in factory.aws_list:
+                names = [c[0] for c in aws.calls]
+                names = reduce(lambda a, b: a if a[-1] == b else a + [b],
+                               names[1:], [names[0]])
+
+                self.assertEqual(names, ['refresh_states', 'change_instances',
+                                         'refresh_states'])
+
+            calls = [(c[1], ids(c[2]))
+                     for c in chain.from_iterable(a.calls
+                                                  for a in factory.aws_list)
+                     if c[0] == 'change_instances']
+
+            self.assertItemsEqual(calls, [('terminate', ['i-000002']),
+                                          ('stop', ['i-000001']),
+                                          ('stop', ['i-000003', 'i-000005'])])
+
+        self.assertEqual(['frozen', 'frozen', 'frozen'],
+                         [p.state for p in Project.objects.order_by('id')])
+
+    def testBulkFreezeSelection(self):
+        factory = AwsMockFactory(ImmediateAwsMock)
+
+        with with_aws(factory):
+            response = self.client.post(reverse('project-bulk',
+                                                args=['thaw']), {})
+            self.assertEqual(response.status_code, 400)
+
+            response = self.client.post(reverse('project-bulk',
+                                                args=['thaw']),
+                                        {'account': 'foo'})
+            self.assertEqual(response.status_code, 400)
+
+            response = self.client.post(reverse('project-bulk',
+                                                args=['thaw']),
+                                        {'domain': 2})
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response.data['projects'], [])
+            self.assertEqual(response.data['skipped'],
+                             {2: 'Project state is not valid for thawing'})
+            self.assertEqual(factory.aws_list, [])
+
     def testThawAccount(self):
         factory = AwsMockFactory(ImmediateAwsMock)
 
@@ -339,5 +588,5 @@ class TestREST(Mixin, test.APITestCase):
             names = reduce(lambda a, b: a if a[-1] == b else a + [b],
                            names[1:], [names[0]])
 
-            self.assertEqual(names, ['refresh_region', 'thaw_instance',
-                                     'refresh_region'])
+            self.assertEqual(names, ['refresh_states', 'thaw_instance',
+                                     'refresh_states'])
@@ -0,0 +1,122 @@
+from django import test
+from django.core import serializers
+from django.utils import timezone
+from datetime import timedelta
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+from freezr.core.models import Account, Domain, LogEntry, Tombstone
+from freezr.core import retention
+
+log = logging.getLogger(__file__)
+
+
+class TestRetention(test.TestCase):
+    def setUp(self):
+        self.domain = Domain(name="test", domain=".test")
+        self.domain.save()
+        self.account = Account(domain=self.domain, name="test",
+                               access_key="1234",
+                               secret_key="abcd")
+        self.account.save()
+        self.now = timezone.now().replace(hour=12, minute=0, second=0,
+                                          microsecond=0)
+
+    def entry(self, message, days, type='verbose', hours=0, obj=None):
+        l = LogEntry(message=message, type=type,
+                     time=self.now - timedelta(days=days, hours=hours))
+        l.set_object(obj or self.account)
+        l.save()
+        return l
+
+    def messages(self):
+        return [l.message for l in LogEntry.objects.order_by('time', 'id')]
+
+    @test.utils.override_settings(
+        FREEZR_LOG_RETENTION={'verbose': timedelta(days=7)})
+    def testExpire(self):
+        self.entry('old verbose', 8)
+        self.entry('old info', 8, type='info')
+        self.entry('new verbose', 6)
+
+        self.assertEqual(1, retention.expire_log_entries(self.now))
+        self.assertEqual(['old info', 'new verbose'], self.messages())
+        self.assertEqual(0, retention.expire_log_entries(self.now))
+
+    @test.utils.override_settings(
+        FREEZR_LOG_ROLLUP={'verbose': timedelta(days=1)})
+    def testRollup(self):
+        for hours in range(3):
+            self.entry('Refreshed 1 regions in %d.5 seconds' % (hours,),
+                       2, hours=hours)
+
+        self.entry('Refreshed 1 regions in 9.5 seconds', 2, obj=self.domain)
+        self.entry('Something else', 2, hours=1)
+        # today and yesterday are not rolled up
+        self.entry('Refreshed 1 regions in 1.0 seconds', 1)
+        self.entry('Refreshed 1 regions in 2.0 seconds', 1, hours=1)
+
+        self.assertEqual(2, retention.rollup_log_entries(self.now))
+        self.assertEqual(5, LogEntry.objects.count())
+
+        rollup = LogEntry.objects.get(account=self.account,
+                                      message__contains='similar')
+        self.assertEqual('Refreshed 1 regions in 0.5 seconds '
+                         '(3 similar entries since 10:00)',
+                         rollup.message)
+        self.assertEqual(self.now - timedelta(days=2), rollup.time)
+
+        # Rolling up again does nothing
+        self.assertEqual(0, retention.rollup_log_entries(self.now))
+
+    @test.utils.override_settings(
+        FREEZR_TOMBSTONE_RETENTION=timedelta(days=7))
+    def testExpireTombstones(self):
+        for id, days in ((1, 9), (2, 8), (3, 6)):
+            Tombstone(kind='instance', object_id=id, sequence=id * 10,
+                      time=self.now - timedelta(days=days)).save()
+
+        self.assertEqual(0, Tombstone.horizon())
+        self.assertEqual(2, retention.expire_tombstones(self.now))
+        self.assertEqual([('', 20), ('instance', 30)],
+                         list(Tombstone.objects.order_by('sequence')
+                              .values_list('kind', 'sequence')))
+        self.assertEqual(20, Tombstone.horizon())
+
+        # the horizon moves on with the next expired ones
+        self.assertEqual(0, retention.expire_tombstones(self.now))
+        self.assertEqual(1, retention.expire_tombstones(
+            self.now + timedelta(days=2)))
+        self.assertEqual([('', 30)],
+                         list(Tombstone.objects.values_list('kind',
+                                                            'sequence')))
+
+    def testArchive(self):
+        directory = tempfile.mkdtemp()
+
+        try:
+            with self.settings(FREEZR_LOG_ARCHIVE_DIR=directory,
+                               FREEZR_LOG_RETENTION={
+                                   'verbose': timedelta(days=7)}):
+                entries = [self.entry('entry %d' % (n,), 8)
+                           for n in range(5)]
+
+                self.assertEqual(5, retention.expire_log_entries(self.now))
+
+            filename = os.path.join(directory, 'log-entries-%d-%d.json.gz' % (
+                entries[0].id, entries[-1].id))
+            self.assertEqual([filename],
+                             [os.path.join(directory, name)
+                              for name in os.listdir(directory)])
+
+            archived = [o.object for o in serializers.deserialize(
+                'json', gzip.open(filename).read())]
+
+            self.assertEqual([l.id for l in entries],
+                             [l.id for l in archived])
+            self.assertEqual(['entry %d' % (n,) for n in range(5)],
+                             [l.message for l in archived])
+        finally:
+            shutil.rmtree(directory)
@@ -27,6 +27,47 @@ class instance_modifier(object):
 
         instance.save()
 
+    def refresh_states(self, account, region, instances):
+        self.refreshes += 1
+
+        # State refresh only tells the state.
+        for instance in instances:
+            instance.state = self.changes.get('state', instance.state)
+            instance.save()
+
+        return (len(instances), len(instances), 0)
+
+
+class change_failer(object):
+    """Stops instances, except for those in `failing` which are
+    reported as failed. Raises `exception` instead if given. Calls
+    `on_refresh` on state refreshes, if given."""
+
+    def __init__(self, failing=(), exception=None, on_refresh=None):
+        self.failing = failing
+        self.exception = exception
+        self.on_refresh = on_refresh
+        self.changes = 0
+
+    def refresh_states(self, account, region, instances):
+        if self.on_refresh:
+            self.on_refresh()
+
+        return (len(instances), len(instances), 0)
+
+    def change_instances(self, action, instances, on_error=None):
+        self.changes += 1
+
+        if self.exception:
+            raise self.exception
+
+        for instance in instances:
+            if instance.instance_id in self.failing:
+                on_error(instance, Exception('Not permitted'))
+            else:
+                instance.state = 'stopped'
+                instance.save()
+
 
 class TestTasks(test.TestCase):
     def setUp(self):
@@ -103,6 +144,43 @@ class TestTasks(test.TestCase):
         case('stopping', 'running', False)
         case('stopping', 'running', True, aws_instance=aws_instance)
 
+    def testInstanceStatesRefresh(self):
+        # transitioning instances are refreshed together, and problem
+        # transitions logged as with refresh_instance
+        other = self.account.new_instance(instance_id="i-456",
+                                          type="m1.small",
+                                          region="us-east-1",
+                                          state="stopping")
+        other.save()
+        self.instance.state = 'pending'
+        self.instance.save()
+
+        dispatched = []
+        dispatch = tasks.dispatch
+        tasks.dispatch = lambda task, **kwargs: dispatched.append(task)
+
+        try:
+            tasks.schedule_transitioning(Instance.objects.all())
+        finally:
+            tasks.dispatch = dispatch
+
+        self.assertEqual([(self.account.id, [self.instance.id, other.id])],
+                         [task.args for task in dispatched])
+
+        obj = instance_modifier(state='stopped')
+
+        with with_aws(AwsMockFactory(obj=obj)):
+            tasks.dispatch(dispatched[0]).get()
+
+        # one state refresh for both, and a full one for the problem
+        self.assertEqual(2, obj.refreshes)
+        self.assertEqual(['stopped', 'stopped'],
+                         [i.state for i in Instance.objects.order_by('id')])
+        self.assertEqual(
+            ['Problem starting instance i-123'],
+            [entry.message
+             for entry in self.account.log_entries.filter(type='error')])
+
     def account_refresh(self, timestamp=None):
         class updated_proxy(object):
             def __init__(self, parent):
@@ -212,3 +290,101 @@ class TestTasks(test.TestCase):
                 self.assertNotEqual(proxy.updated, now)
                 factory.assertUsed()
                 factory.aws.assertCalled()
+
+    def testReissueOperations(self):
+        # only operations whose lease has expired are resumed
+        self.project.save_state('freezing')
+        owner = self.project.acquire_operation()
+
+        factory = AwsMockFactory()
+        with with_aws(factory):
+            tasks.dispatch(tasks.reissue_operations.si()).get()
+            factory.assertNotUsed()
+
+            project = Project.objects.get(pk=self.project.pk)
+            self.assertEqual('freezing', project.state)
+            self.assertEqual(owner, project.operation_owner)
+
+            Project.objects.filter(pk=self.project.pk).update(
+                operation_expires=timezone.now() - timedelta(seconds=1))
+
+            tasks.dispatch(tasks.reissue_operations.si()).get()
+            factory.assertUsed()
+
+            project = Project.objects.get(pk=self.project.pk)
+            self.assertEqual('frozen', project.state)
+            self.assertEqual('', project.operation_owner)
+            self.assertIsNone(project.operation_expires)
+
+    def run_operations(self, aws):
+        """Freeze the project with run_operations, returning the
+        operation and the tasks it dispatched."""
+        self.project.pick_filter = self.project.save_filter = 'true'
+        self.project.save()
+        self.project.save_state('freezing')
+        operation = self.project.acquire_operation()
+        dispatched = []
+        dispatch = tasks.dispatch
+        tasks.dispatch = lambda task, **kwargs: dispatched.append(task)
+
+        try:
+            with with_aws(AwsMockFactory(obj=aws)):
+                tasks.run_operations(self.account.id, 'freeze', 'freezing',
+                                     [(self.project.id, operation)])
+        finally:
+            tasks.dispatch = dispatch
+
+        return operation, dispatched
+
+    def testRunOperationsFailures(self):
+        # failures are logged against the project, which is left for
+        # refresh_project to follow
+        other = self.account.new_instance(instance_id="i-456",
+                                          type="m1.small",
+                                          region="us-east-1",
+                                          state="running")
+        other.save()
+
+        operation, dispatched = self.run_operations(
+            change_failer(failing=('i-123',)))
+
+        self.assertEqual('stopped', Instance.objects.get(pk=other.pk).state)
+        self.assertEqual(
+            ['Could not stop instance i-123'],
+            [entry.message
+             for entry in self.project.log_entries.filter(type='error')])
+
+        self.assertEqual(['freezr.backend.tasks.refresh_project'],
+                         [task.task for task in dispatched])
+        self.assertEqual(
+            operation, Project.objects.get(pk=self.project.pk).operation_owner)
+
+    def testRunOperationsException(self):
+        # the lease is released when the operation fails altogether
+        with self.assertRaises(RuntimeError):
+            self.run_operations(change_failer(exception=RuntimeError()))
+
+        self.assertEqual(
+            '', Project.objects.get(pk=self.project.pk).operation_owner)
+
+    def testRunOperationsExpiredLease(self):
+        # the lease expires during the state refresh and is taken
+        # over, after which the instances are left alone
+        taken = []
+
+        def take_over():
+            if not taken:
+                project = Project.objects.get(pk=self.project.pk)
+                project.acquire_operation(project.operation_owner, lease=-1)
+                taken.append(project.acquire_operation())
+
+        aws = change_failer(on_refresh=take_over)
+        operation, dispatched = self.run_operations(aws)
+
+        self.assertNotEqual(operation, taken[0])
+        self.assertEqual(0, aws.changes)
+        self.assertEqual([], dispatched)
+        self.assertEqual('running',
+                         Instance.objects.get(pk=self.instance.pk).state)
+        self.assertEqual(
+            taken[0], Project.objects.get(pk=self.project.pk).operation_owner)
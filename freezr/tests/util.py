@@ -49,6 +49,13 @@ class AwsMock(object):
         self.calls.append(('refresh_region', account, region))
         return self.result
 
+    def refresh_states(self, account, region, instances=None):
+        log.debug('AwsMock.refresh_states: account=%r region=%r',
+                  account, region)
+
+        self.calls.append(('refresh_states', account, region, instances))
+        return self.result
+
     def freeze_instance(self, instance):
         log.debug('AwsMock.freeze_instance: instance=%r', instance)
         self.calls.append(('freeze_instance', instance))
@@ -61,6 +68,11 @@ class AwsMock(object):
         log.debug('AwsMock.terminate_instance: instance=%r', instance)
         self.calls.append(('terminate_instance', instance))
 
+    def change_instances(self, action, instances, on_error=None):
+        log.debug('AwsMock.change_instances: action=%r instances=%r',
+                  action, instances)
+        self.calls.append(('change_instances', action, instances))
+
 
 class ImmediateAwsMock(AwsMock):
     """Version of AwsMock that will freeze and thaw instances
@@ -81,6 +93,15 @@ class ImmediateAwsMock(AwsMock):
         instance.state = 'terminated'
         instance.save()
 
+    def change_instances(self, action, instances, on_error=None):
+        super(ImmediateAwsMock, self).change_instances(action, instances,
+                                                       on_error)
+
+        for instance in instances:
+            instance.state = {'stop': 'stopped', 'start': 'running',
+                              'terminate': 'terminated'}[action]
+            instance.save()
+
 
 class AwsMockFactory(object):
     def __init__(self, cls=AwsMock, obj=None):
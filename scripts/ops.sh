@@ -3,9 +3,16 @@ id=${1-1}
 base=${OP-$(basename $0 .sh)}
 account=
 base_url=${base_url-http://localhost:8000/api}
+data='{}'
 case $base in
     freeze|thaw)
-	url=$base_url/project/$id/$base/
+	if [ $# -gt 1 ]; then
+	    # Several projects at once
+	    url=$base_url/project/$base/
+	    data="{\"projects\": [$(IFS=,; echo "$*")]}"
+	else
+	    url=$base_url/project/$id/$base/
+	fi
 	;;
     refresh)
 	url=$base_url/account/$id/$base/
@@ -15,5 +22,5 @@ case $base in
 	exit 2
 esac
 
-echo '{}' | lwp-request -E -m POST -H 'Accept: application/json' -c 'application/json' $url
+echo "$data" | lwp-request -E -m POST -H 'Accept: application/json' -c 'application/json' $url
 exit 0
@@ -167,6 +167,7 @@ else
     echo -n "Initializing test database ... "
     (rm -f db.sqlite3 && \
 	$manage syncdb --noinput && \
+	$manage upgrade && \
 	$manage loaddata $test_dir/fixtures.yaml) >>$(logname freezr) 2>&1
     echo "done"
 
@@ -34,10 +34,13 @@
 #
 # 3) Assign `STATE` with your custom `AWS` state.
 
+import errno
 import logging
+import socket
 from copy import deepcopy
 from Queue import PriorityQueue
 from time import time
+from boto.exception import EC2ResponseError
 from freezr.backend.aws import AwsInterface
 
 # Defaults that are used unless specified
@@ -152,6 +155,12 @@ class AttrDict(dict):
         self.__dict__ = self
 
 
+class StatusSet(list):
+    """Mimics `boto.ec2.instancestatus.InstanceStatusSet`. All
+    results are always returned at once."""
+    next_token = None
+
+
 class AWS(object):
     """Abstraction of an AWS state. Typically this is fed `INSTANCES`
     on startup (via `Mock`) and this maintains information on state
@@ -170,6 +179,7 @@ class AWS(object):
         self.instances = {}
         self.count = 0
         self.ops = PriorityQueue()
+        self.unavailable = set()
         for instance in deepcopy(instances):
             self.add_instance(instance)
 
@@ -228,6 +238,13 @@ class AWS(object):
 
             call()
 
+    def check_region(self, region):
+        """Raise a network error if `region` has been marked
+        unavailable (by adding it to `unavailable`)."""
+        if region in self.unavailable:
+            self.log.debug("check_region: %r unavailable", region)
+            raise socket.error(errno.ECONNREFUSED, 'Connection refused')
+
     def get_instances(self):
         """Return a list of instances. The returned list elements try
         to mimic the behavior of `boto.ec2.instances.Instance` to the
@@ -237,6 +254,31 @@ class AWS(object):
                        len(self.instances))
         return [AttrDict(instance) for instance in self.instances.values()]
 
+    def get_instance_status(self, region, ids=None):
+        """Return the statuses of instances in `region`, either of
+        the given instance `ids` or of all instances. Like
+        DescribeInstanceStatus, fails if any of the `ids` is
+        unknown."""
+        self.tick()
+        self.log.debug("get_instance_status: %r in %s", ids, region)
+        instances = [instance for instance in self.instances.values()
+                     if instance['region'] == region]
+
+        if ids is not None:
+            missing = set(ids) - set(i['id'] for i in instances)
+
+            if missing:
+                ex = EC2ResponseError(400, 'Bad Request')
+                ex.error_code = 'InvalidInstanceID.NotFound'
+                ex.error_message = 'Unknown instances: {0}'.format(
+                    ', '.join(sorted(missing)))
+                raise ex
+
+            instances = [i for i in instances if i['id'] in ids]
+
+        return StatusSet(AttrDict(id=i['id'], state_name=i['state'])
+                         for i in instances)
+
     def terminate_instance(self, id):
         self.tick()
         self.log.debug("terminate_instance: %r", id)
@@ -295,10 +337,23 @@ class EC2Interface(object):
     ## boto.ec2 interface mocks
 
     def get_only_instances(self, instance_ids=None):
+        self.state.check_region(self.region)
         return [i for i in self.state.get_instances()
                 if ((instance_ids is None or i.id in instance_ids) and
                     i.region == self.region)]
 
+    def build_list_params(self, params, items, label):
+        for i, item in enumerate(items, 1):
+            params['{0}.{1}'.format(label, i)] = item
+
+    def get_object(self, action, params, cls, verb='GET'):
+        # Only DescribeInstanceStatus is used via this
+        assert action == 'DescribeInstanceStatus', action
+        self.state.check_region(self.region)
+        ids = [value for key, value in params.items()
+               if key.startswith('InstanceId.')]
+        return self.state.get_instance_status(self.region, ids or None)
+
     # Note: {terminate,stop,start}_instances **do not** honor region
     # since we know that instance ids are unique over all regions in
     # our test setup. That is, you can kill instances in other regions
@@ -328,6 +383,7 @@ class Mock(AwsInterface):
 
     def __init__(self, access_key=None, secret_key=None):
         global STATE
+        super(Mock, self).__init__(access_key, secret_key)
         self.log = logging.getLogger('freezr.systemtests.aws.Mock')
         self.log.debug("access_key=%r", access_key)
         if not STATE:
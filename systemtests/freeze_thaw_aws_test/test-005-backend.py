@@ -0,0 +1,80 @@
+import unittest
+import util
+import aws
+from freezr.backend.breaker import breaker, RegionUnavailable
+from freezr.backend.ratelimit import limiter
+
+
+class BackendTests(util.Mixin, unittest.TestCase):
+    """Exercise the cloud backend directly (not through the freezr
+    server) using the fake AWS interface. The fake AWS state in here
+    is separate from the one used by the server under test."""
+
+    # Not used by any of the accounts, so that the server is not
+    # affected by the circuit breaker state.
+    REGION = 'test-region-1'
+
+    def setUp(self):
+        super(BackendTests, self).setUp()
+        self.aws = aws.Mock(self.AWS_ACCESS_KEY_ID,
+                            self.AWS_SECRET_ACCESS_KEY)
+        breaker.reset(self.REGION)
+
+    def tearDown(self):
+        aws.STATE.unavailable.discard(self.REGION)
+        breaker.reset(self.REGION)
+
+    @util.only_fake_aws
+    def test01RateLimitedCalls(self):
+        """005-01 EC2 calls go through the rate limiter"""
+        calls = limiter.stats()['calls']
+        instances = self.aws.call(self.AWS_REGION, 'DescribeInstances',
+                                  'get_only_instances')
+        self.assertEqual(
+            len([i for i in instances if i.state == 'running']), 6)
+        self.assertEqual(limiter.stats()['calls'], calls + 1)
+
+    @util.only_fake_aws
+    def test02CircuitBreaker(self):
+        """005-02 Failing region is cut off by the circuit breaker"""
+        aws.STATE.unavailable.add(self.REGION)
+
+        for i in range(3):
+            with self.assertRaises(RegionUnavailable):
+                self.aws.call(self.REGION, 'DescribeInstances',
+                              'get_only_instances')
+
+        self.assertTrue(breaker.is_open(self.REGION))
+
+        # Region is not called at all while the breaker is open.
+        aws.STATE.unavailable.discard(self.REGION)
+        calls = limiter.stats()['calls']
+
+        with self.assertRaises(RegionUnavailable):
+            self.aws.call(self.REGION, 'DescribeInstances',
+                          'get_only_instances')
+
+        self.assertEqual(limiter.stats()['calls'], calls)
+
+        breaker.reset(self.REGION)
+        self.assertEqual(self.aws.call(self.REGION, 'DescribeInstances',
+                                       'get_only_instances'), [])
+
+    @util.only_fake_aws
+    def test03InstanceStates(self):
+        """005-03 Instance states are described without full instances"""
+        instances = self.aws.call(self.AWS_REGION, 'DescribeInstances',
+                                  'get_only_instances')
+        expected = {i.id: i.state for i in instances}
+
+        self.assertEqual(self.aws.instance_states(self.AWS_REGION),
+                         expected)
+
+        ids = sorted(expected.keys())[:2]
+        self.assertEqual(self.aws.instance_states(self.AWS_REGION, ids),
+                         {id: expected[id] for id in ids})
+
+        # Unknown instances make it look at all of them
+        self.assertEqual(
+            self.aws.instance_states(self.AWS_REGION, ids + ['i-unknown']),
+            expected)
@@ -22,6 +22,14 @@ def only_real_aws(func):
     return inner
 
 
+def only_fake_aws(func):
+    @wraps(func)
+    def inner(self, *args, **kwargs):
+        if not self.real_aws:
+            return func(self, *args, **kwargs)
+    return inner
+
+
 class Client(object):
     """Quick and dirty almost-like-real-django/rest-test-Client
     class."""